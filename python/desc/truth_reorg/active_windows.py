@@ -0,0 +1,296 @@
+'''
+Interval index of SN active windows, answering "which SNe have flux at
+epoch t (or visit v), in this part of the sky" without scanning the
+variability table.
+
+A SN's window is [first MJD, last MJD] over its rows in the variability
+table, all bands.  Built once and stored in a directory as numpy arrays,
+memory-mapped when opened (as for SnIdDictionary):
+
+    key.npy, id.npy, ra.npy, dec.npy, first_mjd.npy, last_mjd.npy
+                   one entry per SN, ordered by duration class, then
+                   first_mjd
+    classes.npy    per duration class: upper bound on window length
+                   (days) and offset of the class's first entry
+    visits.npy, visit_mjd.npy
+                   obsHistID (sorted) and its MJD, for queries by visit
+    meta.json      sources and counts
+
+Stabbing query: windows whose length is at most L and which contain t
+have first_mjd in [t - L, t].  Duration classes have L = 1, 2, 4, ...
+days, so each class needs two binary searches and a scan of a slice
+holding hardly any windows which don't match.  A query costs
+O(n_classes log n + matches) and takes well under a millisecond for
+DC2 sizes.
+'''
+import os
+import json
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+__all__ = ['ActiveWindows']
+
+_META = 'meta.json'
+_COLUMNS = ('key', 'id', 'ra', 'dec', 'first_mjd', 'last_mjd')
+
+def _reduce_windows(parts, key):
+    '''
+    Combine partial (key, first_mjd, last_mjd) tables
+    '''
+    tbl = pa.concat_tables(parts).group_by(key).aggregate(
+        [('first_mjd', 'min'), ('last_mjd', 'max')])
+    return pa.table({key : tbl[key], 'first_mjd' : tbl['first_mjd_min'],
+                     'last_mjd' : tbl['last_mjd_max']})
+
+def _merge_visits(parts):
+    '''
+    Combine partial (obsHistID, MJD) tables
+    '''
+    tbl = pa.concat_tables(parts).group_by('obsHistID').aggregate(
+        [('MJD', 'min')])
+    return pa.table({'obsHistID' : tbl['obsHistID'], 'MJD' : tbl['MJD_min']})
+
+def _to_numpy(col):
+    col = col.combine_chunks() if isinstance(col, pa.ChunkedArray) else col
+    if pa.types.is_string(col.type) or pa.types.is_large_string(col.type):
+        return np.array(col.to_pylist(), dtype=str)
+    return col.to_numpy(zero_copy_only=False)
+
+class ActiveWindows:
+    '''
+    Parameters
+    ----------
+    directory   string  as written by ActiveWindows.build
+    '''
+    def __init__(self, directory):
+        self._directory = directory
+        self._arrays = {c : np.load(os.path.join(directory, c + '.npy'),
+                                    mmap_mode='r')
+                        for c in _COLUMNS}
+        classes = np.load(os.path.join(directory, 'classes.npy'))
+        self._bounds = classes[0]
+        self._offsets = classes[1].astype(np.int64)
+        self._visits = np.load(os.path.join(directory, 'visits.npy'),
+                               mmap_mode='r')
+        self._visit_mjd = np.load(os.path.join(directory, 'visit_mjd.npy'),
+                                  mmap_mode='r')
+        with open(os.path.join(directory, _META)) as f:
+            self.meta = json.load(f)
+
+    def __len__(self):
+        return len(self._arrays['key'])
+
+    @staticmethod
+    def build(summary_path, out_dir, var_path=None, aggregates=None,
+              summary_table='truth_sn_summary',
+              var_table='truth_sn_variability', key='id_string',
+              batch_rows=500000):
+        '''
+        Compute active windows and write the index to out_dir.
+
+        Parameters
+        ----------
+        summary_path  string  sqlite or parquet SN summary; supplies key,
+                              id, ra, dec
+        var_path      string  sqlite or parquet variability file, read in
+                              one streaming pass for windows and visits
+        aggregates    string  alternatively, windows from a file written by
+                              lc_aggregates.aggregate_light_curves (no
+                              visit lookup then).  Its ids must be SN
+                              names: aggregate sn_variability_truth, or
+                              truth_sn_variability with id_column=id_string
+        key           string  column identifying a SN in both summary and
+                              variability.  id_string is unique; int ids
+                              made from host_galaxy need not be.  With
+                              aggregates it must be id_string
+
+        Returns the opened ActiveWindows
+        '''
+        from desc.truth_reorg.parquet_utils import read_batches
+
+        if (var_path is None) == (aggregates is None):
+            raise ValueError('Supply exactly one of var_path and aggregates')
+
+        parts = []
+        visit_parts = []
+        if aggregates is not None:
+            from desc.truth_reorg.lc_aggregates import LcAggregates
+
+            if key != 'id_string':
+                raise ValueError('Aggregates are keyed by SN name; use key=id_string')
+            agg = LcAggregates(aggregates).table
+            id_type = agg.schema.field('id').type
+            if not (pa.types.is_string(id_type) or pa.types.is_large_string(id_type)):
+                raise ValueError(f'{aggregates}: ids are not SN names; aggregate with id_column=id_string')
+            parts.append(pa.table({key : agg['id'],
+                                   'first_mjd' : agg['first_mjd'],
+                                   'last_mjd' : agg['last_mjd']}))
+        else:
+            for batch in read_batches(var_path, [key, 'obsHistID', 'MJD'],
+                                      table=var_table, batch_rows=batch_rows):
+                tbl = pa.Table.from_batches([batch])
+                win = tbl.group_by(key).aggregate([('MJD', 'min'),
+                                                   ('MJD', 'max')])
+                parts.append(pa.table({key : win[key],
+                                       'first_mjd' : win['MJD_min'],
+                                       'last_mjd' : win['MJD_max']}))
+                vis = tbl.group_by('obsHistID').aggregate([('MJD', 'min')])
+                visit_parts.append(pa.table({'obsHistID' : vis['obsHistID'],
+                                             'MJD' : vis['MJD_min']}))
+                # Keep memory bounded if the input is not grouped by key
+                if len(parts) >= 16:
+                    parts = [_reduce_windows(parts, key)]
+                    visit_parts = [_merge_visits(visit_parts)]
+        windows = _reduce_windows(parts, key)
+
+        columns = list(dict.fromkeys([key, 'id', 'ra', 'dec']))
+        summ = pa.Table.from_batches(list(read_batches(
+            summary_path, columns, table=summary_table,
+            batch_rows=batch_rows)))
+        # Summary rows with no variability rows have no window
+        idx = pc.index_in(summ[key], value_set=windows[key].combine_chunks())
+        keep = pc.is_valid(idx)
+        summ = summ.filter(keep)
+        idx = pc.drop_null(idx)
+        first = _to_numpy(pc.take(windows['first_mjd'], idx)).astype(np.float64)
+        last = _to_numpy(pc.take(windows['last_mjd'], idx)).astype(np.float64)
+
+        # Duration classes: length <= 2**c days, c = 0, 1, ...
+        length = np.maximum(last - first, 1.0)
+        cls = np.ceil(np.log2(length)).astype(np.int64)
+        n_cls = int(cls.max()) + 1 if len(cls) else 0
+        order = np.lexsort((first, cls))
+        bounds = np.exp2(np.arange(n_cls)).astype(np.float64)
+        offsets = np.searchsorted(cls[order], np.arange(n_cls + 1))
+
+        os.makedirs(out_dir, exist_ok=True)
+        arrays = {'key' : _to_numpy(summ[key]), 'id' : _to_numpy(summ['id']),
+                  'ra' : _to_numpy(summ['ra']).astype(np.float64),
+                  'dec' : _to_numpy(summ['dec']).astype(np.float64),
+                  'first_mjd' : first, 'last_mjd' : last}
+        for (name, arr) in arrays.items():
+            np.save(os.path.join(out_dir, name + '.npy'), arr[order])
+        np.save(os.path.join(out_dir, 'classes.npy'),
+                np.stack([np.append(bounds, np.inf), offsets.astype(np.float64)]))
+
+        if visit_parts:
+            vis = _merge_visits(visit_parts)
+            v_order = np.argsort(_to_numpy(vis['obsHistID']))
+            visits = _to_numpy(vis['obsHistID'])[v_order]
+            visit_mjd = _to_numpy(vis['MJD'])[v_order]
+        else:
+            visits = np.zeros(0, dtype=np.int64)
+            visit_mjd = np.zeros(0, dtype=np.float64)
+        np.save(os.path.join(out_dir, 'visits.npy'), visits)
+        np.save(os.path.join(out_dir, 'visit_mjd.npy'), visit_mjd)
+
+        meta = {'summary' : os.path.abspath(summary_path),
+                'variability' : os.path.abspath(var_path) if var_path else None,
+                'aggregates' : os.path.abspath(aggregates) if aggregates else None,
+                'key' : key, 'n_windows' : len(first),
+                'n_summary_without_window' : int(len(keep) - pc.sum(keep).as_py()),
+                'n_visits' : len(visits), 'n_classes' : n_cls}
+        with open(os.path.join(out_dir, _META), 'w') as f:
+            json.dump(meta, f, indent=2)
+        return ActiveWindows(out_dir)
+
+    def _stab(self, t0, t1):
+        '''
+        Positions of windows overlapping [t0, t1]
+        '''
+        first = self._arrays['first_mjd']
+        last = self._arrays['last_mjd']
+        found = []
+        for c in range(len(self._offsets) - 1):
+            lo, hi = self._offsets[c], self._offsets[c + 1]
+            if lo == hi:
+                continue
+            starts = first[lo:hi]
+            a = lo + np.searchsorted(starts, t0 - self._bounds[c], side='left')
+            b = lo + np.searchsorted(starts, t1, side='right')
+            if b > a:
+                found.append(a + np.flatnonzero(last[a:b] >= t0))
+        if not found:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate(found)
+
+    def active(self, mjd, mjd_end=None, region=None, box=None):
+        '''
+        SNe active at mjd, or at any time in [mjd, mjd_end].  Optionally
+        only those inside region (an object with contains(ra, dec), e.g.
+        sphgeom_utils.Region) or box (ra_min, ra_max, dec_min, dec_max,
+        degrees).
+
+        Returns pyarrow Table with columns key, id, ra, dec, first_mjd,
+        last_mjd
+        '''
+        pos = self._stab(mjd, mjd if mjd_end is None else mjd_end)
+        ra = self._arrays['ra'][pos]
+        dec = self._arrays['dec'][pos]
+        if box is not None:
+            keep = ((ra >= box[0]) & (ra <= box[1]) &
+                    (dec >= box[2]) & (dec <= box[3]))
+            pos, ra, dec = pos[keep], ra[keep], dec[keep]
+        if region is not None and len(pos) > 0:
+            keep = np.asarray(region.contains(ra, dec), dtype=bool)
+            pos = pos[keep]
+        return pa.table({c : self._arrays[c][pos] for c in _COLUMNS})
+
+    def visit_mjd(self, obsHistID):
+        '''
+        MJD of a visit, or None if no SN was observed in it
+        '''
+        i = np.searchsorted(self._visits, obsHistID)
+        if i < len(self._visits) and self._visits[i] == obsHistID:
+            return float(self._visit_mjd[i])
+        return None
+
+    def active_at_visit(self, obsHistID, region=None, box=None):
+        '''
+        As active, at the epoch of visit obsHistID
+        '''
+        mjd = self.visit_mjd(obsHistID)
+        if mjd is None:
+            raise KeyError(f'Visit {obsHistID} not in index')
+        return self.active(mjd, region=region, box=box)
+
+if __name__ == '__main__':
+    import argparse
+    from time import perf_counter
+
+    parser = argparse.ArgumentParser(description='Build or query the index of SN active windows')
+    parser.add_argument('index_dir')
+    parser.add_argument('--build', action='store_true')
+    parser.add_argument('--summary', default=None, help='SN summary file (build)')
+    parser.add_argument('--var-file', default=None, help='variability file (build)')
+    parser.add_argument('--aggregates', default=None,
+                        help='lc_aggregates output to use instead of --var-file (build)')
+    parser.add_argument('--var-table', default='truth_sn_variability')
+    parser.add_argument('--key', default='id_string')
+    parser.add_argument('--mjd', type=float, default=None)
+    parser.add_argument('--mjd-end', type=float, default=None)
+    parser.add_argument('--visit', type=int, default=None)
+    parser.add_argument('--box', type=float, nargs=4, default=None,
+                        metavar=('RA_MIN', 'RA_MAX', 'DEC_MIN', 'DEC_MAX'))
+
+    args = parser.parse_args()
+    if args.build:
+        aw = ActiveWindows.build(args.summary, args.index_dir,
+                                 var_path=args.var_file,
+                                 aggregates=args.aggregates,
+                                 var_table=args.var_table, key=args.key)
+        print(aw.meta)
+    else:
+        aw = ActiveWindows(args.index_dir)
+    if args.mjd is not None or args.visit is not None:
+        # The first call pays for one-time pyarrow initialization
+        aw.active(0.0)
+        t0 = perf_counter()
+        if args.visit is not None:
+            res = aw.active_at_visit(args.visit, box=args.box)
+        else:
+            res = aw.active(args.mjd, mjd_end=args.mjd_end, box=args.box)
+        ms = (perf_counter() - t0) * 1000
+        print(f'{res.num_rows} active SNe ({ms:.2f} ms)')
+        print(res.slice(0, 10).to_pandas())
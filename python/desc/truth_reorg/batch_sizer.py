@@ -0,0 +1,211 @@
+'''
+Adaptive batch size for the chunked fetch / transform / write loops.
+
+A BatchSizer holds the number of rows the next batch should have.  After
+each batch it is told how many rows the batch had and how long the batch
+took (fetch through commit), and moves the size toward
+
+    smoothed rows/s * target_s
+
+so that each batch takes about target_s seconds: long enough to amortize
+per-batch overhead (query steps, executemany, commit, parquet row
+groups), short enough to keep memory and progress granularity
+reasonable.  The size changes by at most a factor of 2 per batch and
+stays within [min_rows, max_rows].  If max_rss_mbyte is set, the size is
+also capped so that the memory attributed to a batch (RSS growth since
+the sizer was made, per row of the last batch) keeps the process under
+the ceiling, and halved immediately if the ceiling is exceeded.
+
+Loops use it in one of two ways:
+
+    sizer = as_sizer(chunksize)
+    while ...:
+        cur.arraysize = sizer.size
+        with sizer.batch() as b:
+            b.rows = self._do_chunk(cur)
+
+or, for a stream of RecordBatches,
+
+    for batch in sizer.timed(rebatch(source, sizer)):
+        ...
+
+as_sizer turns an int chunksize into a fixed-size sizer, so existing
+callers see no change; pass 'auto' (or a BatchSizer) to adapt.
+'''
+from contextlib import contextmanager
+from time import perf_counter
+
+from desc.truth_reorg.script_utils import current_rss_mbyte
+
+__all__ = ['BatchSizer', 'as_sizer', 'chunksize_arg', 'AUTO']
+
+AUTO = 'auto'
+
+class BatchSizer:
+    '''
+    Parameters
+    ----------
+    initial       int     size of the first batch
+    target_s      float   wanted wall time per batch
+    max_rss_mbyte float   if set, keep process RSS under this
+    min_rows      int     smallest size
+    max_rows      int     largest size
+    adaptive      bool    if False size stays at initial
+    smoothing     float   weight of the newest rows/s measurement
+    warmup        int     number of initial batches not used to adapt
+                          (the first usually includes query set-up)
+    '''
+    def __init__(self, initial=20000, target_s=2.0, max_rss_mbyte=None,
+                 min_rows=1000, max_rows=2000000, adaptive=True,
+                 smoothing=0.5, warmup=1):
+        self.adaptive = adaptive
+        self.target_s = target_s
+        self.max_rss_mbyte = max_rss_mbyte
+        self.min_rows = min_rows
+        self.max_rows = max_rows
+        self._smoothing = smoothing
+        self._warmup = warmup
+        if adaptive:
+            initial = min(max(initial, min_rows), max_rows)
+        self._size = int(initial)
+        self._rate = None
+        self._base_rss = None
+        self._mbyte_per_row = None
+        self.n_batches = 0
+        self.n_rows = 0
+        self.seconds = 0.0
+        self.sizes = [self._size]
+
+    def __getstate__(self):
+        # RSS baseline belongs to the process that measured it
+        state = dict(self.__dict__)
+        state['_base_rss'] = None
+        state['_mbyte_per_row'] = None
+        return state
+
+    @property
+    def size(self):
+        return self._size
+
+    def clone(self):
+        '''
+        New sizer with the same settings, starting from the current size.
+        Use one per loop when a job has loops of very different cost
+        '''
+        return BatchSizer(initial=self._size, target_s=self.target_s,
+                          max_rss_mbyte=self.max_rss_mbyte,
+                          min_rows=self.min_rows, max_rows=self.max_rows,
+                          adaptive=self.adaptive, smoothing=self._smoothing,
+                          warmup=self._warmup)
+
+    def _start(self):
+        if self.max_rss_mbyte is not None and self._base_rss is None:
+            self._base_rss = current_rss_mbyte()
+
+    def update(self, rows, seconds):
+        '''
+        Record a finished batch of rows taking seconds.  Returns the new
+        size
+        '''
+        self.n_batches += 1
+        self.n_rows += rows
+        self.seconds += seconds
+        if not self.adaptive or rows <= 0:
+            return self._size
+        if self.n_batches <= self._warmup:
+            return self._size
+
+        rate = rows / max(seconds, 1.0e-6)
+        if self._rate is None:
+            self._rate = rate
+        else:
+            self._rate = (self._smoothing * rate +
+                          (1.0 - self._smoothing) * self._rate)
+        want = self._rate * self.target_s
+        want = min(max(want, self._size / 2), self._size * 2)
+
+        if self.max_rss_mbyte is not None and self._base_rss is not None:
+            rss = current_rss_mbyte()
+            if rss is not None:
+                grown = max(rss - self._base_rss, 0.0)
+                self._mbyte_per_row = grown / rows
+                if rss > self.max_rss_mbyte:
+                    want = min(want, self._size / 2)
+                elif self._mbyte_per_row > 0:
+                    room = self.max_rss_mbyte - self._base_rss
+                    want = min(want, 0.8 * room / self._mbyte_per_row)
+
+        new = int(min(max(want, self.min_rows), self.max_rows))
+        if new != self._size:
+            self._size = new
+            self.sizes.append(new)
+        return self._size
+
+    @contextmanager
+    def batch(self):
+        '''
+        Time the enclosed block as one batch.  Set rows on the yielded
+        object to the number of rows handled
+        '''
+        self._start()
+        b = _Batch()
+        t0 = perf_counter()
+        try:
+            yield b
+        finally:
+            self.update(b.rows, perf_counter() - t0)
+
+    def timed(self, iterable):
+        '''
+        Yield items of iterable (row lists or RecordBatches), timing each
+        from when it is handed out until the next is asked for, so a
+        batch's time includes its processing by the caller
+        '''
+        self._start()
+        it = iter(iterable)
+        t0 = perf_counter()
+        while True:
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            yield item
+            t1 = perf_counter()
+            rows = item.num_rows if hasattr(item, 'num_rows') else len(item)
+            self.update(rows, t1 - t0)
+            t0 = t1
+
+    def summary(self):
+        '''
+        dict of batches and rows handled, overall rows/s and the sizes used
+        '''
+        return {'batches' : self.n_batches, 'rows' : self.n_rows,
+                'rows_per_s' : round(self.n_rows / self.seconds, 1) if self.seconds > 0 else None,
+                'size' : self._size, 'min_size' : min(self.sizes),
+                'max_size' : max(self.sizes)}
+
+class _Batch:
+    rows = 0
+
+def as_sizer(chunksize, **kwds):
+    '''
+    Return a BatchSizer for chunksize: an int gives a fixed size, 'auto'
+    an adaptive sizer (kwds are passed to BatchSizer), and a BatchSizer
+    is returned as is
+    '''
+    if isinstance(chunksize, BatchSizer):
+        return chunksize
+    if chunksize == AUTO:
+        return BatchSizer(**kwds)
+    return BatchSizer(initial=int(chunksize), adaptive=False)
+
+def chunksize_arg(value):
+    '''
+    argparse type for --chunksize: a positive int or 'auto'
+    '''
+    if value == AUTO:
+        return value
+    n = int(value)
+    if n <= 0:
+        raise ValueError('chunksize must be positive')
+    return n
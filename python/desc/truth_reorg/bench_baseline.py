@@ -0,0 +1,304 @@
+'''
+Local store of benchmark baselines, and comparison of new benchmark
+results with them, so that a change which undoes an earlier speedup (or
+grows memory use) is caught.
+
+The store is one json file:
+
+    {"format_version" : 1,
+     "machines" : {<fingerprint key> :
+                     {"machine" : {...},
+                      "versions" : [{"version" : 1, "created" : ...,
+                                     "label" : ..., "commit" : ...,
+                                     "environment" : {...},
+                                     "stages" : {<stage>@<scale> :
+                                                   {"rows" : n,
+                                                    "wall_s" : [...],
+                                                    "peak_rss_mbyte" : [...]}}},
+                                    ...]}}}
+
+Baselines are kept per machine fingerprint (cpu model and count, memory,
+OS, architecture, python version; not host name, so identical nodes
+share them) since timings from different hardware are not comparable.
+Saving never overwrites: each save appends a new version, and
+comparison is with the latest version unless another is requested.
+
+A stage is a time regression if its median wall time exceeds the
+baseline median by more than rel_tol (fractional) AND by more than
+n_sigma times the combined noise, estimated from the scaled median
+absolute deviation of the repeated samples.  With a single sample on
+either side only the relative test applies.  Peak memory is compared
+in the same way using mem_tol, with an absolute floor of
+mem_floor_mbyte so that allocator jitter on small runs is ignored.
+'''
+import os
+import sys
+import json
+import socket
+import hashlib
+import platform
+import subprocess
+from datetime import datetime
+import numpy as np
+
+__all__ = ['FORMAT_VERSION', 'UNGATED', 'machine_fingerprint',
+           'environment_versions', 'stage_key', 'BaselineStore',
+           'compare_stage', 'compare_results', 'format_report']
+
+FORMAT_VERSION = 1
+
+# compare_results statuses of stages which could not be checked
+UNGATED = ('new', 'missing', 'unbaselined')
+
+# Scale factor making the median absolute deviation a consistent
+# estimator of the standard deviation for normal samples
+_MAD_SCALE = 1.4826
+
+def _cpu_model():
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or platform.machine()
+
+def _memory_gbyte():
+    try:
+        total = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+    return round(total / 1024**3, 1)
+
+def machine_fingerprint():
+    '''
+    Return (key, dict) describing the hardware and platform.  key is a
+    short hash of the dict
+    '''
+    machine = {'cpu_model' : _cpu_model(), 'cpu_count' : os.cpu_count(),
+               'memory_gbyte' : _memory_gbyte(),
+               'system' : platform.system(), 'release' : platform.release(),
+               'arch' : platform.machine(),
+               'python' : '.'.join(platform.python_version_tuple()[:2])}
+    key = hashlib.sha1(json.dumps(machine, sort_keys=True).encode())
+    return key.hexdigest()[:12], machine
+
+def environment_versions():
+    '''
+    Versions of software which affect performance but do not define the
+    machine; recorded with each baseline and reported when they differ
+    '''
+    versions = {'python' : platform.python_version()}
+    for mod in ('numpy', 'pyarrow', 'pandas', 'healpy'):
+        try:
+            versions[mod] = __import__(mod).__version__
+        except ImportError:
+            pass
+    return versions
+
+def _commit():
+    '''
+    Commit of the checkout holding this package, or None
+    '''
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                             cwd=os.path.dirname(os.path.abspath(__file__)),
+                             capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return out.stdout.strip() or None
+
+def stage_key(result):
+    return f'{result["stage"]}@{result["scale"]}'
+
+def _stages_from_results(results):
+    '''
+    Reduce benchmark_pipeline result dicts to what the store keeps.
+    Only stages which ran successfully are kept
+    '''
+    stages = {}
+    for res in results:
+        if res.get('status') != 'ok':
+            continue
+        stages[stage_key(res)] = {
+            'rows' : res.get('rows'),
+            'wall_s' : list(res.get('wall_s_samples', [res['wall_s']])),
+            'peak_rss_mbyte' : list(res.get('peak_rss_samples',
+                                            [res.get('peak_rss_mbyte')]))}
+    return stages
+
+class BaselineStore:
+    '''
+    Parameters
+    ----------
+    path    string   json file; need not exist yet
+    '''
+    def __init__(self, path):
+        self._path = path
+        if os.path.exists(path):
+            with open(path) as f:
+                self._content = json.load(f)
+            version = self._content.get('format_version')
+            if version != FORMAT_VERSION:
+                raise ValueError(f'{path}: baseline format {version}, expected {FORMAT_VERSION}')
+        else:
+            self._content = {'format_version' : FORMAT_VERSION, 'machines' : {}}
+
+    @property
+    def path(self):
+        return self._path
+
+    def versions(self, key=None):
+        '''
+        Versions stored for machine key (default this machine)
+        '''
+        key = key or machine_fingerprint()[0]
+        return self._content['machines'].get(key, {}).get('versions', [])
+
+    def baseline(self, key=None, version=None):
+        '''
+        Return the stored version (latest if version is None) for machine
+        key (default this machine), or None if there is none
+        '''
+        versions = self.versions(key)
+        if not versions:
+            return None
+        if version is None:
+            return versions[-1]
+        for v in versions:
+            if v['version'] == version:
+                return v
+        raise KeyError(f'No baseline version {version} for this machine')
+
+    def add(self, results, label=None):
+        '''
+        Record benchmark results as a new baseline version for this
+        machine.  Return the version number.  Call save() to write
+        '''
+        key, machine = machine_fingerprint()
+        entry = self._content['machines'].setdefault(
+            key, {'machine' : machine, 'versions' : []})
+        versions = entry['versions']
+        number = versions[-1]['version'] + 1 if versions else 1
+        versions.append({'version' : number,
+                         'created' : datetime.now().isoformat(timespec='seconds'),
+                         'host' : socket.gethostname(), 'label' : label,
+                         'commit' : _commit(),
+                         'environment' : environment_versions(),
+                         'stages' : _stages_from_results(results)})
+        return number
+
+    def save(self):
+        dirname = os.path.dirname(os.path.abspath(self._path))
+        os.makedirs(dirname, exist_ok=True)
+        tmp = f'{self._path}.tmp.{os.getpid()}'
+        with open(tmp, 'w') as f:
+            json.dump(self._content, f, indent=2)
+        os.replace(tmp, self._path)
+
+def _noise(samples):
+    samples = np.asarray(samples, dtype=np.float64)
+    if len(samples) < 2:
+        return 0.0
+    return _MAD_SCALE * float(np.median(np.abs(samples - np.median(samples))))
+
+def _judge(base, new, rel_tol, n_sigma, floor=0.0):
+    '''
+    Return (status, baseline median, new median, fractional change)
+    '''
+    base = [x for x in base if x is not None]
+    new = [x for x in new if x is not None]
+    if not base or not new:
+        return 'unmeasured', None, None, None
+    m0 = float(np.median(base))
+    m1 = float(np.median(new))
+    change = (m1 - m0) / m0 if m0 > 0 else 0.0
+    margin = max(n_sigma * np.hypot(_noise(base), _noise(new)), floor)
+    if change > rel_tol and m1 - m0 > margin:
+        status = 'regression'
+    elif change < -rel_tol and m0 - m1 > margin:
+        status = 'improved'
+    else:
+        status = 'ok'
+    return status, m0, m1, change
+
+def compare_stage(base, new, rel_tol=0.10, mem_tol=0.15, n_sigma=3.0,
+                  mem_floor_mbyte=20.0):
+    '''
+    Compare one stage.  base and new are dicts as stored (lists of
+    wall_s and peak_rss_mbyte samples).  Return dict of the outcome
+    '''
+    t_status, t0, t1, t_change = _judge(base['wall_s'], new['wall_s'],
+                                        rel_tol, n_sigma)
+    m_status, m0, m1, m_change = _judge(base['peak_rss_mbyte'],
+                                        new['peak_rss_mbyte'], mem_tol,
+                                        n_sigma, floor=mem_floor_mbyte)
+    if 'regression' in (t_status, m_status):
+        status = 'regression'
+    elif 'improved' in (t_status, m_status):
+        status = 'improved'
+    else:
+        status = 'ok'
+    return {'status' : status,
+            'time' : {'status' : t_status, 'baseline_s' : t0, 'new_s' : t1,
+                      'change' : t_change, 'n_baseline' : len(base['wall_s']),
+                      'n_new' : len(new['wall_s'])},
+            'memory' : {'status' : m_status, 'baseline_mbyte' : m0,
+                        'new_mbyte' : m1, 'change' : m_change}}
+
+def compare_results(results, baseline, **tolerances):
+    '''
+    Compare benchmark_pipeline results with a stored baseline version.
+    Return dict stage key -> outcome.  Stages absent from the baseline
+    are 'new'; baseline stages which did not run ok are 'missing'; stages
+    which neither ran ok nor are in the baseline are 'unbaselined'
+    '''
+    stages = _stages_from_results(results)
+    outcome = {}
+    for (key, new) in stages.items():
+        base = baseline['stages'].get(key)
+        if base is None:
+            outcome[key] = {'status' : 'new'}
+        else:
+            outcome[key] = compare_stage(base, new, **tolerances)
+    for res in results:
+        key = stage_key(res)
+        if key not in stages:
+            status = 'missing' if key in baseline['stages'] else 'unbaselined'
+            outcome[key] = {'status' : status,
+                            'reason' : res.get('reason', res.get('status'))}
+    return outcome
+
+def _pct(change):
+    return '' if change is None else f'{100 * change:+.1f}%'
+
+def format_report(outcome, baseline, file=sys.stdout):
+    '''
+    Print one line per stage, then differences in software versions
+    '''
+    print(f'Compared with baseline version {baseline["version"]} '
+          f'({baseline["created"]}, commit {baseline.get("commit")}, '
+          f'label {baseline.get("label")})', file=file)
+    for key in sorted(outcome):
+        res = outcome[key]
+        line = f'  {res["status"]:<11} {key:<28}'
+        if 'time' in res:
+            t = res['time']
+            m = res['memory']
+            if t['new_s'] is not None:
+                line += (f' time {t["baseline_s"]:.3f}s -> {t["new_s"]:.3f}s'
+                         f' {_pct(t["change"]):>8}')
+            if m['new_mbyte'] is not None:
+                line += (f'  rss {m["baseline_mbyte"]:.0f} -> '
+                         f'{m["new_mbyte"]:.0f} MB {_pct(m["change"]):>8}')
+        elif 'reason' in res:
+            line += f' ({res["reason"]})'
+        print(line, file=file)
+    now = environment_versions()
+    old = baseline.get('environment', {})
+    changed = [f'{k} {old.get(k)} -> {now.get(k)}'
+               for k in sorted(set(now) | set(old)) if old.get(k) != now.get(k)]
+    if changed:
+        print('  software differs from baseline: ' + ', '.join(changed),
+              file=file)
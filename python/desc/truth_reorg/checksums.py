@@ -0,0 +1,355 @@
+'''
+Order-independent content checksums, computed by the writers as they
+write each chunk, so that two artifacts (sqlite or parquet, written in
+any row order or number of pieces) can be checked for identical content
+by comparing small metadata records rather than re-reading both.
+
+For each column the checksum is the row count, the null count and the
+sum, modulo 2**64, of a 64-bit hash of every non-null value.  A sum is
+commutative, so row order and chunking don't matter, and the checksums
+of shards may simply be added (merge).  Values are hashed as the type
+the column has in the output schema (e.g. float32 for sqlite FLOAT), so
+an sqlite table and its parquet conversion agree.  Numbers are hashed
+from their bit pattern (-0.0 as 0.0, one NaN) with the splitmix64
+finalizer; strings 8 bytes at a time with the same mixer, each distinct
+value of a chunk only once.
+
+Checksums are stored
+    parquet   as json in the file key-value metadata, key CHECKSUM_KEY
+    sqlite    in table _checksums, one row per (table, column)
+    other     (e.g. Arrow IPC) in a sidecar file <path>.checksum.json
+'''
+import os
+import json
+import sqlite3
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+__all__ = ['ColumnChecksums', 'write_checksums', 'read_checksums',
+           'compute_checksums', 'compare_checksums', 'CHECKSUM_KEY',
+           'CHECKSUM_TABLE']
+
+CHECKSUM_KEY = 'truth_reorg.checksums'
+CHECKSUM_TABLE = '_checksums'
+_SIDECAR_SUFFIX = '.checksum.json'
+_SQLITE_SUFFIXES = ('.db', '.sqlite', '.sqlite3')
+
+_M1 = np.uint64(0xbf58476d1ce4e5b9)
+_M2 = np.uint64(0x94d049bb133111eb)
+_GOLDEN = np.uint64(0x9e3779b97f4a7c15)
+
+def _mix(x):
+    '''
+    splitmix64 finalizer, elementwise on a uint64 array
+    '''
+    with np.errstate(over='ignore'):
+        x = x + _GOLDEN
+        x = (x ^ (x >> np.uint64(30))) * _M1
+        x = (x ^ (x >> np.uint64(27))) * _M2
+        return x ^ (x >> np.uint64(31))
+
+def _hash_numbers(values):
+    '''
+    values: numpy array without nulls.  Returns uint64 hashes
+    '''
+    if values.dtype.kind == 'f':
+        # 0.0 + -0.0 is 0.0; all NaNs hash alike
+        values = values + values.dtype.type(0.0)
+        nan = np.isnan(values)
+        if nan.any():
+            values = np.where(nan, values.dtype.type(np.nan), values)
+        bits = values.view(np.uint32 if values.dtype.itemsize == 4 else np.uint64)
+        return _mix(bits.astype(np.uint64))
+    if values.dtype.kind == 'b':
+        values = values.astype(np.int64)
+    return _mix(values.astype(np.int64).view(np.uint64))
+
+def _hash_distinct_strings(arr):
+    '''
+    arr: pyarrow string array without nulls.  Hash of each element
+    '''
+    n = len(arr)
+    if n == 0:
+        return np.zeros(0, dtype=np.uint64)
+    arr = pc.cast(arr, pa.string())
+    bufs = arr.buffers()
+    offsets = np.frombuffer(bufs[1], dtype=np.int32)[arr.offset : arr.offset + n + 1]
+    data = np.frombuffer(bufs[2], dtype=np.uint8) if bufs[2] is not None else np.zeros(0, dtype=np.uint8)
+    lengths = np.diff(offsets).astype(np.int64)
+    width = max(8, int(-(-lengths.max() // 8) * 8))
+    pos = offsets[:-1, None].astype(np.int64) + np.arange(width)
+    inside = np.arange(width) < lengths[:, None]
+    padded = np.zeros((n, width), dtype=np.uint8)
+    if len(data):
+        padded[inside] = data[pos[inside]]
+    words = padded.view('<u8')
+    h = _mix(lengths.view(np.uint64))
+    # Rounds depend on each string's own length, not the widest in the
+    # batch, so a value hashes the same whatever it is batched with
+    for k in range(words.shape[1]):
+        h = np.where(k * 8 < lengths, _mix(h ^ words[:, k]), h)
+    return h
+
+def _hash_column(col):
+    '''
+    Return (sum of value hashes mod 2**64 as python int, null count) for
+    a pyarrow Array or ChunkedArray
+    '''
+    if isinstance(col, pa.ChunkedArray):
+        col = col.combine_chunks()
+    if pa.types.is_dictionary(col.type):
+        col = col.dictionary_decode()
+    nulls = col.null_count
+    if nulls:
+        col = col.drop_null()
+    if len(col) == 0:
+        return 0, nulls
+    if pa.types.is_string(col.type) or pa.types.is_large_string(col.type):
+        enc = pc.dictionary_encode(col)
+        h = _hash_distinct_strings(enc.dictionary)
+        h = h[enc.indices.to_numpy(zero_copy_only=False)]
+    else:
+        h = _hash_numbers(col.to_numpy(zero_copy_only=False))
+    with np.errstate(over='ignore'):
+        total = int(h.sum(dtype=np.uint64))
+    return total, nulls
+
+class ColumnChecksums:
+    '''
+    Running checksums for a table being written.
+
+    Parameters
+    ----------
+    schema   pyarrow schema of the output.  Data passed to update are
+             cast to it before hashing
+    '''
+    def __init__(self, schema):
+        self.schema = schema
+        self.rows = 0
+        self._hash = {f.name : 0 for f in schema}
+        self._nulls = {f.name : 0 for f in schema}
+
+    @staticmethod
+    def for_columns(columns):
+        '''
+        columns: list of (name, sqlite type) as used with
+        assemble_create_table
+        '''
+        from desc.truth_reorg.parquet_utils import arrow_schema
+
+        return ColumnChecksums(arrow_schema(columns))
+
+    def update(self, data):
+        '''
+        Add a RecordBatch or Table with (at least) the schema's columns
+        '''
+        if data.num_rows == 0:
+            return
+        for f in self.schema:
+            col = data.column(f.name)
+            if col.type != f.type:
+                col = pc.cast(col, f.type)
+            h, nulls = _hash_column(col)
+            self._hash[f.name] = (self._hash[f.name] + h) % (1 << 64)
+            self._nulls[f.name] += nulls
+        self.rows += data.num_rows
+
+    def update_rows(self, rows):
+        '''
+        Add a list of row tuples with values in schema order
+        '''
+        if len(rows) == 0:
+            return
+        from desc.truth_reorg.parquet_utils import rows_to_batch
+
+        self.update(rows_to_batch(rows, self.schema))
+
+    def merge(self, other):
+        '''
+        Add the checksums of another part (e.g. a shard) of the same table
+        '''
+        for name in self._hash:
+            self._hash[name] = (self._hash[name] + other._hash[name]) % (1 << 64)
+            self._nulls[name] += other._nulls[name]
+        self.rows += other.rows
+        return self
+
+    def as_dict(self):
+        return {'rows' : self.rows,
+                'columns' : {f.name : {'type' : str(f.type),
+                                       'hash' : f'{self._hash[f.name]:016x}',
+                                       'nulls' : self._nulls[f.name]}
+                             for f in self.schema}}
+
+    @staticmethod
+    def from_dict(d):
+        from desc.truth_reorg.parquet_utils import _TYPE_PA
+
+        type_pa = dict(_TYPE_PA)
+        type_pa.update({'float' : pa.float32(), 'double' : pa.float64(),
+                        'bool' : pa.bool_()})
+        schema = pa.schema([(k, type_pa[v['type']])
+                            for (k, v) in d['columns'].items()])
+        out = ColumnChecksums(schema)
+        out.rows = d['rows']
+        for (k, v) in d['columns'].items():
+            out._hash[k] = int(v['hash'], 16)
+            out._nulls[k] = v['nulls']
+        return out
+
+def _kind(path):
+    if path.endswith('.parquet'):
+        return 'parquet'
+    if path.endswith(_SQLITE_SUFFIXES):
+        return 'sqlite'
+    return 'other'
+
+def write_checksums(path, checks, table=None, writer=None, conn=None):
+    '''
+    Store checks for the output at path.  For parquet pass the open
+    ParquetWriter (before closing it); for sqlite the table name and
+    optionally an open connection
+    '''
+    kind = _kind(path)
+    if kind == 'parquet':
+        if writer is None:
+            raise ValueError('Need the open ParquetWriter to add metadata')
+        writer.add_key_value_metadata({CHECKSUM_KEY : json.dumps(checks.as_dict())})
+    elif kind == 'sqlite':
+        if table is None:
+            raise ValueError('Need table name for sqlite checksums')
+        own = conn is None
+        if own:
+            conn = sqlite3.connect(path)
+        d = checks.as_dict()
+        conn.execute(f'''create table if not exists {CHECKSUM_TABLE}
+            (table_name TEXT, column_name TEXT, type TEXT, hash TEXT,
+             nulls BIGINT, rows BIGINT)''')
+        conn.execute(f'delete from {CHECKSUM_TABLE} where table_name=?', (table,))
+        conn.executemany(f'insert into {CHECKSUM_TABLE} VALUES (?,?,?,?,?,?)',
+                         [(table, k, v['type'], v['hash'], v['nulls'], d['rows'])
+                          for (k, v) in d['columns'].items()])
+        conn.commit()
+        if own:
+            conn.close()
+    else:
+        with open(path + _SIDECAR_SUFFIX, 'w') as f:
+            json.dump(checks.as_dict(), f, indent=2)
+
+def read_checksums(path, table=None):
+    '''
+    Return stored ColumnChecksums for path (and table, for sqlite), or
+    None if there are none
+    '''
+    kind = _kind(path)
+    if kind == 'parquet':
+        import pyarrow.parquet as pq
+
+        meta = pq.ParquetFile(path).metadata.metadata or {}
+        raw = meta.get(CHECKSUM_KEY.encode())
+        return ColumnChecksums.from_dict(json.loads(raw)) if raw else None
+    if kind == 'sqlite':
+        from desc.truth_reorg.truth_reorg_utils import connect_read
+
+        with connect_read(path) as conn:
+            if conn.execute("select count(*) from sqlite_master where name=?",
+                            (CHECKSUM_TABLE,)).fetchone()[0] == 0:
+                return None
+            rows = conn.execute(f'''select column_name, type, hash, nulls, rows
+                from {CHECKSUM_TABLE} where table_name=? order by rowid''',
+                                (table,)).fetchall()
+        if len(rows) == 0:
+            return None
+        return ColumnChecksums.from_dict(
+            {'rows' : rows[0][4],
+             'columns' : {r[0] : {'type' : r[1], 'hash' : r[2], 'nulls' : r[3]}
+                          for r in rows}})
+    sidecar = path + _SIDECAR_SUFFIX
+    if not os.path.exists(sidecar):
+        return None
+    with open(sidecar) as f:
+        return ColumnChecksums.from_dict(json.load(f))
+
+def compute_checksums(path, table=None, batch_rows=500000):
+    '''
+    Checksums by a full scan, for artifacts written without them.
+    sqlite columns are typed as by convert_sqlite_to_parquet
+    '''
+    kind = _kind(path)
+    if kind == 'parquet':
+        import pyarrow.parquet as pq
+
+        f = pq.ParquetFile(path)
+        checks = ColumnChecksums(f.schema_arrow)
+        for batch in f.iter_batches(batch_size=batch_rows):
+            checks.update(batch)
+        return checks
+    if kind == 'sqlite':
+        from desc.truth_reorg.truth_reorg_utils import connect_read
+        from desc.truth_reorg.parquet_utils import _table_schema
+        from desc.truth_reorg.sqlite_arrow import SqliteArrowReader
+
+        with connect_read(path) as conn:
+            _, schema = _table_schema(conn.cursor(), table, path)
+        checks = ColumnChecksums(schema)
+        with SqliteArrowReader(path) as reader:
+            for batch in reader.batches(f'select * from {table}', schema=schema,
+                                        batch_rows=batch_rows):
+                checks.update(batch)
+        return checks
+    reader = pa.ipc.open_file(pa.memory_map(path, 'r'))
+    checks = ColumnChecksums(reader.schema)
+    for i in range(reader.num_record_batches):
+        checks.update(reader.get_batch(i))
+    return checks
+
+def compare_checksums(a, b):
+    '''
+    Compare two ColumnChecksums.  Columns present in only one are
+    reported but don't count as mismatches
+
+    Returns
+    -------
+    dict with ok, row counts and lists of mismatched and unmatched columns
+    '''
+    da = a.as_dict()
+    db = b.as_dict()
+    ca = da['columns']
+    cb = db['columns']
+    common = [k for k in ca if k in cb]
+    # Types aren't compared: integers hash alike at any width, and floats
+    # of different widths hash differently anyway
+    mismatched = [k for k in common
+                  if (ca[k]['hash'], ca[k]['nulls']) !=
+                     (cb[k]['hash'], cb[k]['nulls'])]
+    unmatched = [k for k in ca if k not in cb] + [k for k in cb if k not in ca]
+    return {'ok' : da['rows'] == db['rows'] and not mismatched,
+            'rows' : (da['rows'], db['rows']), 'mismatched' : mismatched,
+            'unmatched' : unmatched}
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Compare content checksums of two sqlite or parquet artifacts')
+    parser.add_argument('path_a')
+    parser.add_argument('path_b')
+    parser.add_argument('--table-a', default=None, help='table, if path_a is sqlite')
+    parser.add_argument('--table-b', default=None, help='table, if path_b is sqlite; defaults to --table-a')
+    parser.add_argument('--compute', action='store_true',
+                        help='scan files which have no stored checksums')
+
+    args = parser.parse_args()
+    table_b = args.table_b or args.table_a
+    checks = []
+    for (p, t) in ((args.path_a, args.table_a), (args.path_b, table_b)):
+        c = read_checksums(p, table=t)
+        if c is None:
+            if not args.compute:
+                raise SystemExit(f'{p} has no stored checksums; use --compute')
+            c = compute_checksums(p, table=t)
+        checks.append(c)
+    res = compare_checksums(*checks)
+    print(res)
+    if not res['ok']:
+        raise SystemExit(1)
@@ -0,0 +1,210 @@
+'''
+Multi-resolution HEALPix coverage map (MOC style) of a convex spherical
+polygon, so that points can be classified by a vectorized pixel lookup
+and only those in pixels crossed by the polygon edge need the exact test.
+
+Pixels are classified from order 0 down, in the nested scheme.  A pixel
+is inside if a circle bounding it lies on the inner side of every edge
+(great circle) of the polygon, outside if the circle lies beyond any one
+edge, and otherwise split into its 4 children at the next order.  Pixels
+left undecided at max_order are boundary.  Bounding circles are
+conservative, so inside and outside are exact; a few pixels near the
+corners may be called boundary although entirely outside.
+
+The map is stored as sorted, merged ranges of max_order pixel ids, and
+cached on disk keyed by the polygon corners and max_order.  Requires
+healpy.
+'''
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+
+__all__ = ['Coverage', 'coverage_cache_dir', 'OUTSIDE', 'INSIDE', 'BOUNDARY']
+
+OUTSIDE = 0
+INSIDE = 1
+BOUNDARY = 2
+
+# Bump if the map layout or classification changes, to invalidate caches
+_VERSION = 1
+# healpy.max_pixrad is center-to-corner; pad it since edges are curved
+_RADIUS_PAD = 1.1
+
+def coverage_cache_dir():
+    '''
+    Default directory for cached maps: $SCRATCH/desc/truth/coverage, or
+    under the system temp directory if SCRATCH is not set
+    '''
+    base = os.getenv('SCRATCH') or tempfile.gettempdir()
+    return os.path.join(base, 'desc/truth/coverage')
+
+def _unit_vectors(ra, dec):
+    ra = np.radians(np.asarray(ra, dtype=np.float64))
+    dec = np.radians(np.asarray(dec, dtype=np.float64))
+    cos_dec = np.cos(dec)
+    return np.stack([cos_dec * np.cos(ra), cos_dec * np.sin(ra),
+                     np.sin(dec)], axis=-1)
+
+def _edge_normals(corners):
+    '''
+    corners: (ra, dec) degrees of a convex polygon, in any order.
+    Return unit normals of the edges' great circles, pointing inward
+    '''
+    v = _unit_vectors([c[0] for c in corners], [c[1] for c in corners])
+    center = v.mean(axis=0)
+    center /= np.linalg.norm(center)
+    # Order vertices by position angle about the center
+    east = np.cross([0.0, 0.0, 1.0], center)
+    if np.linalg.norm(east) < 1.0e-12:
+        east = np.array([1.0, 0.0, 0.0])
+    east /= np.linalg.norm(east)
+    north = np.cross(center, east)
+    v = v[np.argsort(np.arctan2(v @ north, v @ east))]
+    normals = np.cross(v, np.roll(v, -1, axis=0))
+    normals /= np.linalg.norm(normals, axis=1)[:, None]
+    normals[normals @ center < 0] *= -1.0
+    return normals
+
+def _merge_ranges(lo, hi):
+    '''
+    Sort ranges [lo, hi) and merge those which touch
+    '''
+    if len(lo) == 0:
+        return lo, hi
+    order = np.argsort(lo)
+    lo = lo[order]
+    hi = hi[order]
+    # A range starts a new run unless it begins where the previous ended
+    starts = np.concatenate([[True], lo[1:] != hi[:-1]])
+    ends = np.concatenate([starts[1:], [True]])
+    return lo[starts], hi[ends]
+
+class Coverage:
+    '''
+    Parameters
+    ----------
+    corners    list  (ra, dec) in degrees of the vertices of a convex
+                     polygon, e.g. Region.region_corners
+    max_order  int   deepest HEALPix order (nside 2**max_order); order 12
+                     pixels are about 0.86 arcmin across
+    '''
+    def __init__(self, corners, max_order=12, _arrays=None):
+        self.corners = [tuple(float(x) for x in c) for c in corners]
+        self.max_order = int(max_order)
+        self.nside = 1 << self.max_order
+        if _arrays is None:
+            _arrays = self._build()
+        (self._inside_lo, self._inside_hi,
+         self._boundary_lo, self._boundary_hi, self.n_pixels) = _arrays
+        # One sorted table of both kinds of range, so a lookup is a single
+        # searchsorted
+        lo = np.concatenate([self._inside_lo, self._boundary_lo])
+        order = np.argsort(lo, kind='stable')
+        self._lo = lo[order]
+        self._hi = np.concatenate([self._inside_hi, self._boundary_hi])[order]
+        self._code = np.concatenate(
+            [np.full(len(self._inside_lo), INSIDE, dtype=np.uint8),
+             np.full(len(self._boundary_lo), BOUNDARY, dtype=np.uint8)])[order]
+
+    def _build(self):
+        import healpy
+
+        normals = _edge_normals(self.corners)
+        inside = []
+        boundary = np.zeros(0, dtype=np.int64)
+        n_pixels = []
+        pix = np.arange(12, dtype=np.int64)
+        for order in range(self.max_order + 1):
+            n_pixels.append(len(pix))
+            if len(pix) == 0:
+                break
+            nside = 1 << order
+            centers = np.stack(healpy.pix2vec(nside, pix, nest=True), axis=-1)
+            radius = min(_RADIUS_PAD * healpy.max_pixrad(nside), np.pi / 2)
+            d = centers @ normals.T
+            is_in = (d >= np.sin(radius)).all(axis=1)
+            is_out = (d < -np.sin(radius)).any(axis=1)
+            shift = 2 * (self.max_order - order)
+            inside.append((pix[is_in] << shift, (pix[is_in] + 1) << shift))
+            rest = pix[~is_in & ~is_out]
+            if order == self.max_order:
+                boundary = rest
+            else:
+                pix = (rest[:, None] * 4 + np.arange(4)).ravel()
+        inside_lo, inside_hi = _merge_ranges(
+            np.concatenate([r[0] for r in inside]),
+            np.concatenate([r[1] for r in inside]))
+        boundary_lo, boundary_hi = _merge_ranges(boundary, boundary + 1)
+        return (inside_lo, inside_hi, boundary_lo, boundary_hi,
+                np.array(n_pixels, dtype=np.int64))
+
+    @staticmethod
+    def _key(corners, max_order):
+        spec = {'corners' : [[round(float(x), 9) for x in c] for c in corners],
+                'max_order' : int(max_order), 'version' : _VERSION}
+        return hashlib.sha1(json.dumps(spec).encode()).hexdigest()[:16]
+
+    @staticmethod
+    def cached(corners, max_order=12, cache_dir=None):
+        '''
+        Coverage for corners from the cache in cache_dir (default
+        coverage_cache_dir()), building and saving it if absent
+        '''
+        cache_dir = cache_dir or coverage_cache_dir()
+        path = os.path.join(cache_dir,
+                            f'coverage_{Coverage._key(corners, max_order)}.npz')
+        if os.path.exists(path):
+            with np.load(path) as f:
+                return Coverage(corners, max_order,
+                                _arrays=(f['inside_lo'], f['inside_hi'],
+                                         f['boundary_lo'], f['boundary_hi'],
+                                         f['n_pixels']))
+        cov = Coverage(corners, max_order)
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = f'{path}.tmp.{os.getpid()}'
+        with open(tmp, 'wb') as f:
+            np.savez(f, inside_lo=cov._inside_lo, inside_hi=cov._inside_hi,
+                     boundary_lo=cov._boundary_lo,
+                     boundary_hi=cov._boundary_hi, n_pixels=cov.n_pixels,
+                     corners=np.array(cov.corners))
+        os.replace(tmp, path)
+        return cov
+
+    def pixels(self, ra, dec):
+        '''
+        max_order nested pixel ids of points (degrees)
+        '''
+        import healpy
+
+        return healpy.ang2pix(self.nside, np.asarray(ra, dtype=np.float64),
+                              np.asarray(dec, dtype=np.float64),
+                              nest=True, lonlat=True)
+
+    def classify(self, ra, dec):
+        '''
+        For points (degrees) return uint8 array of OUTSIDE, INSIDE or
+        BOUNDARY
+        '''
+        pix = self.pixels(ra, dec)
+        if len(self._lo) == 0:
+            return np.full(len(pix), OUTSIDE, dtype=np.uint8)
+        i = np.maximum(np.searchsorted(self._lo, pix, side='right') - 1, 0)
+        hit = (pix >= self._lo[i]) & (pix < self._hi[i])
+        return np.where(hit, self._code[i], np.uint8(OUTSIDE))
+
+    def summary(self):
+        '''
+        dict of areas (square degrees) inside and on the boundary, and
+        number of pixels examined at each order
+        '''
+        pix_area = 41252.96 / (12 * self.nside**2)
+        n_in = int((self._inside_hi - self._inside_lo).sum())
+        n_bd = int((self._boundary_hi - self._boundary_lo).sum())
+        return {'max_order' : self.max_order,
+                'inside_deg2' : round(n_in * pix_area, 3),
+                'boundary_deg2' : round(n_bd * pix_area, 3),
+                'inside_ranges' : len(self._inside_lo),
+                'boundary_ranges' : len(self._boundary_lo),
+                'pixels_per_order' : self.n_pixels.tolist()}
@@ -0,0 +1,123 @@
+'''
+Read a directory of galaxy truth_summary_hp<pixel>.parquet files (as
+used and written by add_avrv.py) as a single pyarrow dataset, with
+healpix pixel as partition key, column projection and filter pushdown.
+'''
+import os
+import re
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.fs
+import pyarrow.parquet as pq
+
+__all__ = ['TruthSummaryDataset', 'HP_FILE_PATTERN']
+
+HP_FILE_PATTERN = re.compile(r'truth_summary_hp(\d+)\.parquet$')
+
+class TruthSummaryDataset:
+    '''
+    All truth_summary_hp<pixel>.parquet files in a directory as one
+    dataset.  The virtual column "healpix" holds the pixel number from
+    the file name; filtering on it skips files entirely.  Other filters
+    are pushed down to row group statistics where possible.
+
+    Parameters
+    ----------
+    directory   string   directory containing the files
+    pixels      list     if supplied, use only files for these pixels
+    '''
+    def __init__(self, directory, pixels=None):
+        self._directory = directory
+        paths = []
+        hps = []
+        for f in sorted(os.listdir(directory)):
+            m = HP_FILE_PATTERN.match(f)
+            if m is None:
+                continue
+            hp = int(m.group(1))
+            if pixels is not None and hp not in pixels:
+                continue
+            paths.append(os.path.join(directory, f))
+            hps.append(hp)
+        if len(paths) == 0:
+            raise ValueError(f'No truth_summary_hp files found in {directory}')
+        self._pixels = hps
+
+        # Files written before and after add_avrv differ in av, rv columns
+        schema = pa.unify_schemas([pq.read_schema(p) for p in paths])
+        schema = schema.append(pa.field('healpix', pa.int32()))
+        self._dataset = ds.FileSystemDataset.from_paths(
+            paths, schema=schema, format=ds.ParquetFileFormat(),
+            filesystem=pyarrow.fs.LocalFileSystem(),
+            partitions=[ds.field('healpix') == hp for hp in hps])
+
+    @property
+    def dataset(self):
+        return self._dataset
+
+    @property
+    def pixels(self):
+        return list(self._pixels)
+
+    @property
+    def schema(self):
+        return self._dataset.schema
+
+    @staticmethod
+    def make_filter(ra_range=None, dec_range=None, redshift_range=None,
+                    flux_cuts=None, pixels=None):
+        '''
+        Build a dataset filter expression.  Each range is (min, max),
+        inclusive; either end may be None.  flux_cuts is a dict of column
+        name -> (min, max), e.g. {'flux_r' : (100.0, None)}.
+        Returns None if no cuts are requested
+        '''
+        cuts = {}
+        if ra_range is not None:
+            cuts['ra'] = ra_range
+        if dec_range is not None:
+            cuts['dec'] = dec_range
+        if redshift_range is not None:
+            cuts['redshift'] = redshift_range
+        if flux_cuts:
+            cuts.update(flux_cuts)
+
+        expr = None
+        def _and(e, term):
+            return term if e is None else e & term
+        for (col, (lo, hi)) in cuts.items():
+            if lo is not None:
+                expr = _and(expr, ds.field(col) >= lo)
+            if hi is not None:
+                expr = _and(expr, ds.field(col) <= hi)
+        if pixels is not None:
+            expr = _and(expr, ds.field('healpix').isin(list(pixels)))
+        return expr
+
+    def scanner(self, columns=None, filter=None, batch_size=131072,
+                use_threads=True, **cuts):
+        '''
+        Return a pyarrow.dataset.Scanner.  columns restricts which columns
+        are read.  filter is a dataset expression; alternatively supply
+        the keyword arguments of make_filter
+        '''
+        if filter is None and cuts:
+            filter = self.make_filter(**cuts)
+        return self._dataset.scanner(columns=columns, filter=filter,
+                                     batch_size=batch_size,
+                                     use_threads=use_threads)
+
+    def to_batches(self, columns=None, filter=None, **kwargs):
+        '''
+        Stream matching record batches, reading files and row groups
+        in parallel.  Arguments as for scanner
+        '''
+        return self.scanner(columns=columns, filter=filter,
+                            **kwargs).to_batches()
+
+    def to_table(self, columns=None, filter=None, **kwargs):
+        return self.scanner(columns=columns, filter=filter,
+                            **kwargs).to_table()
+
+    def count_rows(self, filter=None, **cuts):
+        return self.scanner(columns=[], filter=filter, **cuts).count_rows()
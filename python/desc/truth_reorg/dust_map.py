@@ -0,0 +1,271 @@
+'''
+Vectorized Milky Way E(B-V) from the SFD (Schlegel, Finkbeiner & Davis
+1998) dust maps, as used by lsst.sims.catUtils.dust.EBVbase but without
+the lsst_sims stack.
+
+The two 4096 x 4096 Lambert zenithal equal-area maps (north and south
+galactic pole) are memory-mapped straight from the FITS files; only the
+pages touched by a query are read.  Equatorial (J2000) -> galactic
+transform and bilinear interpolation are done in numpy over whole
+batches.  SFDDustMap.calculateEbv has the same signature as
+EBVbase.calculateEbv, so it may be passed to oldsim_utils.get_MW_AvRv.
+
+Agreement with EBVbase is checked by compare_with_ebvbase (run this
+module where lsst_sims and sims_maps are set up).  No result is recorded
+yet: neither the real maps nor lsst_sims were available where this was
+written, so run it before relying on dust_engine='sfd' for production
+outputs, and put the maximum relative difference here.
+
+Instances are read-only, so may be shared by threads.  When pickled (e.g.
+sent to a process pool worker) only the file paths are sent; each
+process maps the files itself.
+'''
+import os
+import numpy as np
+
+__all__ = ['SFDDustMap', 'make_ebv_model', 'compare_with_ebvbase',
+           'equatorial_to_galactic']
+
+_NORTH_FILE = 'SFD_dust_4096_ngp.fits'
+_SOUTH_FILE = 'SFD_dust_4096_sgp.fits'
+
+# J2000 equatorial -> IAU 1958 galactic rotation, as in SLALIB/PAL
+# sla_EQGAL (used by EBVbase via palpy)
+_EQ_TO_GAL = np.array([[-0.054875539726, -0.873437108010, -0.483834985808],
+                       [+0.494109453312, -0.444829589425, +0.746982251810],
+                       [-0.867666135858, -0.198076386122, +0.455983795705]])
+
+_FITS_BLOCK = 2880
+_FITS_CARD = 80
+_BITPIX_DTYPE = {8 : '>u1', 16 : '>i2', 32 : '>i4', 64 : '>i8',
+                 -32 : '>f4', -64 : '>f8'}
+
+def _default_map_dir():
+    # eups sets SIMS_MAPS_DIR when sims_maps is set up
+    sims_maps = os.getenv('SIMS_MAPS_DIR')
+    if sims_maps:
+        return os.path.join(sims_maps, 'DustMaps')
+    return None
+
+def _read_fits_header(f):
+    '''
+    Read primary header cards from open binary file f.  Return
+    (dict of keyword -> value, offset of data)
+    '''
+    header = {}
+    n_read = 0
+    while True:
+        block = f.read(_FITS_BLOCK)
+        if len(block) < _FITS_BLOCK:
+            raise ValueError('Truncated FITS header')
+        n_read += _FITS_BLOCK
+        for i in range(0, _FITS_BLOCK, _FITS_CARD):
+            card = block[i : i + _FITS_CARD].decode('ascii')
+            key = card[:8].strip()
+            if key == 'END':
+                return header, n_read
+            if card[8:10] != '= ':
+                continue
+            value = card[10:].split('/')[0].strip()
+            if value.startswith("'"):
+                header[key] = value.strip("'").strip()
+            elif value in ('T', 'F'):
+                header[key] = (value == 'T')
+            else:
+                try:
+                    header[key] = int(value)
+                except ValueError:
+                    header[key] = float(value)
+
+def _map_fits_image(path):
+    '''
+    Return (header, read-only memmap of the primary image)
+    '''
+    with open(path, 'rb') as f:
+        header, offset = _read_fits_header(f)
+    if header.get('NAXIS') != 2:
+        raise ValueError(f'{path}: expected 2-d primary image')
+    if header.get('BSCALE', 1) != 1 or header.get('BZERO', 0) != 0:
+        raise ValueError(f'{path}: scaled images are not supported')
+    data = np.memmap(path, dtype=_BITPIX_DTYPE[header['BITPIX']], mode='r',
+                     offset=offset,
+                     shape=(header['NAXIS2'], header['NAXIS1']))
+    return header, data
+
+def equatorial_to_galactic(ra, dec):
+    '''
+    ra, dec in radians (J2000).  Return galactic longitude, latitude in
+    radians, longitude in [0, 2 pi)
+    '''
+    ra = np.asarray(ra, dtype=np.float64)
+    dec = np.asarray(dec, dtype=np.float64)
+    cos_dec = np.cos(dec)
+    v = np.stack([cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)])
+    g = np.tensordot(_EQ_TO_GAL, v, axes=1)
+    glon = np.mod(np.arctan2(g[1], g[0]), 2 * np.pi)
+    glat = np.arcsin(np.clip(g[2], -1.0, 1.0))
+    return glon, glat
+
+class _PoleMap:
+    '''
+    One hemisphere of the SFD map
+    '''
+    def __init__(self, path):
+        self.path = path
+        hdr, self.data = _map_fits_image(path)
+        self._nsgp = hdr['LAM_NSGP']
+        self._scale = hdr['LAM_SCAL']
+        self._crpix1 = hdr['CRPIX1']
+        self._crpix2 = hdr['CRPIX2']
+        self._ny, self._nx = self.data.shape
+
+    def sky_to_xy(self, glon, glat):
+        '''
+        Zero-based pixel coordinates, following the SFD convention
+        (not FITS WCS)
+        '''
+        r = self._scale * np.sqrt(1.0 - self._nsgp * np.sin(glat))
+        x = self._crpix1 - 1.0 + r * np.cos(glon)
+        y = self._crpix2 - 1.0 - self._nsgp * r * np.sin(glon)
+        return x, y
+
+    def ebv(self, glon, glat, interp=True):
+        x, y = self.sky_to_xy(glon, glat)
+        if not interp:
+            ix = np.clip(np.rint(x).astype(np.int64), 0, self._nx - 1)
+            iy = np.clip(np.rint(y).astype(np.int64), 0, self._ny - 1)
+            return self.data[iy, ix].astype(np.float64)
+
+        x0 = np.clip(np.floor(x).astype(np.int64), 0, self._nx - 2)
+        y0 = np.clip(np.floor(y).astype(np.int64), 0, self._ny - 2)
+        fx = np.clip(x - x0, 0.0, 1.0)
+        fy = np.clip(y - y0, 0.0, 1.0)
+        d = self.data
+        return ((1.0 - fx) * (1.0 - fy) * d[y0, x0] +
+                fx * (1.0 - fy) * d[y0, x0 + 1] +
+                (1.0 - fx) * fy * d[y0 + 1, x0] +
+                fx * fy * d[y0 + 1, x0 + 1])
+
+class SFDDustMap:
+    '''
+    Parameters
+    ----------
+    map_dir     string  directory containing SFD_dust_4096_[ns]gp.fits.
+                        Defaults to $SIMS_MAPS_DIR/DustMaps, where
+                        EBVbase finds them
+    chunk_rows  int     rows handled at once; bounds temporary memory for
+                        arbitrarily large inputs
+    '''
+    def __init__(self, map_dir=None, chunk_rows=1000000):
+        map_dir = map_dir or _default_map_dir()
+        if map_dir is None:
+            raise ValueError('No map_dir given and SIMS_MAPS_DIR is not set')
+        self._map_dir = map_dir
+        self._chunk_rows = chunk_rows
+        self._open()
+
+    def _open(self):
+        self._north = _PoleMap(os.path.join(self._map_dir, _NORTH_FILE))
+        self._south = _PoleMap(os.path.join(self._map_dir, _SOUTH_FILE))
+
+    def __getstate__(self):
+        return {'map_dir' : self._map_dir, 'chunk_rows' : self._chunk_rows}
+
+    def __setstate__(self, state):
+        self._map_dir = state['map_dir']
+        self._chunk_rows = state['chunk_rows']
+        self._open()
+
+    def ebv_galactic(self, glon, glat, interp=True):
+        '''
+        E(B-V) for galactic coordinates in radians
+        '''
+        glon = np.asarray(glon, dtype=np.float64)
+        glat = np.asarray(glat, dtype=np.float64)
+        out = np.empty(glon.shape, dtype=np.float64)
+        # As EBVbase: the galactic plane is looked up in the south map
+        south = glat <= 0.0
+        north = ~south
+        out[north] = self._north.ebv(glon[north], glat[north], interp=interp)
+        out[south] = self._south.ebv(glon[south], glat[south], interp=interp)
+        return out
+
+    def ebv(self, ra, dec, interp=True):
+        '''
+        E(B-V) for J2000 ra, dec in degrees
+        '''
+        ra = np.radians(np.asarray(ra, dtype=np.float64))
+        dec = np.radians(np.asarray(dec, dtype=np.float64))
+        out = np.empty(ra.shape, dtype=np.float64)
+        for lo in range(0, len(ra), self._chunk_rows):
+            hi = lo + self._chunk_rows
+            glon, glat = equatorial_to_galactic(ra[lo:hi], dec[lo:hi])
+            out[lo:hi] = self.ebv_galactic(glon, glat, interp=interp)
+        return out
+
+    def calculateEbv(self, galacticCoordinates=None,
+                     equatorialCoordinates=None, interp=False):
+        '''
+        Drop-in for EBVbase.calculateEbv.  Coordinates are arrays of shape
+        (2, n) in radians
+        '''
+        if galacticCoordinates is not None:
+            return self.ebv_galactic(galacticCoordinates[0],
+                                     galacticCoordinates[1], interp=interp)
+        if equatorialCoordinates is None:
+            raise ValueError('Need galactic or equatorial coordinates')
+        return self.ebv(np.degrees(equatorialCoordinates[0]),
+                        np.degrees(equatorialCoordinates[1]), interp=interp)
+
+def make_ebv_model(engine='ebvbase', map_dir=None):
+    '''
+    Return an object with method calculateEbv, suitable for get_MW_AvRv.
+    engine is 'ebvbase' (requires lsst_sims) or 'sfd' (this module)
+    '''
+    if engine == 'sfd':
+        return SFDDustMap(map_dir=map_dir)
+    if engine == 'ebvbase':
+        from lsst.sims.catUtils.dust import EBVbase
+        return EBVbase()
+    raise ValueError(f'Unknown dust engine {engine}')
+
+def compare_with_ebvbase(n=100000, seed=1234, map_dir=None, interp=True):
+    '''
+    Evaluate both engines at n random points uniform on the sky.  Must be
+    run where lsst_sims is available.
+
+    Returns
+    -------
+    dict with max absolute and relative differences and the 99.9th
+    percentile relative difference (relative to max(ebv, 0.01))
+    '''
+    rng = np.random.default_rng(seed)
+    ra = rng.uniform(0.0, 360.0, n)
+    dec = np.degrees(np.arcsin(rng.uniform(-1.0, 1.0, n)))
+    eq = np.array([np.radians(ra), np.radians(dec)])
+    ours = SFDDustMap(map_dir=map_dir).calculateEbv(equatorialCoordinates=eq,
+                                                    interp=interp)
+    theirs = make_ebv_model('ebvbase').calculateEbv(equatorialCoordinates=eq,
+                                                    interp=interp)
+    diff = np.abs(ours - theirs)
+    rel = diff / np.maximum(np.abs(theirs), 0.01)
+    return {'n' : n, 'max_abs' : float(diff.max()),
+            'max_rel' : float(rel.max()),
+            'p999_rel' : float(np.percentile(rel, 99.9))}
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Check SFDDustMap against EBVbase')
+    parser.add_argument('--map-dir', default=None)
+    parser.add_argument('--n', type=int, default=100000)
+    parser.add_argument('--no-interp', action='store_true')
+    parser.add_argument('--max-rel', type=float, default=1.0e-4,
+                        help='fail if any relative difference exceeds this')
+
+    args = parser.parse_args()
+    res = compare_with_ebvbase(n=args.n, map_dir=args.map_dir,
+                               interp=not args.no_interp)
+    print(res)
+    if res['max_rel'] > args.max_rel:
+        raise SystemExit(1)
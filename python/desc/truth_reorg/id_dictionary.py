@@ -0,0 +1,196 @@
+'''
+Persistent SN id_string <-> int64 id dictionary.
+
+Built once (from truth_sn_summary, or from the trimmed initial table
+using host_galaxy) and stored in a directory as numpy arrays:
+
+    keys.npy      id strings, fixed-width bytes, sorted
+    values.npy    int64 id for each key
+    by_value.npy  permutation of keys ordering values
+    meta.json     source, row count, key width
+
+Arrays are memory-mapped when opened, so the dictionary may be shared by
+processes at no cost.  Lookups are vectorized (searchsorted) over whole
+batches; stages can translate string ids to int64 as they read and do
+joins and aggregation on integers only.  Group on codes (position in
+keys), which are unique per string; int ids computed from host_galaxy
+are not always.
+'''
+import os
+import json
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from desc.truth_reorg.truth_reorg_utils import make_sn_int_ids
+
+__all__ = ['SnIdDictionary']
+
+_KEYS = 'keys.npy'
+_VALUES = 'values.npy'
+_BY_VALUE = 'by_value.npy'
+_META = 'meta.json'
+
+def _to_bytes(strings):
+    '''
+    pyarrow array or python sequence of str (None allowed) -> numpy bytes
+    array, byte lengths and validity.  Converted by pyarrow from the
+    string buffers, with no per-row python code.  Null entries become
+    b'' and are not valid
+    '''
+    if isinstance(strings, pa.ChunkedArray):
+        strings = strings.combine_chunks()
+    elif not isinstance(strings, pa.Array):
+        strings = pa.array(strings, type=pa.string())
+    valid = pc.is_valid(strings).to_numpy(zero_copy_only=False)
+    binary = pc.fill_null(pc.cast(strings, pa.large_binary()), b'')
+    lengths = pc.binary_length(binary).to_numpy(zero_copy_only=False)
+    width = max(1, int(lengths.max())) if len(lengths) else 1
+    arr = binary.to_numpy(zero_copy_only=False).astype(f'S{width}')
+    return arr, lengths, valid
+
+class SnIdDictionary:
+    '''
+    Parameters
+    ----------
+    directory   string  as written by SnIdDictionary.build
+    '''
+    def __init__(self, directory):
+        self._directory = directory
+        self._keys = np.load(os.path.join(directory, _KEYS), mmap_mode='r')
+        self._values = np.load(os.path.join(directory, _VALUES), mmap_mode='r')
+        self._by_value = np.load(os.path.join(directory, _BY_VALUE),
+                                 mmap_mode='r')
+        with open(os.path.join(directory, _META)) as f:
+            self.meta = json.load(f)
+        self._width = self._keys.dtype.itemsize
+        self._sorted_values = None
+
+    def __len__(self):
+        return len(self._keys)
+
+    @staticmethod
+    def build(path, out_dir, table='truth_sn_summary', key='id_string',
+              value='id', host=None):
+        '''
+        Read key and value columns of table in sqlite or parquet file path
+        and write the dictionary to out_dir.  If host is given (e.g.
+        'host_galaxy') int ids are computed from it with make_sn_int_ids
+        instead of being read from column value.
+
+        Returns the opened SnIdDictionary
+        '''
+        from desc.truth_reorg.parquet_utils import read_batches
+
+        columns = [key, host if host else value]
+        keys = []
+        values = []
+        for batch in read_batches(path, columns, table=table):
+            k, _, valid = _to_bytes(batch.column(0))
+            if not valid.all():
+                raise ValueError(f'Null {key} values in {path}')
+            keys.append(k)
+            v = batch.column(1).to_numpy(zero_copy_only=False).astype(np.int64)
+            values.append(make_sn_int_ids(v) if host else v)
+        keys = np.concatenate(keys) if keys else np.zeros(0, dtype='S1')
+        values = np.concatenate(values) if values else np.zeros(0, dtype=np.int64)
+
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        values = values[order]
+        if len(keys) > 1 and np.any(keys[1:] == keys[:-1]):
+            raise ValueError(f'Duplicate {key} values in {path}')
+        by_value = np.argsort(values, kind='stable')
+        # Several SNe may share a host, hence an int id derived from it
+        n_dup = int(np.count_nonzero(values[by_value][1:] == values[by_value][:-1]))
+        if n_dup > 0:
+            print(f'Warning: {n_dup} int ids in {path} are shared by more than one id string')
+
+        os.makedirs(out_dir, exist_ok=True)
+        np.save(os.path.join(out_dir, _KEYS), keys)
+        np.save(os.path.join(out_dir, _VALUES), values)
+        np.save(os.path.join(out_dir, _BY_VALUE), by_value)
+        meta = {'source' : os.path.abspath(path), 'table' : table,
+                'key' : key, 'value' : f'make_sn_int_ids({host})' if host else value,
+                'rows' : int(len(keys)), 'key_width' : keys.dtype.itemsize,
+                'shared_values' : n_dup}
+        with open(os.path.join(out_dir, _META), 'w') as f:
+            json.dump(meta, f, indent=2)
+        return SnIdDictionary(out_dir)
+
+    def codes(self, strings, missing=-1):
+        '''
+        Position of each of a batch of id strings (pyarrow array or
+        sequence of str) in the sorted keys: a dense int64 code, unique
+        per string, for joining and grouping.  Unknown and null ids get
+        missing
+        '''
+        q, lengths, valid = _to_bytes(strings)
+        out = np.full(len(q), missing, dtype=np.int64)
+        if len(self._keys) == 0 or len(q) == 0:
+            return out
+        # Strings longer than the key width can't be present, but would
+        # compare equal to a key after numpy truncates them
+        ok = valid & (lengths <= self._width)
+        q = q.astype(self._keys.dtype)
+        idx = np.searchsorted(self._keys, q)
+        idx = np.minimum(idx, len(self._keys) - 1)
+        found = ok & (self._keys[idx] == q)
+        out[found] = idx[found]
+        return out
+
+    def lookup(self, strings, missing=-1):
+        '''
+        int64 ids for a batch of id strings.  Unknown and null ids get
+        missing.
+        Use codes rather than these to group by SN, since int ids derived
+        from host galaxy need not be unique
+        '''
+        c = self.codes(strings)
+        out = np.full(len(c), missing, dtype=np.int64)
+        found = c >= 0
+        out[found] = self._values[c[found]]
+        return out
+
+    def lookup_arrow(self, strings):
+        '''
+        As lookup, but return a pyarrow int64 array, null where unknown
+        or null
+        '''
+        ids = self.lookup(strings, missing=-1)
+        return pa.array(ids, mask=(ids == -1), type=pa.int64())
+
+    def to_strings(self, ids):
+        '''
+        Inverse lookup.  Returns list of str, None where unknown.  If an
+        int id is shared (see meta['shared_values']) the first id string
+        in sort order is returned
+        '''
+        ids = np.asarray(ids, dtype=np.int64)
+        if self._sorted_values is None:
+            self._sorted_values = self._values[self._by_value]
+        sorted_values = self._sorted_values
+        if len(sorted_values) == 0:
+            return [None] * len(ids)
+        pos = np.minimum(np.searchsorted(sorted_values, ids),
+                         len(sorted_values) - 1)
+        found = sorted_values[pos] == ids
+        keys = self._keys[self._by_value[pos]]
+        return [k.decode() if f else None for (k, f) in zip(keys, found)]
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Build SN id_string -> int id dictionary')
+    parser.add_argument('source', help='sqlite or parquet file with SN ids')
+    parser.add_argument('out_dir')
+    parser.add_argument('--table', default='truth_sn_summary')
+    parser.add_argument('--key', default='id_string')
+    parser.add_argument('--value', default='id')
+    parser.add_argument('--host', default=None,
+                        help='compute int ids from this host galaxy column instead of reading --value')
+
+    args = parser.parse_args()
+    d = SnIdDictionary.build(args.source, args.out_dir, table=args.table,
+                             key=args.key, value=args.value, host=args.host)
+    print(d.meta)
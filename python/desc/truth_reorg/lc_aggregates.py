@@ -0,0 +1,270 @@
+'''
+Per-object, per-band light-curve aggregates from one streaming pass over
+a variability table (sn_variability_truth, stellar_variability_truth or
+the new truth_*_variability tables).
+
+Input rows must be grouped by id.  For sqlite input the query orders by
+id, which sqlite satisfies from the id index without a sort; parquet
+input must already be grouped (e.g. written by
+convert_sqlite_to_parquet_sorted).  An id appearing in more than one run
+is detected only if both runs fall in the same batch.  Each batch is reduced with sorted
+segment reductions (numpy reduceat); rows for the last id in a batch are
+held back and joined to the next batch, so no id is split.
+
+The object identifier is the input column id unless another is named
+(truth_sn_variability carries the SN name as id_string; its int id,
+made from the host galaxy, is not unique).
+
+Output has one row per (id, bandpass):
+    id, bandpass, n_obs, min_delta_flux, max_delta_flux,
+    mean_delta_flux, stdev_delta_flux (population, ddof=0),
+    first_mjd, last_mjd
+Nulls are ignored, as by sqlite's min, max and avg.
+written as parquet if the output name ends in .parquet, else as table
+lc_aggregates in an sqlite file.  LcAggregates reads it back for the SN
+summary writer (max delta_flux per band).  The star summary does not use
+it: its stdev of delta mag is not a function of the stdev of delta_flux
+and comes from the LC stats file.
+'''
+import sqlite3
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from desc.truth_reorg.truth_reorg_utils import assemble_create_table
+from desc.truth_reorg.script_utils import NULL_INSTRUMENT
+from desc.truth_reorg.parquet_utils import read_batches, batch_to_rows
+from desc.truth_reorg.parquet_utils import open_parquet_writer, arrow_schema
+from desc.truth_reorg.parquet_utils import concat_batches, rebatch
+from desc.truth_reorg.batch_sizer import as_sizer, chunksize_arg
+from desc.truth_reorg.checksums import ColumnChecksums, write_checksums
+
+__all__ = ['aggregate_light_curves', 'LcAggregates', 'AGG_TABLE']
+
+AGG_TABLE = 'lc_aggregates'
+
+_STAT_COLUMNS = [('n_obs', 'INT'), ('min_delta_flux', 'FLOAT'),
+                 ('max_delta_flux', 'FLOAT'), ('mean_delta_flux', 'FLOAT'),
+                 ('stdev_delta_flux', 'FLOAT'), ('first_mjd', 'DOUBLE'),
+                 ('last_mjd', 'DOUBLE')]
+
+def _agg_columns(id_sql_type):
+    return [('id', id_sql_type), ('bandpass', 'TEXT')] + _STAT_COLUMNS
+
+def _segment_starts(ids):
+    '''
+    Start index of each run of equal values in pyarrow array ids
+    '''
+    n = len(ids)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+    changed = pc.not_equal(ids.slice(1), ids.slice(0, n - 1))
+    changed = changed.to_numpy(zero_copy_only=False)
+    return np.concatenate([[0], np.flatnonzero(changed) + 1]).astype(np.int64)
+
+def _reduce(batch, schema):
+    '''
+    Aggregates for a batch holding only complete ids.  Returns a
+    RecordBatch with the given output schema.  Null delta_flux and MJD
+    are ignored, as by sqlite's aggregate functions; n_obs counts rows
+    with non-null delta_flux, and statistics of a segment with none are
+    null
+    '''
+    ids = batch.column(0)
+    bands = batch.column(1)
+    pieces = []
+    for band in pc.unique(bands).to_pylist():
+        sel = pc.equal(bands, band)
+        sub_ids = pc.filter(ids, sel)
+        mjd_col = pc.filter(batch.column(2), sel)
+        flux_col = pc.filter(batch.column(3), sel)
+        mjd = pc.fill_null(mjd_col.cast(pa.float64()), np.nan).to_numpy(zero_copy_only=False)
+        flux = pc.fill_null(flux_col.cast(pa.float64()), 0.0).to_numpy(zero_copy_only=False)
+        valid = pc.is_valid(flux_col).to_numpy(zero_copy_only=False)
+        starts = _segment_starts(sub_ids)
+        seg_ids = pc.take(sub_ids, pa.array(starts))
+        if pc.count_distinct(seg_ids).as_py() != len(seg_ids):
+            raise ValueError('Variability input is not grouped by id')
+        rows = np.diff(np.append(starts, len(flux)))
+        n = np.add.reduceat(valid.astype(np.int64), starts)
+        empty = n == 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.add.reduceat(flux, starts) / n
+            dev = np.where(valid, flux - np.repeat(mean, rows), 0.0)
+            stdev = np.sqrt(np.add.reduceat(dev * dev, starts) / n)
+        # fmin/fmax skip NaN, standing in for null
+        masked = np.where(valid, flux, np.nan)
+        arrays = [seg_ids, pa.array(np.full(len(starts), band)),
+                  pa.array(n),
+                  pa.array(np.fmin.reduceat(masked, starts), mask=empty),
+                  pa.array(np.fmax.reduceat(masked, starts), mask=empty),
+                  pa.array(mean, mask=empty), pa.array(stdev, mask=empty),
+                  pa.array(np.fmin.reduceat(mjd, starts), from_pandas=True),
+                  pa.array(np.fmax.reduceat(mjd, starts), from_pandas=True)]
+        pieces.append(pa.RecordBatch.from_arrays(
+            [pc.cast(a, f.type) for (a, f) in zip(arrays, schema)],
+            schema=schema))
+    if len(pieces) == 0:
+        return pa.RecordBatch.from_pylist([], schema=schema)
+    return concat_batches(pieces)
+
+def aggregate_light_curves(var_path, out_path, table=None, chunksize=500000,
+                           id_type='TEXT', id_column='id',
+                           instrument=NULL_INSTRUMENT):
+    '''
+    Parameters
+    ----------
+    var_path    string  sqlite or parquet variability file
+    out_path    string  output; parquet if it ends in .parquet, else sqlite
+    table       string  variability table name (sqlite input only)
+    chunksize   int     rows read per batch, or 'auto' or a BatchSizer
+                        (see batch_sizer)
+    id_type     string  sqlite type for id in the output: 'TEXT' (SN) or
+                        'BIGINT' (stars, whose input ids are numeric TEXT)
+    id_column   string  input column identifying an object; written to
+                        the output as id
+    instrument  Instrument for timing fetch, transform, write
+
+    Returns
+    -------
+    number of (id, bandpass) rows written
+    '''
+    columns = _agg_columns(id_type)
+    schema = arrow_schema(columns)
+    sizer = as_sizer(chunksize)
+    if var_path.endswith('.parquet'):
+        batches = read_batches(var_path,
+                               [id_column, 'bandpass', 'MJD', 'delta_flux'],
+                               batch_rows=sizer.size)
+    else:
+        from desc.truth_reorg.sqlite_arrow import SqliteArrowReader
+
+        reader = SqliteArrowReader(var_path)
+        q = f'select {id_column} as id, bandpass, MJD, delta_flux from {table} order by {id_column}'
+        batches = reader.batches(q, batch_rows=sizer.size)
+    batches = sizer.timed(rebatch(batches, sizer))
+
+    if out_path.endswith('.parquet'):
+        pq_writer = open_parquet_writer(out_path, columns,
+                                        low_cardinality=['bandpass'])
+        out_conn = None
+    else:
+        pq_writer = None
+        out_conn = sqlite3.connect(out_path)
+        out_conn.execute(assemble_create_table(AGG_TABLE, columns))
+        insert = f'insert into {AGG_TABLE} VALUES (' + ','.join(['?'] * len(columns)) + ')'
+
+    checks = ColumnChecksums(schema)
+
+    def _write(out):
+        with instrument.stage('write', rows=out.num_rows):
+            if pq_writer is not None:
+                pq_writer.write_batch(out)
+            else:
+                out_conn.executemany(insert, batch_to_rows(out))
+                out_conn.commit()
+        with instrument.stage('checksum', rows=out.num_rows):
+            checks.update(out)
+
+    id_arrow_type = schema.field('id').type
+    n_written = 0
+    held = None
+    while True:
+        with instrument.stage('fetch') as st:
+            batch = next(batches, None)
+            st.add(rows=batch.num_rows if batch is not None else 0)
+        if batch is None:
+            break
+        if (batch.column(0).type != id_arrow_type or
+            batch.schema.names[0] != 'id'):
+            batch = batch.set_column(0, 'id', pc.cast(batch.column(0),
+                                                      id_arrow_type))
+        if held is not None:
+            batch = concat_batches([held, batch])
+        # Hold back the last id; it may continue in the next batch
+        starts = _segment_starts(batch.column(0))
+        last = int(starts[-1])
+        held = batch.slice(last)
+        complete = batch.slice(0, last)
+        if complete.num_rows == 0:
+            continue
+        with instrument.stage('transform', rows=complete.num_rows):
+            out = _reduce(complete, schema)
+        _write(out)
+        n_written += out.num_rows
+    if held is not None and held.num_rows > 0:
+        out = _reduce(held, schema)
+        _write(out)
+        n_written += out.num_rows
+
+    write_checksums(out_path, checks, table=AGG_TABLE, writer=pq_writer,
+                    conn=out_conn)
+    if pq_writer is not None:
+        pq_writer.close()
+    else:
+        out_conn.close()
+    if not var_path.endswith('.parquet'):
+        reader.close()
+    return n_written
+
+class LcAggregates:
+    '''
+    Aggregates table read into memory (it has one row per object and
+    band) with vectorized lookup by id.
+
+    Parameters
+    ----------
+    path    string   file written by aggregate_light_curves
+    '''
+    def __init__(self, path):
+        if path.endswith('.parquet'):
+            import pyarrow.parquet as pq
+
+            self._table = pq.read_table(path)
+        else:
+            from desc.truth_reorg.sqlite_arrow import SqliteArrowReader
+
+            with SqliteArrowReader(path) as reader:
+                self._table = reader.table(f'select * from {AGG_TABLE}')
+        self._by_band = {}
+
+    @property
+    def table(self):
+        return self._table
+
+    def _band(self, band):
+        if band not in self._by_band:
+            sub = self._table.filter(pc.equal(self._table['bandpass'], band))
+            self._by_band[band] = sub.combine_chunks()
+        return self._by_band[band]
+
+    def column(self, ids, band, name):
+        '''
+        Values of aggregate column name for band, aligned with pyarrow
+        array ids (null where an id has no rows in that band)
+        '''
+        sub = self._band(band)
+        value_set = sub['id'].combine_chunks()
+        if value_set.type != ids.type:
+            ids = pc.cast(ids, value_set.type)
+        idx = pc.index_in(ids, value_set=value_set)
+        return pc.take(sub[name].combine_chunks(), idx)
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Per-object, per-band light curve aggregates from a variability table.  Used for SN max delta_flux and active windows; star stdev of delta mag is taken from LC stats, not from these')
+    parser.add_argument('var_path', help='sqlite or parquet variability file')
+    parser.add_argument('out_path', help='output; .parquet or sqlite')
+    parser.add_argument('--table', default='sn_variability_truth')
+    parser.add_argument('--chunksize', type=chunksize_arg, default=500000,
+                        help="rows per batch, or 'auto' to adapt at run time")
+    parser.add_argument('--id-type', default='TEXT', choices=['TEXT', 'BIGINT'])
+    parser.add_argument('--id-column', default='id',
+                        help='input column identifying an object (id_string for truth_sn_variability)')
+
+    args = parser.parse_args()
+    n = aggregate_light_curves(args.var_path, args.out_path, table=args.table,
+                               chunksize=args.chunksize, id_type=args.id_type,
+                               id_column=args.id_column)
+    print(f'Wrote {n} rows')
@@ -0,0 +1,482 @@
+'''
+Compact storage layout for variability (light curve) tables.
+
+The variability tables store, on every row, the object's id (and for SNe
+also id_string), MJD as a double and bandpass as text.  In the compact
+layout a table becomes a directory:
+
+    objects.parquet       one row per run of consecutive rows belonging to
+                          the same object: the object columns (everything
+                          but obsHistID, MJD, bandpass, delta_flux) and
+                          n_rows, the run length
+    observations.parquet  one row per observation: obsHistID, band (int8
+                          code into meta bands), delta_flux, mjd_exact,
+                          mjd_null
+    visits.parquet        obsHistID, MJD; one row per visit, sorted
+    meta.json             source, band names, counts and checksums of the
+                          source columns (see checksums)
+
+MJD is a function of the visit, so it is stored once per visit and
+recovered by a lookup on obsHistID.  An observation whose MJD is not the
+one recorded for its visit (the first seen) keeps its own value in
+mjd_exact, which is null elsewhere and costs next to nothing; so does a
+row with null obsHistID.  A null MJD has null mjd_exact and mjd_null
+true.  Runs are found with null-aware comparisons, so null object
+column values are kept too.  Decoding is exact: same rows, same order,
+same values (nulls included) and types as the source.  A
+per-object base MJD plus float32 offset would not be: over a light
+curve of 100 days a float32 offset resolves only about a second.
+
+Runs need not be maximal; input not grouped by object simply has more
+of them.  Variability outputs are written grouped by object.
+'''
+import os
+import json
+import shutil
+from time import perf_counter
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from desc.truth_reorg.parquet_utils import parquet_write_options
+from desc.truth_reorg.checksums import ColumnChecksums, compare_checksums
+
+__all__ = ['encode_light_curves', 'CompactLightCurves', 'compare_layouts']
+
+_OBJECTS = 'objects.parquet'
+_OBSERVATIONS = 'observations.parquet'
+_VISITS = 'visits.parquet'
+_META = 'meta.json'
+
+# Columns which vary from row to row within a light curve
+_ROW_COLUMNS = ('obsHistID', 'MJD', 'bandpass', 'delta_flux')
+_BANDS = ('u', 'g', 'r', 'i', 'z', 'y')
+# pyarrow type names -> names used by parquet_write_options
+_TYPE_NAMES = {'float' : 'float32', 'double' : 'float64'}
+
+def _source_batches(path, table, batch_rows):
+    '''
+    Return (schema, iterator of RecordBatches) for a parquet, Arrow IPC
+    or sqlite variability file.  sqlite columns are typed as by
+    convert_sqlite_to_parquet
+    '''
+    if path.endswith('.parquet'):
+        f = pq.ParquetFile(path)
+        return f.schema_arrow, f.iter_batches(batch_size=batch_rows)
+    if path.endswith(('.arrow', '.feather')):
+        reader = pa.ipc.open_file(pa.memory_map(path, 'r'))
+        return reader.schema, (reader.get_batch(i)
+                               for i in range(reader.num_record_batches))
+    from desc.truth_reorg.truth_reorg_utils import connect_read
+    from desc.truth_reorg.parquet_utils import _table_schema
+    from desc.truth_reorg.sqlite_arrow import SqliteArrowReader
+
+    with connect_read(path) as conn:
+        _, schema = _table_schema(conn.cursor(), table, path)
+
+    def _batches():
+        with SqliteArrowReader(path) as reader:
+            yield from reader.batches(f'select * from {table} order by rowid',
+                                      schema=schema, batch_rows=batch_rows)
+    return schema, _batches()
+
+class _Visits:
+    '''
+    Sorted obsHistID -> MJD, filled as observations are seen
+    '''
+    def __init__(self, ids=None, mjd=None):
+        self.ids = np.zeros(0, dtype=np.int64) if ids is None else ids
+        self.mjd = np.zeros(0, dtype=np.float64) if mjd is None else mjd
+        self._dense = None
+
+    def make_dense(self):
+        '''
+        Once complete: if ids are dense enough, index MJD directly by
+        obsHistID rather than by binary search
+        '''
+        if len(self.ids) == 0:
+            return
+        span = int(self.ids[-1] - self.ids[0]) + 1
+        if span <= 4 * len(self.ids) + 1024:
+            self._dense = np.full(span, np.nan)
+            self._dense[self.ids - self.ids[0]] = self.mjd
+
+    def lookup(self, obs):
+        if self._dense is not None:
+            return self._dense[obs - self.ids[0]]
+        return self.mjd[np.searchsorted(self.ids, obs)]
+
+    def add(self, obs, mjd):
+        '''
+        Record visits not seen before, with the MJD of their first row
+        '''
+        u, first = np.unique(obs, return_index=True)
+        i = np.searchsorted(self.ids, u)
+        known = np.zeros(len(u), dtype=bool)
+        inside = i < len(self.ids)
+        known[inside] = self.ids[i[inside]] == u[inside]
+        if known.all():
+            return
+        ids = np.concatenate([self.ids, u[~known]])
+        mjd = np.concatenate([self.mjd, mjd[first[~known]]])
+        order = np.argsort(ids, kind='stable')
+        self.ids = ids[order]
+        self.mjd = mjd[order]
+
+def _same_bits(a, b):
+    # Exact comparison, distinguishing e.g. 0.0 from -0.0
+    return a.view(np.int64) == b.view(np.int64)
+
+def _band_codes(bandpass, bands):
+    '''
+    int8 codes of bandpass values, extending bands (a list) with any new
+    names.  Null bandpass has code -1
+    '''
+    idx = pc.index_in(bandpass, value_set=pa.array(bands, type=pa.string()))
+    missing = pc.and_(pc.is_null(idx), pc.is_valid(bandpass))
+    if pc.any(missing).as_py():
+        new = pc.unique(pc.filter(bandpass, missing)).to_pylist()
+        bands.extend(sorted(new))
+        if len(bands) > 127:
+            raise ValueError('Too many distinct bandpass values for int8 codes')
+        idx = pc.index_in(bandpass, value_set=pa.array(bands, type=pa.string()))
+    return pc.fill_null(idx, -1).cast(pa.int8())
+
+def _column_values(col):
+    return col.to_numpy(zero_copy_only=False)
+
+def _filled(col, value, dtype):
+    '''
+    numpy array of col with nulls replaced by value
+    '''
+    return _column_values(pc.fill_null(col.cast(dtype), value))
+
+def _row_changes(col):
+    '''
+    For pyarrow array col of length n, numpy bool array of length n - 1:
+    True where row i + 1 differs from row i.  Null differs from any
+    value but not from null.  Floating point values are compared by bit
+    pattern, so that e.g. 0.0 and -0.0 are not merged
+    '''
+    n = len(col)
+    a = col.slice(1)
+    b = col.slice(0, n - 1)
+    if pa.types.is_floating(col.type):
+        bits = _filled(col.cast(pa.float64()), 0.0, pa.float64()).view(np.int64)
+        differ = bits[1:] != bits[:-1]
+    else:
+        differ = _column_values(pc.fill_null(pc.not_equal(a, b), False))
+    valid = _column_values(pc.is_valid(col))
+    return (differ & valid[1:] & valid[:-1]) | (valid[1:] != valid[:-1])
+
+def encode_light_curves(in_path, out_dir, table=None, batch_rows=500000,
+                        compression='zstd', verbose=False):
+    '''
+    Write the compact layout of a variability table.
+
+    Parameters
+    ----------
+    in_path     string  sqlite, parquet or Arrow IPC variability file
+    out_dir     string  directory to write; replaced if it exists
+    table       string  table name, for sqlite input
+    batch_rows  int     rows read (and written as a row group) at a time
+
+    Returns the opened CompactLightCurves
+    '''
+    schema, batches = _source_batches(in_path, table, batch_rows)
+    for c in ('obsHistID', 'MJD', 'bandpass'):
+        if c not in schema.names:
+            raise ValueError(f'{in_path}: no column {c}')
+    obj_names = [n for n in schema.names if n not in _ROW_COLUMNS]
+    obs_fields = [schema.field('obsHistID'), pa.field('band', pa.int8()),
+                  pa.field('mjd_exact', pa.float64()),
+                  pa.field('mjd_null', pa.bool_())]
+    if 'delta_flux' in schema.names:
+        obs_fields.append(schema.field('delta_flux'))
+    obs_schema = pa.schema(obs_fields)
+    obj_schema = pa.schema([schema.field(n) for n in obj_names] +
+                           [pa.field('n_rows', pa.int64())])
+
+    def _options(sch, low_cardinality=()):
+        column_dict = {f.name : _TYPE_NAMES.get(str(f.type), str(f.type))
+                       for f in sch}
+        return parquet_write_options(column_dict,
+                                     low_cardinality=low_cardinality,
+                                     compression=compression)
+
+    tmp_dir = f'{out_dir}.tmp.{os.getpid()}'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    checks = ColumnChecksums(schema)
+    visits = _Visits()
+    bands = list(_BANDS)
+    n_exact = 0
+    n_runs = 0
+    # Last run of the previous batch, which may continue in this one:
+    # (object columns of its first row, as length-1 arrays; rows so far)
+    pending = None
+
+    def _write_run(run):
+        obj_writer.write_table(pa.table(
+            run[0] + [pa.array([run[1]], type=pa.int64())],
+            schema=obj_schema))
+        return 1
+    obj_writer = pq.ParquetWriter(os.path.join(tmp_dir, _OBJECTS), obj_schema,
+                                  **_options(obj_schema))
+    obs_writer = pq.ParquetWriter(os.path.join(tmp_dir, _OBSERVATIONS),
+                                  obs_schema,
+                                  **_options(obs_schema, ['band']))
+    with obj_writer, obs_writer:
+        for batch in batches:
+            n = batch.num_rows
+            if n == 0:
+                continue
+            checks.update(batch)
+
+            obs = _filled(batch.column('obsHistID'), 0, pa.int64())
+            mjd = _filled(batch.column('MJD'), np.nan, pa.float64())
+            obs_valid = _column_values(pc.is_valid(batch.column('obsHistID')))
+            mjd_valid = _column_values(pc.is_valid(batch.column('MJD')))
+            # Only rows with both values say anything about the visit.
+            # Rows with a null obsHistID keep their own MJD
+            both = obs_valid & mjd_valid
+            visits.add(obs[both], mjd[both])
+            differs = mjd_valid.copy()
+            differs[both] = ~_same_bits(visits.lookup(obs[both]), mjd[both])
+            n_exact += int(differs.sum())
+            columns = [batch.column('obsHistID'),
+                       _band_codes(batch.column('bandpass'), bands),
+                       pa.array(mjd, mask=~differs), pa.array(~mjd_valid)]
+            if 'delta_flux' in schema.names:
+                columns.append(batch.column('delta_flux'))
+            obs_writer.write_batch(pa.RecordBatch.from_arrays(
+                columns, schema=obs_schema))
+
+            # Runs of rows with identical object columns
+            change = np.zeros(n, dtype=bool)
+            change[0] = True
+            values = [batch.column(c) for c in obj_names]
+            for v in values:
+                change[1:] |= _row_changes(v)
+            starts = np.flatnonzero(change)
+            lengths = np.diff(np.append(starts, n))
+            if pending is not None:
+                continues = not any(
+                    _row_changes(pa.concat_arrays([p, v.slice(0, 1)]))[0]
+                    for (p, v) in zip(pending[0], values))
+                if continues:
+                    lengths[0] += pending[1]
+                else:
+                    n_runs += _write_run(pending)
+            # Hold back the last run
+            pending = ([v.slice(int(starts[-1]), 1) for v in values],
+                       int(lengths[-1]))
+            if len(starts) > 1:
+                idx = pa.array(starts[:-1])
+                obj_writer.write_table(pa.table(
+                    [batch.column(c).take(idx) for c in obj_names] +
+                    [pa.array(lengths[:-1], type=pa.int64())],
+                    schema=obj_schema))
+                n_runs += len(starts) - 1
+            if verbose:
+                print(f'{checks.rows} rows, {n_runs} runs, {len(visits.ids)} visits')
+        if pending is not None:
+            n_runs += _write_run(pending)
+
+    pq.write_table(pa.table({'obsHistID' : visits.ids, 'MJD' : visits.mjd}),
+                   os.path.join(tmp_dir, _VISITS), compression=compression)
+    meta = {'source' : os.path.abspath(in_path), 'table' : table,
+            'bands' : bands, 'object_columns' : obj_names,
+            'n_rows' : checks.rows, 'n_runs' : n_runs,
+            'n_visits' : len(visits.ids), 'n_mjd_exact' : n_exact,
+            'checksums' : checks.as_dict()}
+    with open(os.path.join(tmp_dir, _META), 'w') as f:
+        json.dump(meta, f, indent=2)
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.replace(tmp_dir, out_dir)
+    return CompactLightCurves(out_dir)
+
+class CompactLightCurves:
+    '''
+    Parameters
+    ----------
+    directory   string  as written by encode_light_curves
+    '''
+    def __init__(self, directory):
+        self._directory = directory
+        with open(os.path.join(directory, _META)) as f:
+            self.meta = json.load(f)
+        # Source schema, in source column order
+        self.schema = ColumnChecksums.from_dict(self.meta['checksums']).schema
+        self._objects = None
+        self._visits = None
+
+    def __len__(self):
+        return self.meta['n_rows']
+
+    def nbytes(self):
+        '''
+        Size on disk of the layout
+        '''
+        return sum(os.path.getsize(os.path.join(self._directory, f))
+                   for f in os.listdir(self._directory))
+
+    def _load(self):
+        if self._objects is None:
+            self._objects = pq.read_table(os.path.join(self._directory,
+                                                       _OBJECTS))
+            self._run_end = np.cumsum(
+                self._objects['n_rows'].to_numpy(zero_copy_only=False))
+            vis = pq.read_table(os.path.join(self._directory, _VISITS))
+            self._visits = _Visits(vis['obsHistID'].to_numpy(),
+                                   vis['MJD'].to_numpy())
+            self._visits.make_dense()
+            self._bands = pa.array(self.meta['bands'], type=pa.string())
+
+    def _decode(self, batch, start):
+        '''
+        batch of observations beginning at row start -> source RecordBatch
+        '''
+        n = batch.num_rows
+        # Runs overlapping rows [start, start + n), and rows of each
+        r0, r1 = np.searchsorted(self._run_end, [start, start + n - 1],
+                                 side='right')
+        ends = np.minimum(self._run_end[r0:r1 + 1], start + n)
+        begins = np.maximum(np.append(self._run_end[r0 - 1] if r0 > 0 else 0,
+                                      self._run_end[r0:r1]), start)
+        run = pa.array(np.repeat(np.arange(r0, r1 + 1), ends - begins))
+        obs = batch.column('obsHistID')
+        # MJD from the visit where there is no exact value and it is not null
+        exact = batch.column('mjd_exact')
+        need = ~(_column_values(pc.is_valid(exact)) |
+                 _column_values(batch.column('mjd_null')))
+        visit_mjd = np.full(n, np.nan)
+        visit_mjd[need] = self._visits.lookup(
+            _filled(obs, 0, pa.int64())[need])
+        mjd = pc.coalesce(exact, pa.array(visit_mjd, mask=~need))
+        codes = batch.column('band').cast(pa.int32())
+        codes = pc.if_else(pc.less(codes, 0), pa.scalar(None, pa.int32()),
+                           codes)
+        decoded = {'obsHistID' : obs, 'MJD' : mjd,
+                   'bandpass' : self._bands.take(codes)}
+        if 'delta_flux' in batch.schema.names:
+            decoded['delta_flux'] = batch.column('delta_flux')
+        for c in self.meta['object_columns']:
+            decoded[c] = self._objects[c].take(run).combine_chunks()
+        return pa.RecordBatch.from_arrays(
+            [decoded[f.name].cast(f.type) for f in self.schema],
+            schema=self.schema)
+
+    def iter_batches(self, batch_rows=500000):
+        '''
+        Yield decoded RecordBatches with the source's columns and types,
+        rows in source order
+        '''
+        self._load()
+        f = pq.ParquetFile(os.path.join(self._directory, _OBSERVATIONS))
+        start = 0
+        for batch in f.iter_batches(batch_size=batch_rows):
+            yield self._decode(batch, start)
+            start += batch.num_rows
+
+    def read(self):
+        '''
+        Decode the whole table
+        '''
+        batches = list(self.iter_batches())
+        return pa.Table.from_batches(batches, schema=self.schema)
+
+    def verify(self, batch_rows=500000):
+        '''
+        Decode everything and compare checksums with those of the source
+        taken while encoding.  Returns dict as from
+        checksums.compare_checksums
+        '''
+        checks = ColumnChecksums(self.schema)
+        for batch in self.iter_batches(batch_rows=batch_rows):
+            checks.update(batch)
+        return compare_checksums(
+            ColumnChecksums.from_dict(self.meta['checksums']), checks)
+
+def _time_full_scan(batches):
+    t0 = perf_counter()
+    rows = sum(b.num_rows for b in batches)
+    return perf_counter() - t0, rows
+
+def compare_layouts(dbfile, table, out_dir=None, batch_rows=500000):
+    '''
+    Compare on-disk size and full-scan time (all columns, decoded) of a
+    variability table in sqlite, in parquet with the current schema
+    (tuned encodings, see parquet_write_options) and in the compact
+    layout.  Also checks that the compact layout decodes to exactly the
+    rows of the parquet file.
+
+    Returns
+    -------
+    dict keyed by 'sqlite', 'parquet', 'compact' with values dicts of
+    size (bytes), full_scan_s and rows; and key 'round_trip_exact'
+    '''
+    import tempfile
+    from desc.truth_reorg.parquet_utils import convert_sqlite_to_parquet
+
+    if out_dir is None:
+        out_dir = tempfile.mkdtemp(prefix='lc_compact_')
+    os.makedirs(out_dir, exist_ok=True)
+    report = {}
+    _, batches = _source_batches(dbfile, table, batch_rows)
+    scan_s, rows = _time_full_scan(batches)
+    report['sqlite'] = {'size' : os.path.getsize(dbfile),
+                        'full_scan_s' : scan_s, 'rows' : rows}
+
+    pqfile = os.path.join(out_dir, f'{table}.parquet')
+    convert_sqlite_to_parquet(dbfile, pqfile, table, order_by='rowid',
+                              tune=True)
+    scan_s, rows = _time_full_scan(
+        pq.ParquetFile(pqfile).iter_batches(batch_size=batch_rows))
+    report['parquet'] = {'size' : os.path.getsize(pqfile),
+                         'full_scan_s' : scan_s, 'rows' : rows}
+
+    lc_dir = os.path.join(out_dir, f'{table}.lc')
+    t0 = perf_counter()
+    encode_light_curves(dbfile, lc_dir, table=table, batch_rows=batch_rows)
+    encode_s = perf_counter() - t0
+    compact = CompactLightCurves(lc_dir)
+    scan_s, rows = _time_full_scan(compact.iter_batches(batch_rows=batch_rows))
+    report['compact'] = {'size' : compact.nbytes(), 'full_scan_s' : scan_s,
+                         'rows' : rows, 'encode_s' : encode_s}
+    report['round_trip_exact'] = compact.read().equals(pq.read_table(pqfile))
+    return report
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Encode, verify or benchmark the compact light curve layout')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('encode', help='write compact layout of a variability file')
+    p.add_argument('in_path')
+    p.add_argument('out_dir')
+    p.add_argument('--table', default=None, help='table name for sqlite input')
+    p.add_argument('--batch-rows', type=int, default=500000)
+    p = sub.add_parser('verify', help='decode and compare with source checksums')
+    p.add_argument('directory')
+    p = sub.add_parser('benchmark',
+                       help='compare size and scan time with sqlite and parquet')
+    p.add_argument('dbfile')
+    p.add_argument('table')
+    p.add_argument('--out-dir', default=None,
+                   help='where to write parquet and compact files. Default is a temporary directory')
+
+    args = parser.parse_args()
+    if args.command == 'encode':
+        lc = encode_light_curves(args.in_path, args.out_dir, table=args.table,
+                                 batch_rows=args.batch_rows)
+        print({k : v for (k, v) in lc.meta.items() if k != 'checksums'})
+        print(f'{lc.nbytes()} bytes')
+    elif args.command == 'verify':
+        print(CompactLightCurves(args.directory).verify())
+    else:
+        report = compare_layouts(args.dbfile, args.table, out_dir=args.out_dir)
+        print(json.dumps(report, indent=2))
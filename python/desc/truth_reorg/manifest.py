@@ -0,0 +1,138 @@
+'''
+Content fingerprints for pipeline inputs and outputs, and a build manifest
+recording them, so that a rebuild need only redo partitions (e.g. healpix
+files) whose inputs have changed.
+
+Fingerprints are cheap to compute and do not depend on mtime, so files
+which have been copied or hard-linked keep their fingerprint:
+  parquet   size and hash of the footer (schema, row group metadata
+            including statistics)
+  sqlite    size and, per table, row count and rowid range
+  other     size and mtime
+'''
+import os
+import json
+import shutil
+import sqlite3
+import hashlib
+
+from desc.truth_reorg.truth_reorg_utils import connect_read
+
+__all__ = ['fingerprint', 'BuildManifest', 'link_or_copy', 'MANIFEST_NAME']
+
+MANIFEST_NAME = 'build_manifest.json'
+
+_PARQUET_MAGIC = b'PAR1'
+_SQLITE_SUFFIXES = ('.db', '.sqlite', '.sqlite3')
+
+def _parquet_fingerprint(path, size):
+    with open(path, 'rb') as f:
+        f.seek(size - 8)
+        tail = f.read(8)
+        if tail[4:] != _PARQUET_MAGIC:
+            raise ValueError(f'{path} is not a parquet file')
+        footer_len = int.from_bytes(tail[:4], 'little')
+        f.seek(size - 8 - footer_len)
+        footer = f.read(footer_len)
+    return {'size' : size, 'footer_sha1' : hashlib.sha1(footer).hexdigest()}
+
+def _sqlite_fingerprint(path, size):
+    h = hashlib.sha1()
+    with connect_read(path) as conn:
+        tables = [r[0] for r in conn.execute(
+            "select name from sqlite_master where type='table' order by name")]
+        for t in tables:
+            try:
+                row = conn.execute(
+                    f'select count(*), min(rowid), max(rowid) from "{t}"').fetchone()
+            except sqlite3.OperationalError:
+                # e.g. WITHOUT ROWID table
+                row = conn.execute(f'select count(*) from "{t}"').fetchone()
+            h.update(repr((t,) + tuple(row)).encode())
+    return {'size' : size, 'tables_sha1' : h.hexdigest()}
+
+def fingerprint(path):
+    '''
+    Return a dict characterizing the content of file path, or None if
+    it does not exist
+    '''
+    if not os.path.exists(path):
+        return None
+    size = os.path.getsize(path)
+    if path.endswith('.parquet'):
+        return _parquet_fingerprint(path, size)
+    if path.endswith(_SQLITE_SUFFIXES):
+        return _sqlite_fingerprint(path, size)
+    return {'size' : size, 'mtime' : os.path.getmtime(path)}
+
+def _normalize(params):
+    # Compare parameters as they will look after a json round trip
+    return json.loads(json.dumps(params if params else {}))
+
+def link_or_copy(src, dst):
+    '''
+    Hard-link src to dst if possible (same filesystem), else copy.
+    Any existing dst is replaced
+    '''
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+class BuildManifest:
+    '''
+    Record, per key (a stage or partition name), fingerprints of the inputs
+    and outputs and any parameters used when the outputs were made.
+    Stored as json, typically as MANIFEST_NAME in the output directory.
+    '''
+    def __init__(self, path):
+        self._path = path
+        self._entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self._entries = json.load(f)
+
+    @property
+    def path(self):
+        return self._path
+
+    def entry(self, key):
+        return self._entries.get(key)
+
+    def inputs_match(self, key, inputs, params=None):
+        '''
+        True if inputs (list of paths) have the same fingerprints, in
+        order, as when key was last recorded, and params are unchanged.
+        Input paths themselves need not be the same.
+        '''
+        e = self._entries.get(key)
+        if e is None:
+            return False
+        if e.get('params') != _normalize(params):
+            return False
+        recorded = [fp for (p, fp) in e['inputs']]
+        return recorded == [fingerprint(p) for p in inputs]
+
+    def is_current(self, key, inputs, outputs, params=None):
+        '''
+        True if inputs match (see inputs_match) and the outputs are
+        present and unchanged since they were recorded
+        '''
+        if not self.inputs_match(key, inputs, params):
+            return False
+        recorded = [fp for (p, fp) in self._entries[key]['outputs']]
+        current = [fingerprint(p) for p in outputs]
+        return None not in current and recorded == current
+
+    def record(self, key, inputs, outputs, params=None):
+        self._entries[key] = {'inputs' : [(p, fingerprint(p)) for p in inputs],
+                              'outputs' : [(p, fingerprint(p)) for p in outputs],
+                              'params' : _normalize(params)}
+
+    def save(self):
+        tmp = self._path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self._entries, f, indent=1)
+        os.replace(tmp, self._path)
@@ -3,14 +3,192 @@ import sys
 
 import pyarrow.parquet as pq
 import pyarrow as pa
+import pyarrow.compute as pc
 import numpy as np
 import pandas as pd
+import shutil
 import sqlite3
+import tempfile
+from time import perf_counter
 
 from desc.truth_reorg.script_utils import print_callinfo
+from desc.truth_reorg.script_utils import Instrument, NULL_INSTRUMENT
 from desc.truth_reorg.truth_reorg_utils import connect_read
+from desc.truth_reorg.batch_sizer import BatchSizer
+from desc.truth_reorg.checksums import ColumnChecksums, write_checksums
+
+__all__ = ["convert_sqlite_to_parquet", "compare_sqlite_parquet",
+           "arrow_schema", "rows_to_batch", "batch_to_rows",
+           "parquet_write_options", "compare_parquet_tuning",
+           "convert_sqlite_to_parquet_sorted", "open_parquet_writer",
+           "read_batches", "rebatch", "concat_batches"]
+
+_TYPE_TRANSLATE = {'BIGINT' : 'int64', 'INT' : 'int32',
+                   'INTEGER' : 'int32',
+                   'FLOAT' : 'float32', 'DOUBLE' : 'float64',
+                   'TEXT' : 'string'}
+_TYPE_PA = {'int64' : pa.int64(), 'int32' : pa.int32(),
+            'float32': pa.float32(), 'float64' : pa.float64(),
+            'string' : pa.string()}
+
+def arrow_schema(columns):
+    '''
+    Given a list of (column name, sqlite type) as used with
+    assemble_create_table, return the corresponding pyarrow schema
+    '''
+    return pa.schema([(c[0], _TYPE_PA[_TYPE_TRANSLATE[c[1]]])
+                      for c in columns])
+
+def rows_to_batch(rows, schema):
+    '''
+    Convert a list of row tuples (as returned by fetchmany) to a
+    pyarrow RecordBatch with the given schema
+    '''
+    if len(rows) == 0:
+        cols = [[] for f in schema]
+    else:
+        cols = list(zip(*rows))
+    return pa.RecordBatch.from_arrays([pa.array(c, type=f.type)
+                                       for (c, f) in zip(cols, schema)],
+                                      schema=schema)
+
+def batch_to_rows(batch):
+    '''
+    Inverse of rows_to_batch: return list of row tuples
+    '''
+    return list(zip(*[c.to_pylist() for c in batch.columns]))
+# Columns with at most this many distinct values in the sample are
+# dictionary encoded
+_MAX_DICT_DISTINCT = 1000
+_CARDINALITY_SAMPLE = 10000
+# Candidate keys on which readers commonly filter
+_SORT_KEYS = ('id', 'MJD')
+
+def _low_cardinality_columns(cursor, table, column_dict,
+                             sample=_CARDINALITY_SAMPLE,
+                             max_distinct=_MAX_DICT_DISTINCT):
+    '''
+    Return names of string columns with few distinct values among the
+    first sample rows of table
+    '''
+    low = []
+    for (k, v) in column_dict.items():
+        if v != 'string':
+            continue
+        q = f'select count(distinct {k}) from (select {k} from {table} limit {sample})'
+        n_distinct = cursor.execute(q).fetchone()[0]
+        if n_distinct <= max_distinct:
+            low.append(k)
+    return low
+
+def parquet_write_options(column_dict, low_cardinality=(), sorted_by=None,
+                          page_size=None, compression='zstd',
+                          compression_level=None):
+    '''
+    Return dict of keyword arguments for pyarrow.parquet.ParquetWriter
+    suited to the columns described by column_dict (column name -> type
+    as used in convert_sqlite_to_parquet):
+       * dictionary encoding only for low_cardinality string columns
+       * BYTE_STREAM_SPLIT encoding for float columns, which compresses
+         much better than plain encoding
+       * compression (default zstd) for everything
+       * column and offset (page) indexes, so readers can skip pages
+       * sorting_columns metadata if sorted_by (list of column names) is
+         supplied.  Only pass this if rows really are written in that order
+    Requires a recent pyarrow (>= 13)
+    '''
+    floats = [k for (k, v) in column_dict.items()
+              if v in ('float32', 'float64')]
+    opts = {'use_dictionary' : list(low_cardinality),
+            'column_encoding' : {k : 'BYTE_STREAM_SPLIT' for k in floats},
+            'compression' : compression,
+            'write_statistics' : True,
+            'write_page_index' : True}
+    if compression_level is not None:
+        opts['compression_level'] = compression_level
+    if page_size is not None:
+        opts['data_page_size'] = page_size
+    if sorted_by:
+        names = list(column_dict.keys())
+        opts['sorting_columns'] = [pq.SortingColumn(names.index(k))
+                                   for k in sorted_by]
+    return opts
+
+def open_parquet_writer(pqfile, columns, tune=True, low_cardinality=(),
+                        sorted_by=None):
+    '''
+    Return a pyarrow.parquet.ParquetWriter for columns, a list of
+    (column name, sqlite type) as used with assemble_create_table.
+    If tune, use parquet_write_options
+    '''
+    schema = arrow_schema(columns)
+    if not tune:
+        return pq.ParquetWriter(pqfile, schema)
+    column_dict = {c[0] : _TYPE_TRANSLATE[c[1]] for c in columns}
+    return pq.ParquetWriter(pqfile, schema,
+                            **parquet_write_options(column_dict,
+                                                    low_cardinality=low_cardinality,
+                                                    sorted_by=sorted_by))
+
+def read_batches(path, columns, table=None, batch_rows=65536):
+    '''
+    Yield pyarrow RecordBatches holding columns (in that order) of a
+    parquet file, an Arrow IPC file (.arrow, .feather) or, for anything
+    else, table of an sqlite file
+    '''
+    columns = list(columns)
+    if path.endswith('.parquet'):
+        yield from pq.ParquetFile(path).iter_batches(batch_size=batch_rows,
+                                                     columns=columns)
+        return
+    if path.endswith(('.arrow', '.feather')):
+        reader = pa.ipc.open_file(pa.memory_map(path, 'r'))
+        for i in range(reader.num_record_batches):
+            yield reader.get_batch(i).select(columns)
+        return
+    from desc.truth_reorg.sqlite_arrow import SqliteArrowReader
+
+    q = 'select ' + ','.join(columns) + ' from ' + table
+    with SqliteArrowReader(path) as reader:
+        yield from reader.batches(q, batch_rows=batch_rows)
+
+def rebatch(batches, batch_rows):
+    '''
+    Re-cut a stream of RecordBatches into batches of exactly batch_rows
+    rows (the last may be shorter).  Two row-aligned streams rebatched
+    to the same size may be zipped together.  batch_rows may be a
+    BatchSizer, whose current size is used for each output batch
+    '''
+    def _target():
+        if isinstance(batch_rows, BatchSizer):
+            return batch_rows.size
+        return batch_rows
+
+    pieces = []
+    n = 0
+    target = _target()
+    for batch in batches:
+        while batch.num_rows > 0:
+            take = min(target - n, batch.num_rows)
+            pieces.append(batch.slice(0, take))
+            batch = batch.slice(take)
+            n += take
+            if n == target:
+                yield concat_batches(pieces)
+                pieces = []
+                n = 0
+                target = _target()
+    if n > 0:
+        yield concat_batches(pieces)
+
+def concat_batches(pieces):
+    '''
+    Concatenate RecordBatches with the same schema into one
+    '''
+    if len(pieces) == 1:
+        return pieces[0]
+    return pa.Table.from_batches(pieces).combine_chunks().to_batches()[0]
 
-__all__ = ["convert_sqlite_to_parquet", "compare_sqlite_parquet"]
 def  _transpose(records, column_dict, schema, n_rec=None, verbose=False,
                 force_id=False):
     '''
@@ -45,9 +223,49 @@ def  _transpose(records, column_dict, schema, n_rec=None, verbose=False,
 
     return pa.Table.from_arrays(dat, schema=schema)
 
+def _table_schema(cursor, table, dbfile, verbose=False):
+    '''
+    Return dict of column name -> type name (keys of _TYPE_PA) and
+    corresponding pyarrow schema for an sqlite table
+    '''
+    # Get names, types
+    meta_res = cursor.execute('PRAGMA table_info({})'.format(table))
+    column_dict = {t[1]: t[2] for t in meta_res.fetchall()}
+
+    for (k,v) in column_dict.items():
+        if v in _TYPE_TRANSLATE.keys():
+            column_dict[k] = _TYPE_TRANSLATE[v]
+            # Override in case MJD column is mislabeled as FLOAT
+            if k == 'MJD':
+                column_dict[k] = 'float64'
+            # Override for star files only to set id to int64
+            if k == 'id' and 'star' in dbfile:
+                column_dict[k] = 'int64'
+        else:
+            print(f"For key {k} found unknown type {v}, setting to float32")
+            column_dict[k] = 'float32'
+
+    if verbose:
+        print('column_dict: ')
+        for (k, v) in column_dict.items():
+            print(k, " : ", v, " : ")
+
+    # Make the parquet schema
+    fields = []
+    for (k, v) in column_dict.items():
+        fields.append((k, _TYPE_PA[v]))
+    schema = pa.schema(fields)
+    if verbose:
+        for k in schema:
+            print(k)
+
+    return column_dict, schema
+
 def convert_sqlite_to_parquet(dbfile, pqfile, table,
                               n_group=1, max_group_gbyte=5.0,
-                              order_by=None, dry=False, verbose=False ):
+                              order_by=None, dry=False, verbose=False,
+                              instrument=NULL_INSTRUMENT, tune=False,
+                              page_size=None, native_read=True):
     '''
     Write a parquet file corresponding to contents of a table from an sqlite3 db.
 
@@ -62,7 +280,15 @@ def convert_sqlite_to_parquet(dbfile, pqfile, table,
     order_by        if supplied, use in SELECT from sqlite
     dry             if true, produce no output parquet file
     verbose         if true, include more information in output log
+    instrument      Instrument object used to time fetch, transform and
+                    write stages.  Default does no timing.
+    tune            if true, choose encodings, compression and page indexes
+                    from the column types; see parquet_write_options
+    page_size       data page size in bytes (only used if tune is true)
+    native_read     if true and the ADBC sqlite driver is available, read
+                    each window directly into Arrow (see sqlite_arrow)
     '''
+    from desc.truth_reorg.sqlite_arrow import SqliteArrowReader, HAVE_ADBC
 
     statinfo = os.stat(dbfile)
     min_groups = np.ceil(statinfo.st_size / (float(max_group_gbyte) * 1e9))
@@ -71,7 +297,7 @@ def convert_sqlite_to_parquet(dbfile, pqfile, table,
 
     column_dict = {}
     #with sqlite3.connect(dbfile) as conn:
-    with connect_read(dbfile) as conn:
+    with connect_read(dbfile, profile='scan') as conn:
         cursor = conn.cursor()
         cmd = 'select count(*) from ' + table
         res = cursor.execute(cmd)
@@ -82,43 +308,8 @@ def convert_sqlite_to_parquet(dbfile, pqfile, table,
 
         print(f'Rows per group: {row_per_group}\nN groups: {ng}')
 
-        # Get names, types
-        meta_res = cursor.execute('PRAGMA table_info({})'.format(table))
-        column_dict = {t[1]: t[2] for t in meta_res.fetchall()}
-
-        type_translate = {'BIGINT' : 'int64', 'INT' : 'int32',
-                          'INTEGER' : 'int32',
-                          'FLOAT' : 'float32', 'DOUBLE' : 'float64',
-                          'TEXT' : 'string'}
-        type_pa = {'int64' : pa.int64(), 'int32' : pa.int32(),
-                   'float32': pa.float32(), 'float64' : pa.float64(),
-                   'string' : pa.string()}
-
-        for (k,v) in column_dict.items():
-            if v in type_translate.keys():
-                column_dict[k] = type_translate[v]
-                # Override in case MJD column is mislabeled as FLOAT
-                if k == 'MJD':
-                    column_dict[k] = 'float64'
-                # Override for star files only to set id to int64
-                if k == 'id' and 'star' in dbfile:
-                    column_dict[k] = 'int64'
-            else:
-                print(f"For key {k} found unknown type {v}, setting to float32")
-                column_dict[k] = 'float32'
-
-        if verbose:
-            print('column_dict: ')
-            for (k, v) in column_dict.items():
-                print(k, " : ", v, " : ")
-
-        # Make the parquet schema
-        fields = []
-        for (k, v) in column_dict.items():
-            fields.append((k, type_pa[v]))
-        schema = pa.schema(fields)
-        for k in schema:
-            print(k)
+        column_dict, schema = _table_schema(cursor, table, dbfile,
+                                            verbose=verbose)
 
         done = False
 
@@ -126,7 +317,23 @@ def convert_sqlite_to_parquet(dbfile, pqfile, table,
         prev_row = 0
         limit_row = min(row_per_group, total_row)
 
-        writer = pq.ParquetWriter(pqfile, schema)
+        write_options = {}
+        if tune:
+            low_card = _low_cardinality_columns(cursor, table, column_dict)
+            sorted_by = None
+            if order_by in _SORT_KEYS and order_by in column_dict:
+                sorted_by = [order_by]
+            write_options = parquet_write_options(column_dict,
+                                                  low_cardinality=low_card,
+                                                  sorted_by=sorted_by,
+                                                  page_size=page_size)
+            print(f'Parquet write options: {write_options}')
+
+        writer = pq.ParquetWriter(pqfile, schema, **write_options)
+        checks = ColumnChecksums(schema)
+        arrow_reader = None
+        if native_read and HAVE_ADBC and not dry:
+            arrow_reader = SqliteArrowReader(dbfile)
 
         while limit_row <= total_row:
             cmd = f"select * from {table} where rowid > {prev_row} and rowid <= {limit_row}"
@@ -136,17 +343,37 @@ def convert_sqlite_to_parquet(dbfile, pqfile, table,
 
             print('\nFetch command is:\n', cmd)
 
-            if not dry:
-                cursor.execute(cmd)
+            if arrow_reader is not None:
+                with instrument.stage('fetch') as st:
+                    to_write = arrow_reader.table(cmd, schema=schema)
+                    st.add(rows=to_write.num_rows)
+                if to_write.num_rows == 0:
+                    break
+                with instrument.stage('write', rows=to_write.num_rows,
+                                      nbytes=to_write.nbytes):
+                    writer.write_table(to_write)
+                with instrument.stage('checksum', rows=to_write.num_rows):
+                    checks.update(to_write)
+                if to_write.num_rows < row_per_group:
+                    break
+            elif not dry:
+                with instrument.stage('fetch') as st:
+                    cursor.execute(cmd)
 
-                records =  cursor.fetchall()
+                    records =  cursor.fetchall()
+                    st.add(rows=len(records))
                 if len(records) == 0:
                     done = True
                     break
-                to_write = _transpose(records, column_dict, schema,
-                                      verbose=verbose)
-                                      ###verbose=verbose, force_id=True)
-                writer.write_table(to_write)
+                with instrument.stage('transform', rows=len(records)):
+                    to_write = _transpose(records, column_dict, schema,
+                                          verbose=verbose)
+                                          ###verbose=verbose, force_id=True)
+                with instrument.stage('write', rows=to_write.num_rows,
+                                      nbytes=to_write.nbytes):
+                    writer.write_table(to_write)
+                with instrument.stage('checksum', rows=to_write.num_rows):
+                    checks.update(to_write)
                 if len(records) < row_per_group:
                     done = True
                     break
@@ -155,10 +382,232 @@ def convert_sqlite_to_parquet(dbfile, pqfile, table,
             limit_row = min(prev_row + row_per_group, total_row)
 
             if dry and  prev_row == limit_row:
+                writer.close()
                 return
 
+        write_checksums(pqfile, checks, writer=writer)
+        writer.close()
+        if arrow_reader is not None:
+            arrow_reader.close()
+
     print('Conversion successful')
 
+def _sort_table(tbl, sort_keys):
+    idx = pc.sort_indices(tbl, sort_keys=[(k, 'ascending') for k in sort_keys])
+    return tbl.take(idx)
+
+def _add_healpix(tbl, nside, ra='ra', dec='dec'):
+    import healpy
+
+    hp = healpy.ang2pix(nside, tbl.column(ra).to_numpy(),
+                        tbl.column(dec).to_numpy(), lonlat=True)
+    return tbl.append_column('healpix', pa.array(hp, pa.int64()))
+
+def _key_le(tbl, sort_keys, bound):
+    '''
+    Return boolean numpy mask: True where the key tuple of a row of tbl
+    is <= bound (a tuple of values), in lexicographic order
+    '''
+    le = np.zeros(tbl.num_rows, dtype=bool)
+    eq = np.ones(tbl.num_rows, dtype=bool)
+    for (k, b) in zip(sort_keys, bound):
+        col = tbl.column(k).to_numpy()
+        le |= eq & (col < b)
+        eq &= (col == b)
+    return le | eq
+
+def _last_key(tbl, sort_keys):
+    return tuple(tbl.column(k)[tbl.num_rows - 1].as_py() for k in sort_keys)
+
+class _RunReader:
+    '''
+    Sequential reader for one sorted run spilled as an Arrow IPC file.
+    Holds at most one batch (plus a remainder) in memory
+    '''
+    def __init__(self, path):
+        self._reader = pa.ipc.open_file(pa.memory_map(path, 'r'))
+        self._next = 0
+        self.buffer = None
+        self._refill()
+
+    def _refill(self):
+        while (self.buffer is None or self.buffer.num_rows == 0):
+            if self._next >= self._reader.num_record_batches:
+                self.buffer = None
+                return
+            batch = self._reader.get_batch(self._next)
+            self._next += 1
+            self.buffer = pa.Table.from_batches([batch])
+
+    def take_through(self, sort_keys, bound):
+        '''
+        Remove and return the leading rows with key <= bound
+        '''
+        n = int(_key_le(self.buffer, sort_keys, bound).sum())
+        piece = self.buffer.slice(0, n)
+        self.buffer = self.buffer.slice(n)
+        self._refill()
+        return piece
+
+def convert_sqlite_to_parquet_sorted(dbfile, pqfile, table, sort_keys,
+                                     run_rows=5000000, merge_block=65536,
+                                     row_group_rows=1000000, tmp_dir=None,
+                                     healpix_nside=None, tune=True,
+                                     page_size=None,
+                                     instrument=NULL_INSTRUMENT):
+    '''
+    Write a parquet file from an sqlite table with rows in order of
+    sort_keys, using a bounded-memory external sort, so that row group
+    min/max statistics and page indexes let readers skip data when
+    filtering on the keys.
+
+    Parameters:
+    dbfile          input sqlite3
+    pqfile          path for output file
+    table           write contents of this table to parquet
+    sort_keys       list of column names, e.g. ['id'], ['healpix', 'id'],
+                    ['MJD'].  'healpix' need not be a column of the table
+                    if healpix_nside is supplied
+    run_rows        rows per in-memory sorted run; bounds memory use
+    merge_block     rows per batch in spilled runs; each merge step holds
+                    about one block per run
+    row_group_rows  rows per output row group
+    tmp_dir         where to spill runs; default system temp directory
+    healpix_nside   if set, add column healpix (ring scheme) computed from
+                    ra, dec with this nside.  Requires healpy
+    tune            if true, use parquet_write_options for the writer
+    page_size       data page size in bytes (only used if tune is true)
+    instrument      Instrument object for timing
+    '''
+    from desc.truth_reorg.sqlite_arrow import SqliteArrowReader
+
+    spill_dir = tempfile.mkdtemp(prefix='pq_sort_', dir=tmp_dir)
+    runs = []
+    with connect_read(dbfile) as conn:
+        cursor = conn.cursor()
+        column_dict, schema = _table_schema(cursor, table, dbfile)
+        if healpix_nside is not None:
+            column_dict['healpix'] = 'int64'
+        missing = [k for k in sort_keys if k not in column_dict]
+        if missing:
+            raise ValueError(f'Sort key(s) {missing} not in table {table}')
+
+        # Pass 1: sorted runs spilled to disk
+        reader = SqliteArrowReader(dbfile)
+        batches = reader.batches(f'select * from {table}', schema=schema,
+                                 batch_rows=run_rows)
+        while True:
+            with instrument.stage('fetch') as st:
+                batch = next(batches, None)
+                st.add(rows=batch.num_rows if batch is not None else 0)
+            if batch is None:
+                break
+            with instrument.stage('sort', rows=batch.num_rows):
+                tbl = pa.Table.from_batches([batch])
+                del batch
+                if healpix_nside is not None:
+                    tbl = _add_healpix(tbl, healpix_nside)
+                tbl = _sort_table(tbl, sort_keys)
+            run_path = os.path.join(spill_dir, f'run_{len(runs)}.arrow')
+            with instrument.stage('spill', rows=tbl.num_rows,
+                                  nbytes=tbl.nbytes):
+                with pa.OSFile(run_path, 'wb') as sink:
+                    with pa.ipc.new_file(sink, tbl.schema) as w:
+                        for batch in tbl.to_batches(max_chunksize=merge_block):
+                            w.write_batch(batch)
+            runs.append(run_path)
+            print(f'Wrote sorted run {len(runs)} of {tbl.num_rows} rows')
+            del tbl
+        reader.close()
+
+        write_options = {}
+        if tune:
+            low_card = _low_cardinality_columns(cursor, table, column_dict)
+            write_options = parquet_write_options(column_dict,
+                                                  low_cardinality=low_card,
+                                                  sorted_by=sort_keys,
+                                                  page_size=page_size)
+        else:
+            write_options['write_statistics'] = True
+
+    # Pass 2: k-way merge.  Each step takes, from every run, the rows with
+    # key <= the smallest "last key" among the runs' current blocks.  Such
+    # rows precede everything not yet read, so sorting just them is enough.
+    out_schema = schema
+    if healpix_nside is not None:
+        out_schema = schema.append(pa.field('healpix', pa.int64()))
+    readers = [_RunReader(p) for p in runs]
+    pending = []
+    n_pending = 0
+    n_written = 0
+    checks = ColumnChecksums(out_schema)
+    with pq.ParquetWriter(pqfile, out_schema, **write_options) as writer:
+        while True:
+            active = [r for r in readers if r.buffer is not None]
+            if not active:
+                break
+            with instrument.stage('merge') as st:
+                bound = min(_last_key(r.buffer, sort_keys) for r in active)
+                pieces = [r.take_through(sort_keys, bound) for r in active]
+                merged = _sort_table(pa.concat_tables(pieces), sort_keys)
+                st.add(rows=merged.num_rows)
+            with instrument.stage('checksum', rows=merged.num_rows):
+                checks.update(merged)
+            pending.append(merged)
+            n_pending += merged.num_rows
+            while n_pending >= row_group_rows:
+                out = pa.concat_tables(pending)
+                with instrument.stage('write', rows=row_group_rows):
+                    writer.write_table(out.slice(0, row_group_rows),
+                                       row_group_size=row_group_rows)
+                rest = out.slice(row_group_rows)
+                pending = [rest]
+                n_pending = rest.num_rows
+                n_written += row_group_rows
+        if n_pending > 0:
+            with instrument.stage('write', rows=n_pending):
+                writer.write_table(pa.concat_tables(pending),
+                                   row_group_size=row_group_rows)
+            n_written += n_pending
+        write_checksums(pqfile, checks, writer=writer)
+
+    readers = None
+    shutil.rmtree(spill_dir)
+    print(f'Sorted conversion successful: {n_written} rows from {len(runs)} runs')
+
+def _time_scan(pqfile, columns=None, filters=None):
+    t0 = perf_counter()
+    tbl = pq.read_table(pqfile, columns=columns, filters=filters)
+    return perf_counter() - t0, tbl.num_rows
+
+def compare_parquet_tuning(dbfile, table, out_dir=None, page_size=None,
+                           filter_column=None, filter_value=None):
+    '''
+    Convert table with default and with tuned writer options and
+    compare file size and time for a full scan and, if filter_column is
+    given, for a scan with filter_column == filter_value.
+
+    Returns
+    -------
+    dict keyed by 'default', 'tuned' with values dicts of
+    size (bytes), full_scan_s and, if applicable, filtered_scan_s
+    '''
+    if out_dir is None:
+        out_dir = tempfile.mkdtemp(prefix='pq_tuning_')
+    report = {}
+    for (label, tune) in (('default', False), ('tuned', True)):
+        pqfile = os.path.join(out_dir, f'{table}_{label}.parquet')
+        convert_sqlite_to_parquet(dbfile, pqfile, table, order_by='rowid',
+                                  tune=tune, page_size=page_size)
+        res = {'size' : os.path.getsize(pqfile)}
+        res['full_scan_s'], res['rows'] = _time_scan(pqfile)
+        if filter_column is not None:
+            res['filtered_scan_s'], res['filtered_rows'] = \
+                _time_scan(pqfile, filters=[(filter_column, '==',
+                                             filter_value)])
+        report[label] = res
+    return report
+
 def compare_sqlite_parquet(sqlite_file, parquet_file, sqlite_table,
                            id_column=None, n_rows=100,
                            verbose=False, check_cols=None):
@@ -280,21 +729,68 @@ if __name__ == "__main__":
                         help='If set, compare sqlite and parquet')
     parser.add_argument('--dry', action='store_true',
                         help='If set describe output without creating it')
+    parser.add_argument('--plan', action='store_true',
+                        help='sample the table; print estimated size, memory and time and recommended n-group')
+    parser.add_argument('--memory-gbyte', type=float, default=4.0,
+                        help='memory budget used with --plan')
     parser.add_argument('--verbose', action='store_true',
                         help='Print more; may be useful for debugging')
     parser.add_argument('--id-column', default=None)
     parser.add_argument('--n-check', type=int, default=10,
                         help='Number of rows from sqlite to check. Ignored in no check or id_colume is None')
+    parser.add_argument('--timing-report', default=None,
+                        help='If supplied, write per-stage timing (json) to this path')
+    parser.add_argument('--tune', action='store_true',
+                        help='choose encodings, compression and page indexes from column types')
+    parser.add_argument('--page-size', type=int, default=None,
+                        help='data page size in bytes; used with --tune')
+    parser.add_argument('--sort-by', nargs='*', default=None,
+                        help='write rows sorted by these columns (external sort), e.g. id or healpix id or MJD')
+    parser.add_argument('--healpix-nside', type=int, default=None,
+                        help='with --sort-by, add healpix column of this nside computed from ra, dec')
+    parser.add_argument('--run-rows', type=int, default=5000000,
+                        help='with --sort-by, rows per in-memory sorted run')
+    parser.add_argument('--tuning-report', action='store_true',
+                        help='write default and tuned versions and compare size and scan time')
 
     args = parser.parse_args()
 
     print_callinfo(sys.argv[0], args)
 
-    if not args.check:
+    if args.plan:
+        from desc.truth_reorg.planner import plan_convert, format_plan
+
+        print(format_plan(plan_convert(args.dbfile, args.table,
+                                       memory_gbyte=args.memory_gbyte,
+                                       tune=args.tune)))
+    elif args.tuning_report:
+        out_dir = os.path.dirname(args.pqfile) if args.pqfile else None
+        report = compare_parquet_tuning(args.dbfile, args.table,
+                                        out_dir=out_dir,
+                                        page_size=args.page_size)
+        for (label, res) in report.items():
+            print(label, res)
+    elif args.sort_by:
+        instrument = NULL_INSTRUMENT
+        if args.timing_report:
+            instrument = Instrument()
+        convert_sqlite_to_parquet_sorted(args.dbfile, args.pqfile, args.table,
+                                         args.sort_by, run_rows=args.run_rows,
+                                         healpix_nside=args.healpix_nside,
+                                         page_size=args.page_size,
+                                         instrument=instrument)
+        instrument.report(args.timing_report)
+    elif not args.check:
+        instrument = NULL_INSTRUMENT
+        if args.timing_report:
+            instrument = Instrument()
         convert_sqlite_to_parquet(args.dbfile, args.pqfile, args.table,
                                   n_group=args.n_group, dry=args.dry,
                                   max_group_gbyte=args.max_group_gbyte,
-                                  order_by = 'rowid', verbose=args.verbose)
+                                  order_by = 'rowid', verbose=args.verbose,
+                                  instrument=instrument, tune=args.tune,
+                                  page_size=args.page_size)
+        instrument.report(args.timing_report)
     else:
         ok = compare_sqlite_parquet(args.dbfile, args.pqfile, args.table,
                                     id_column=args.id_column,
@@ -0,0 +1,236 @@
+'''
+Minimal make-like runner for chains of pipeline stages.
+
+Each stage names its input and output files.  A stage depends on any other
+stage producing one of its inputs, and on stages listed explicitly in
+"after".  Independent stages (e.g. the SN and star chains) run concurrently
+in separate processes.  A stage is skipped if all its outputs exist and are
+newer than all its inputs, unless forced.  If the pipeline has a build
+manifest, content fingerprints of inputs and outputs are compared instead
+of modification times.  Outputs of a stage which fails are removed, so
+that a partial output can't look up to date.
+'''
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from time import perf_counter
+
+from desc.truth_reorg.script_utils import print_date
+from desc.truth_reorg.manifest import BuildManifest
+
+__all__ = ['Stage', 'Pipeline', 'load_config']
+
+class Stage:
+    '''
+    Parameters
+    ----------
+    name      string    unique name for the stage
+    func      callable  called as func(inputs, outputs, **params).  Must be
+                        picklable (i.e. defined at module level)
+    inputs    list      paths read by the stage
+    outputs   list      paths written by the stage
+    after     list      names of stages which must complete first, in
+                        addition to those inferred from inputs/outputs
+    params    dict      keyword arguments for func
+    '''
+    def __init__(self, name, func, inputs=(), outputs=(), after=(),
+                 params=None):
+        self.name = name
+        self.func = func
+        self.inputs = [os.path.expandvars(p) for p in inputs]
+        self.outputs = [os.path.expandvars(p) for p in outputs]
+        self.after = list(after)
+        self.params = params if params else {}
+
+    def is_up_to_date(self):
+        '''
+        True if every output exists and is newer than every input
+        which exists
+        '''
+        if len(self.outputs) == 0:
+            return False
+        if not all(os.path.exists(p) for p in self.outputs):
+            return False
+        in_times = [os.path.getmtime(p) for p in self.inputs
+                    if os.path.exists(p)]
+        if len(in_times) == 0:
+            return True
+        return min(os.path.getmtime(p) for p in self.outputs) > max(in_times)
+
+def _remove_paths(paths):
+    for p in paths:
+        if os.path.isdir(p):
+            shutil.rmtree(p)
+        elif os.path.exists(p):
+            os.remove(p)
+
+def _run_one(stage):
+    t0 = perf_counter()
+    stage.func(stage.inputs, stage.outputs, **stage.params)
+    return perf_counter() - t0
+
+class Pipeline:
+    '''
+    A set of stages forming a directed acyclic graph.  If manifest_path is
+    supplied, fingerprints of each stage's inputs and outputs are recorded
+    there and used to decide whether the stage is up to date.
+    '''
+    def __init__(self, stages, manifest_path=None):
+        self._manifest = None
+        if manifest_path:
+            self._manifest = BuildManifest(os.path.expandvars(manifest_path))
+        self._stages = {}
+        for s in stages:
+            if s.name in self._stages:
+                raise ValueError(f'Duplicate stage name {s.name}')
+            self._stages[s.name] = s
+        self._deps = self._find_dependencies()
+        self._order = self._topological_order()
+
+    @property
+    def stages(self):
+        return self._stages
+
+    def _find_dependencies(self):
+        producer = {}
+        for s in self._stages.values():
+            for p in s.outputs:
+                if p in producer:
+                    raise ValueError(f'Output {p} produced by both {producer[p]} and {s.name}')
+                producer[p] = s.name
+        deps = {}
+        for s in self._stages.values():
+            d = set(producer[p] for p in s.inputs if p in producer)
+            for a in s.after:
+                if a not in self._stages:
+                    raise ValueError(f'Stage {s.name} must follow unknown stage {a}')
+                d.add(a)
+            d.discard(s.name)
+            deps[s.name] = d
+        return deps
+
+    def _topological_order(self):
+        order = []
+        remaining = {k : set(v) for (k, v) in self._deps.items()}
+        while remaining:
+            ready = sorted(k for (k, v) in remaining.items() if not v)
+            if not ready:
+                raise ValueError(f'Dependency cycle among stages {sorted(remaining)}')
+            for k in ready:
+                order.append(k)
+                del remaining[k]
+            for v in remaining.values():
+                v.difference_update(ready)
+        return order
+
+    def dependencies(self, name):
+        return set(self._deps[name])
+
+    def _is_up_to_date(self, stage):
+        if self._manifest is None:
+            return stage.is_up_to_date()
+        return self._manifest.is_current(stage.name, stage.inputs,
+                                         stage.outputs, stage.params)
+
+    def run(self, max_workers=2, force=False, dry_run=False):
+        '''
+        Run all stages, respecting dependencies, with up to max_workers
+        stages at a time.  A stage whose outputs are up to date is skipped
+        unless force is True or one of the stages it depends on ran.
+        If any stage fails its outputs are removed and its dependents are
+        not run.
+
+        Returns
+        -------
+        dict keyed by stage name.  Values are dicts with keys
+        status ('ran', 'skipped', 'failed', 'not_run', 'dry') and
+        elapsed (seconds)
+        '''
+        results = {}
+        pending = list(self._order)
+        running = {}
+
+        def _settled(name):
+            return name in results
+
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            while pending or running:
+                for name in list(pending):
+                    deps = self._deps[name]
+                    if not all(_settled(d) for d in deps):
+                        continue
+                    pending.remove(name)
+                    stage = self._stages[name]
+                    if any(results[d]['status'] in ('failed', 'not_run')
+                           for d in deps):
+                        results[name] = {'status' : 'not_run', 'elapsed' : 0.0}
+                        print_date(msg=f'Stage {name} not run: a dependency failed')
+                        continue
+                    upstream_ran = any(results[d]['status'] in ('ran', 'dry')
+                                       for d in deps)
+                    if not force and not upstream_ran and self._is_up_to_date(stage):
+                        results[name] = {'status' : 'skipped', 'elapsed' : 0.0}
+                        print_date(msg=f'Stage {name} up to date; skipped')
+                        continue
+                    if dry_run:
+                        results[name] = {'status' : 'dry', 'elapsed' : 0.0}
+                        print_date(msg=f'Stage {name} would run')
+                        continue
+                    print_date(msg=f'Starting stage {name}')
+                    running[pool.submit(_run_one, stage)] = name
+
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    name = running.pop(fut)
+                    try:
+                        elapsed = fut.result()
+                        results[name] = {'status' : 'ran', 'elapsed' : elapsed}
+                        if self._manifest is not None:
+                            stage = self._stages[name]
+                            self._manifest.record(name, stage.inputs,
+                                                  stage.outputs, stage.params)
+                            self._manifest.save()
+                        print_date(msg=f'Finished stage {name} in {elapsed:.1f} s')
+                    except Exception as ex:
+                        _remove_paths(self._stages[name].outputs)
+                        results[name] = {'status' : 'failed', 'elapsed' : 0.0,
+                                         'error' : repr(ex)}
+                        print_date(msg=f'Stage {name} failed: {ex!r}')
+        return results
+
+    def critical_path(self, results):
+        '''
+        Given the return from run, find the chain of dependent stages
+        with the largest total elapsed time.
+        Returns (list of stage names, total seconds)
+        '''
+        best = {}
+        for name in self._order:
+            t = results.get(name, {}).get('elapsed', 0.0)
+            prev = max(((best[d][1], best[d][0]) for d in self._deps[name]),
+                       default=(0.0, []))
+            best[name] = (prev[1] + [name], prev[0] + t)
+        if not best:
+            return [], 0.0
+        return max(best.values(), key=lambda e: e[1])
+
+def load_config(path):
+    '''
+    Read a YAML (.yaml, .yml) or TOML (.toml) pipeline configuration
+    and return it as a dict
+    '''
+    ext = os.path.splitext(path)[1].lower()
+    if ext in ('.yaml', '.yml'):
+        import yaml
+        with open(path) as f:
+            return yaml.safe_load(f)
+    if ext == '.toml':
+        try:
+            import tomllib
+        except ImportError:
+            import tomli as tomllib
+        with open(path, 'rb') as f:
+            return tomllib.load(f)
+    raise ValueError(f'Unrecognized config file type {ext}')
@@ -0,0 +1,312 @@
+'''
+Dry-run cost planner for convert_sqlite_to_parquet and the variability
+writers.
+
+A few thousand rows are read from windows spread over the rowid range of
+the input (the outer table of the join, for the writers) and pushed
+through the same steps as the real job: fetch, conversion to Arrow and
+write (parquet to memory, or sqlite to a scratch file).  From the sample
+estimate
+
+    output rows           rowid span of the input * rows out per rowid
+    output bytes          from the size of the written sample
+    memory per chunk      python rows + Arrow batch + encoded output
+    wall time             at the throughput measured on the sample
+
+and recommend n_group (row groups for convert_sqlite_to_parquet) or
+chunksize and number of workers (writers) for a memory budget.
+
+Estimates are rough.  Compression ratios on a small sample are usually
+worse than on full row groups, so output size tends to be overestimated;
+time assumes parallel workers don't contend for I/O, so parallel wall
+time is a lower bound.
+'''
+import os
+import sys
+import sqlite3
+import tempfile
+from time import perf_counter
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from desc.truth_reorg.truth_reorg_utils import connect_read, READ_PROFILES
+from desc.truth_reorg.truth_reorg_utils import assemble_create_table
+
+__all__ = ['sample_windows', 'plan_convert', 'plan_writer', 'format_plan']
+
+_GBYTE = 1.0e9
+# Fraction of the memory budget a plan may use; the rest is headroom for
+# the interpreter, libraries and estimation error
+_BUDGET_FRACTION = 0.75
+_MIN_CHUNK = 1000
+_MAX_CHUNK = 1000000
+# Rowids per window used to measure rows out per rowid of a join
+_PROBE_WIDTH = 16
+
+def _python_bytes_per_row(rows):
+    '''
+    Approximate size of fetched row tuples.  Shared small ints and
+    interned strings are counted each time, so this is an upper bound
+    '''
+    if len(rows) == 0:
+        return 0.0
+    step = max(1, len(rows) // 500)
+    some = rows[::step]
+    total = sum(sys.getsizeof(r) + sum(sys.getsizeof(v) for v in r)
+                for r in some)
+    return total / len(some)
+
+def _rows_to_table(rows, names, schema=None):
+    cols = list(zip(*rows)) if rows else [[] for _ in names]
+    if schema is not None:
+        arrays = [pa.array(c, type=f.type) for (c, f) in zip(cols, schema)]
+        return pa.Table.from_arrays(arrays, schema=schema)
+    return pa.Table.from_arrays([pa.array(c) for c in cols], names=names)
+
+def _write_sample(tbl, out_format, write_options, columns=None):
+    '''
+    Write tbl as the job would.  Return (seconds, bytes written)
+    '''
+    if out_format == 'parquet':
+        sink = pa.BufferOutputStream()
+        t0 = perf_counter()
+        with pq.ParquetWriter(sink, tbl.schema, **write_options) as w:
+            w.write_table(tbl)
+        elapsed = perf_counter() - t0
+        return elapsed, sink.getvalue().size
+
+    if columns is None:
+        raise ValueError('sqlite output needs columns')
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        rows = list(zip(*[c.to_pylist() for c in tbl.columns]))
+        ins = 'insert into t VALUES (' + ','.join(['?'] * len(columns)) + ')'
+        t0 = perf_counter()
+        with sqlite3.connect(path) as conn:
+            conn.execute(assemble_create_table('t', columns))
+            conn.executemany(ins, rows)
+            conn.commit()
+        elapsed = perf_counter() - t0
+        # Subtract the size of the empty database
+        with sqlite3.connect(path) as conn:
+            page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+        nbytes = max(0, os.path.getsize(path) - 2 * page_size)
+    finally:
+        os.remove(path)
+    return elapsed, nbytes
+
+def sample_windows(conn, make_query, range_table, sample_rows=5000,
+                   n_windows=4, schema=None, out_format='parquet',
+                   write_options=None, columns=None):
+    '''
+    Run make_query((lo, hi)) (sql for rowids lo < rowid <= hi of
+    range_table) on n_windows windows spread evenly over the rowids of
+    range_table, sized to return about sample_rows rows in all, and time
+    each step.
+
+    Parameters
+    ----------
+    conn          sqlite3 connection; attach any other inputs first
+    make_query    function of a (lo, hi) tuple returning sql
+    range_table   table (may be schema-qualified) whose rowids are split
+    sample_rows   int      target number of rows to sample
+    n_windows     int      number of windows
+    schema        pyarrow schema of the output, or None to infer it
+    out_format    'parquet' or 'db'
+    write_options dict of keyword arguments for ParquetWriter
+    columns       list of (name, sqlite type); needed for out_format 'db'
+
+    Returns
+    -------
+    dict with rowid span and per-row measurements
+    '''
+    write_options = write_options or {}
+    lo, hi = conn.execute(f'select min(rowid), max(rowid) from {range_table}').fetchone()
+    if lo is None:
+        raise ValueError(f'{range_table} is empty')
+    span = hi - lo + 1
+
+    # Rows out per rowid in, from a small probe at the start
+    probe = conn.execute(make_query((lo - 1, lo - 1 + _PROBE_WIDTH))).fetchall()
+    fanout = max(len(probe), 1) / min(_PROBE_WIDTH, span)
+    width = max(1, int(sample_rows / (n_windows * fanout)))
+    starts = np.linspace(lo - 1, max(lo - 1, hi - width), n_windows)
+    starts = sorted(set(int(s) for s in starts))
+
+    rows = []
+    n_rowids = 0
+    t_fetch = 0.0
+    names = None
+    for s in starts:
+        e = min(s + width, hi)
+        t0 = perf_counter()
+        cur = conn.execute(make_query((s, e)))
+        got = cur.fetchall()
+        t_fetch += perf_counter() - t0
+        names = [d[0] for d in cur.description]
+        rows.extend(got)
+        n_rowids += e - s
+    n = len(rows)
+
+    t0 = perf_counter()
+    tbl = _rows_to_table(rows, names, schema=schema)
+    t_transform = perf_counter() - t0
+    t_write, out_bytes = _write_sample(tbl, out_format, write_options,
+                                       columns=columns)
+    per_row = (lambda x : x / n if n else 0.0)
+    return {'range_table' : range_table, 'rowid_span' : span,
+            'sample_rows' : n, 'sampled_rowids' : n_rowids,
+            'rows_per_rowid' : n / n_rowids if n_rowids else 0.0,
+            'python_bytes_per_row' : _python_bytes_per_row(rows),
+            'arrow_bytes_per_row' : per_row(tbl.nbytes),
+            'out_bytes_per_row' : per_row(out_bytes),
+            'fetch_s_per_row' : per_row(t_fetch),
+            'transform_s_per_row' : per_row(t_transform),
+            'write_s_per_row' : per_row(t_write)}
+
+def _estimates(sample, memory_gbyte):
+    total_rows = int(sample['rowid_span'] * sample['rows_per_rowid'])
+    return {'est_rows' : total_rows,
+            'est_out_gbyte' : total_rows * sample['out_bytes_per_row'] / _GBYTE,
+            'budget_gbyte' : memory_gbyte}
+
+def plan_convert(dbfile, table, memory_gbyte=4.0, sample_rows=5000,
+                 tune=False, native_read=True):
+    '''
+    Plan convert_sqlite_to_parquet(dbfile, ..., table).  Recommends the
+    smallest n_group for which one row group fits in memory_gbyte.
+
+    Returns
+    -------
+    dict of sample measurements, estimates and recommendation
+    '''
+    from desc.truth_reorg.parquet_utils import _table_schema, _low_cardinality_columns
+    from desc.truth_reorg.parquet_utils import parquet_write_options
+    from desc.truth_reorg.sqlite_arrow import HAVE_ADBC
+
+    with connect_read(dbfile, profile='scan') as conn:
+        cursor = conn.cursor()
+        column_dict, schema = _table_schema(cursor, table, dbfile)
+        write_options = {}
+        if tune:
+            low_card = _low_cardinality_columns(cursor, table, column_dict)
+            write_options = parquet_write_options(column_dict,
+                                                  low_cardinality=low_card)
+        make_query = (lambda r : f'select * from {table} where rowid > {r[0]} and rowid <= {r[1]}')
+        sample = sample_windows(conn, make_query, table,
+                                sample_rows=sample_rows, schema=schema,
+                                write_options=write_options)
+
+    plan = dict(sample)
+    plan.update(_estimates(sample, memory_gbyte))
+    # convert_sqlite_to_parquet holds a whole row group: Arrow table (twice
+    # while conforming native reads to the schema) or python rows plus the
+    # Arrow table, and the encoded row group
+    native = native_read and HAVE_ADBC
+    if native:
+        mem_per_row = 2 * sample['arrow_bytes_per_row']
+    else:
+        mem_per_row = sample['python_bytes_per_row'] + sample['arrow_bytes_per_row']
+    mem_per_row += sample['out_bytes_per_row']
+    budget = memory_gbyte * _GBYTE * _BUDGET_FRACTION
+    n_group = max(1, int(np.ceil(plan['est_rows'] * mem_per_row / budget)))
+    rows_per_group = int(np.ceil(plan['est_rows'] / n_group))
+    s_per_row = (sample['fetch_s_per_row'] + sample['transform_s_per_row'] +
+                 sample['write_s_per_row'])
+    plan.update({'job' : f'convert_sqlite_to_parquet {dbfile} {table}',
+                 'native_read' : native,
+                 'n_group' : n_group, 'rows_per_group' : rows_per_group,
+                 'group_mem_gbyte' : rows_per_group * mem_per_row / _GBYTE,
+                 'fits' : True,
+                 'est_wall_s' : plan['est_rows'] * s_per_row})
+    return plan
+
+def plan_writer(conn, make_query, range_table, columns, input_files,
+                memory_gbyte=4.0, sample_rows=5000, out_format='db',
+                read_profile='scan', max_workers=None, n_ranges=None):
+    '''
+    Plan a chunked writer (e.g. the variability writers) whose query
+    restricted to rowids (lo, hi] of range_table is make_query((lo, hi)).  Recommends chunksize and number of workers
+    for create_parallel such that all workers fit in memory_gbyte.
+
+    Parameters
+    ----------
+    conn          read connection with other inputs attached
+    columns       output (name, sqlite type) list
+    input_files   sqlite files read by the query (main and attached)
+    out_format    'db' or 'parquet'
+    read_profile  profile each worker's read connection uses; its page
+                  cache is counted once per input file, up to the size
+                  of the file
+    max_workers   at most this many workers; default cpu count
+    n_ranges      number of rowid ranges; default the number of workers
+
+    Returns
+    -------
+    dict of sample measurements, estimates and recommendation
+    '''
+    from desc.truth_reorg.parquet_utils import arrow_schema
+
+    sample = sample_windows(conn, make_query, range_table,
+                            sample_rows=sample_rows,
+                            schema=arrow_schema(columns),
+                            out_format=out_format, columns=columns)
+    plan = dict(sample)
+    plan.update(_estimates(sample, memory_gbyte))
+
+    settings = READ_PROFILES[read_profile] if isinstance(read_profile, str) else read_profile
+    cache_max = 1024 * settings.get('cache_kbyte', 2000)
+    cache_bytes = sum(min(cache_max, os.path.getsize(f)) for f in input_files)
+    # A chunk is held as fetched rows, and as an Arrow batch for parquet
+    mem_per_row = sample['python_bytes_per_row']
+    if out_format == 'parquet':
+        mem_per_row += sample['arrow_bytes_per_row'] + sample['out_bytes_per_row']
+    budget = memory_gbyte * _GBYTE * _BUDGET_FRACTION
+
+    max_workers = max_workers or os.cpu_count() or 1
+    # Each worker needs at least its cache and a minimum chunk
+    per_worker_min = cache_bytes + _MIN_CHUNK * mem_per_row
+    workers = int(max(1, min(max_workers, budget // per_worker_min)))
+    if n_ranges:
+        workers = min(workers, n_ranges)
+    chunk_budget = budget / workers - cache_bytes
+    chunksize = int(min(_MAX_CHUNK, max(_MIN_CHUNK,
+                                        chunk_budget // max(mem_per_row, 1))))
+    # No point in chunks bigger than a range
+    per_range = int(np.ceil(plan['est_rows'] / (n_ranges or workers)))
+    chunksize = min(chunksize, max(_MIN_CHUNK, per_range))
+    chunksize -= chunksize % _MIN_CHUNK
+    s_per_row = (sample['fetch_s_per_row'] + sample['transform_s_per_row'] +
+                 sample['write_s_per_row'])
+    serial_s = plan['est_rows'] * s_per_row
+    worker_mem = cache_bytes + chunksize * mem_per_row
+    plan.update({'job' : f'writer over {range_table}',
+                 'out_format' : out_format,
+                 'chunksize' : chunksize, 'max_workers' : workers,
+                 'n_ranges' : n_ranges or workers,
+                 'worker_mem_gbyte' : worker_mem / _GBYTE,
+                 'fits' : workers * worker_mem <= budget,
+                 'est_wall_s' : serial_s,
+                 'est_parallel_wall_s' : serial_s / workers})
+    return plan
+
+def format_plan(plan):
+    '''
+    Return a multi-line, human-readable summary of a plan
+    '''
+    lines = [f"Plan for {plan['job']}",
+             f"  sampled {plan['sample_rows']} rows from {plan['sampled_rowids']} of {plan['rowid_span']} rowids of {plan['range_table']}",
+             f"  per row: python {plan['python_bytes_per_row']:.0f} B, arrow {plan['arrow_bytes_per_row']:.0f} B, output {plan['out_bytes_per_row']:.1f} B",
+             f"  estimated rows {plan['est_rows']}, output {plan['est_out_gbyte']:.3g} GB",
+             f"  estimated wall time {plan['est_wall_s']:.4g} s serial"]
+    if 'n_group' in plan:
+        lines.append(f"  recommend n_group={plan['n_group']} ({plan['rows_per_group']} rows, {plan['group_mem_gbyte']:.3g} GB per group; budget {plan['budget_gbyte']} GB)")
+    else:
+        lines[-1] += f", {plan['est_parallel_wall_s']:.4g} s with {plan['max_workers']} workers"
+        lines.append(f"  recommend chunksize={plan['chunksize']} max_workers={plan['max_workers']} n_ranges={plan['n_ranges']} ({plan['worker_mem_gbyte']:.3g} GB per worker; budget {plan['budget_gbyte']} GB)")
+    if not plan['fits']:
+        lines.append('  WARNING: even the minimum settings exceed the memory budget')
+    return '\n'.join(lines)
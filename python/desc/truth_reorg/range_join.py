@@ -0,0 +1,190 @@
+'''
+Run a long sqlite join as several independent rowid ranges, one process
+per range, each writing its own output shard.
+
+The range is always taken over the table the query planner uses as the
+outer loop of the join.  Rows come out of each range in the same order
+as from the serial query, so shards concatenated in range order reproduce
+the serial output exactly; verify_against_serial checks this.
+'''
+import os
+import re
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_EXCEPTION
+
+import pyarrow.parquet as pq
+
+from desc.truth_reorg.truth_reorg_utils import connect_read
+from desc.truth_reorg.checksums import read_checksums, write_checksums
+
+__all__ = ['outer_table', 'rowid_ranges', 'run_ranges', 'RangeError',
+           'merge_sqlite_shards', 'merge_parquet_shards',
+           'verify_against_serial']
+
+class RangeError(RuntimeError):
+    '''
+    A range of run_ranges failed
+    '''
+
+_SCAN_RE = re.compile(r'^SCAN (?:TABLE )?(\S+)')
+
+def outer_table(conn, query):
+    '''
+    Return the name of the table scanned by the outer loop of query,
+    from EXPLAIN QUERY PLAN, or None if no table is scanned
+    '''
+    for row in conn.execute('EXPLAIN QUERY PLAN ' + query):
+        m = _SCAN_RE.match(row[-1])
+        if m:
+            return m.group(1)
+    return None
+
+def rowid_ranges(conn, table, n_ranges):
+    '''
+    Split rowids of table (may be schema-qualified) into at most n_ranges
+    intervals (lo, hi], lo exclusive and hi inclusive, with about the
+    same number of rows in each
+    '''
+    n_rows = conn.execute(f'select count(*) from {table}').fetchone()[0]
+    if n_rows == 0:
+        return []
+    n_ranges = max(1, min(n_ranges, n_rows))
+    lo = conn.execute(f'select min(rowid) from {table}').fetchone()[0] - 1
+    bounds = [lo]
+    for i in range(1, n_ranges):
+        offset = (i * n_rows) // n_ranges - 1
+        q = f'select rowid from {table} order by rowid limit 1 offset {offset}'
+        bounds.append(conn.execute(q).fetchone()[0])
+    bounds.append(conn.execute(f'select max(rowid) from {table}').fetchone()[0])
+    return [(bounds[i], bounds[i + 1]) for i in range(n_ranges)
+            if bounds[i + 1] > bounds[i]]
+
+def run_ranges(worker, ranges, shard_paths, max_workers=None):
+    '''
+    Call worker(shard_path, lo, hi) for each range in its own process.
+    worker must be picklable (a module-level function or a
+    functools.partial of one).  Returns the workers' return values in
+    range order.  On the first failure, ranges not yet started are
+    cancelled and RangeError naming the range is raised from it
+    '''
+    if max_workers is None:
+        max_workers = min(len(ranges), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(worker, shard, lo, hi)
+                   for (shard, (lo, hi)) in zip(shard_paths, ranges)]
+        wait(futures, return_when=FIRST_EXCEPTION)
+        for (f, shard, (lo, hi)) in zip(futures, shard_paths, ranges):
+            if f.done() and not f.cancelled() and f.exception() is not None:
+                executor.shutdown(wait=True, cancel_futures=True)
+                raise RangeError(f'Range ({lo}, {hi}] writing {shard} failed: '
+                                 f'{f.exception()}') from f.exception()
+        return [f.result() for f in futures]
+
+def _merged_checksums(shards, table=None):
+    '''
+    Sum of the checksums stored with the shards, or None if any shard
+    has none
+    '''
+    total = None
+    for shard in shards:
+        checks = read_checksums(shard, table=table)
+        if checks is None:
+            return None
+        total = checks if total is None else total.merge(checks)
+    return total
+
+def merge_sqlite_shards(shards, out_file, table, create_query):
+    '''
+    Create table in out_file and copy the rows of each shard into it,
+    in shard order.  Shard checksums, if all shards have them, are
+    summed into those of out_file
+    '''
+    checks = _merged_checksums(shards, table)
+    with sqlite3.connect(out_file) as conn:
+        conn.execute(create_query)
+        for shard in shards:
+            conn.execute(f"ATTACH DATABASE '{shard}' AS shard")
+            conn.execute(f'insert into {table} select * from shard.{table} order by rowid')
+            conn.commit()
+            conn.execute('DETACH DATABASE shard')
+        if checks is not None:
+            write_checksums(out_file, checks, table=table, conn=conn)
+
+def merge_parquet_shards(shards, out_file):
+    '''
+    Concatenate parquet shards, in order, into a single file one row
+    group at a time.  Shard checksums, if all shards have them, are
+    summed into those of out_file
+    '''
+    checks = _merged_checksums(shards)
+    writer = None
+    for shard in shards:
+        f = pq.ParquetFile(shard)
+        if writer is None:
+            writer = pq.ParquetWriter(out_file, f.schema_arrow)
+        for i in range(f.num_row_groups):
+            writer.write_table(f.read_row_group(i))
+    if writer is not None:
+        if checks is not None:
+            write_checksums(out_file, checks, writer=writer)
+        writer.close()
+
+def _iter_rows(path, table):
+    if isinstance(path, (list, tuple)) or path.endswith('.parquet'):
+        paths = path if isinstance(path, (list, tuple)) else [path]
+        for p in paths:
+            for batch in pq.ParquetFile(p).iter_batches():
+                yield from zip(*[c.to_pylist() for c in batch.columns])
+        return
+    conn = connect_read(path, profile='scan')
+    cur = conn.cursor()
+    cur.arraysize = 50000
+    cur.execute(f'select * from {table} order by rowid')
+    while True:
+        rows = cur.fetchmany()
+        if len(rows) == 0:
+            break
+        yield from rows
+    conn.close()
+
+def verify_against_serial(serial_file, parallel, table, tolerance=0.0):
+    '''
+    Compare output of the serial path (sqlite file) with parallel output:
+    a merged sqlite or parquet file, or a list of parquet shards in range
+    order.  Rows are compared in order; floats may differ by relative
+    tolerance.  sqlite stores FLOAT columns as doubles but parquet shards
+    keep them as float32, so use about 1e-7 when comparing with parquet.
+
+    Returns
+    -------
+    dict with keys serial_rows, parallel_rows, first_mismatch (row
+    number, or None) and ok
+    '''
+    def _same(a, b):
+        if len(a) != len(b):
+            return False
+        for (x, y) in zip(a, b):
+            if isinstance(x, float) and isinstance(y, float):
+                if abs(x - y) > tolerance * max(abs(x), abs(y)):
+                    return False
+            elif x != y:
+                return False
+        return True
+
+    n_serial = 0
+    n_parallel = 0
+    mismatch = None
+    it_parallel = _iter_rows(parallel, table)
+    for row in _iter_rows(serial_file, table):
+        n_serial += 1
+        other = next(it_parallel, None)
+        if other is None:
+            continue
+        n_parallel += 1
+        if mismatch is None and not _same(row, other):
+            mismatch = n_serial - 1
+    for other in it_parallel:
+        n_parallel += 1
+    return {'serial_rows' : n_serial, 'parallel_rows' : n_parallel,
+            'first_mismatch' : mismatch,
+            'ok' : mismatch is None and n_serial == n_parallel}
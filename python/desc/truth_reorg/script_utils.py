@@ -1,10 +1,18 @@
 """
 Utilities for top-level scripts
 """
+import csv
 from datetime import datetime as dt
+import functools
+import io
+import json
+import os
 import sys
+from time import perf_counter, process_time
 
-__all__ = ['print_callinfo', 'print_date', 'TIME_TO_SECOND_FMT']
+__all__ = ['print_callinfo', 'print_date', 'TIME_TO_SECOND_FMT',
+           'Instrument', 'NULL_INSTRUMENT', 'peak_rss_mbyte',
+           'current_rss_mbyte']
 
 TIME_TO_SECOND_FMT = '%Y-%m-%d %H:%M:%S'
 
@@ -35,3 +43,203 @@ def print_date(to_second=True, file=None, msg=''):
         print(dt.now().strftime(TIME_TO_SECOND_FMT), msg, file=file, flush=True)
     else:
         print(dt.now(), msg, file=file, flush=True)
+
+class _NullStage:
+    '''
+    Stand-in returned by a disabled Instrument so that instrumented code
+    costs (almost) nothing when timing is not wanted
+    '''
+    rows = 0
+    nbytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add(self, rows=0, nbytes=0):
+        pass
+
+_NULL_STAGE = _NullStage()
+
+class _Stage:
+    '''
+    Context manager timing one pass through a named stage
+    '''
+    def __init__(self, instrument, name, rows, nbytes):
+        self._instrument = instrument
+        self._name = name
+        self.rows = rows
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        self._wall0 = perf_counter()
+        self._cpu0 = process_time()
+        return self
+
+    def __exit__(self, *exc):
+        self._instrument._record(self._name, perf_counter() - self._wall0,
+                                 process_time() - self._cpu0,
+                                 self.rows, self.nbytes)
+        return False
+
+    def add(self, rows=0, nbytes=0):
+        '''
+        Count rows and bytes once they are known, e.g. after a fetch
+        '''
+        self.rows += rows
+        self.nbytes += nbytes
+
+def peak_rss_mbyte():
+    '''
+    Peak resident set size of this process in Mbytes, or None if it
+    cannot be determined on this platform
+    '''
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kbytes, macOS bytes
+    if sys.platform == 'darwin':
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+def current_rss_mbyte():
+    '''
+    Current resident set size of this process in Mbytes.  Falls back to
+    peak_rss_mbyte where /proc is not available
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return peak_rss_mbyte()
+    return resident_pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+
+class Instrument:
+    '''
+    Lightweight per-stage timers and counters for the pipeline scripts.
+
+    Typical stages are fetch, transform, extinction, write and commit.
+    For each stage accumulate number of calls, wall time, cpu time, rows
+    and bytes.  A stage whose cpu time is close to its wall time is
+    cpu-bound; one where wall time dominates is waiting on I/O.
+
+    Parameters
+    ----------
+    enabled            boolean   If False every method is a no-op
+    progress_interval  float     If set, print a progress line at most every
+                                 this many seconds
+    file                         where to print progress lines; default stdout
+    '''
+    def __init__(self, enabled=True, progress_interval=None, file=None):
+        self.enabled = enabled
+        self._progress_interval = progress_interval
+        self._file = file
+        self._stats = {}
+        self._start = perf_counter()
+        self._last_progress = self._start
+
+    def stage(self, name, rows=0, nbytes=0):
+        '''
+        Return a context manager timing the enclosed block as part of
+        stage name.  Rows and bytes may be supplied now or added later
+        with the add method of the returned object
+        '''
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name, rows, nbytes)
+
+    def timed(self, name):
+        '''
+        Decorator form of stage
+        '''
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                with _Stage(self, name, 0, 0):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def count(self, name, rows=0, nbytes=0):
+        '''
+        Add to the row and byte counters of a stage without timing anything
+        '''
+        if not self.enabled:
+            return
+        self._record(name, 0.0, 0.0, rows, nbytes, calls=0)
+
+    def _record(self, name, wall, cpu, rows, nbytes, calls=1):
+        s = self._stats.get(name)
+        if s is None:
+            s = {'calls' : 0, 'wall' : 0.0, 'cpu' : 0.0, 'rows' : 0,
+                 'bytes' : 0}
+            self._stats[name] = s
+        s['calls'] += calls
+        s['wall'] += wall
+        s['cpu'] += cpu
+        s['rows'] += rows
+        s['bytes'] += nbytes
+
+        if self._progress_interval is not None:
+            now = perf_counter()
+            if now - self._last_progress >= self._progress_interval:
+                self._last_progress = now
+                self.print_progress()
+
+    def summary(self):
+        '''
+        Return list of dicts, one per stage, in order of first use
+        '''
+        out = []
+        for (name, s) in self._stats.items():
+            wall = s['wall']
+            out.append({'stage' : name, 'calls' : s['calls'],
+                        'wall_s' : round(wall, 6), 'cpu_s' : round(s['cpu'], 6),
+                        'cpu_fraction' : round(s['cpu']/wall, 3) if wall > 0 else None,
+                        'rows' : s['rows'], 'bytes' : s['bytes'],
+                        'rows_per_s' : round(s['rows']/wall, 1) if wall > 0 else None})
+        return out
+
+    def print_progress(self):
+        elapsed = perf_counter() - self._start
+        parts = [f'{d["stage"]}: {d["rows"]} rows {d["wall_s"]:.1f}s'
+                 for d in self.summary()]
+        print_date(file=self._file,
+                   msg=f'[{elapsed:.0f}s] ' + '; '.join(parts))
+
+    def report(self, path=None, fmt='json'):
+        '''
+        Write summary to path (or print it if path is None) as json or csv.
+        The json form also includes total elapsed time and peak RSS.
+        '''
+        if not self.enabled:
+            return
+        stages = self.summary()
+        if fmt == 'json':
+            content = json.dumps({'elapsed_s' : round(perf_counter() - self._start, 3),
+                                  'peak_rss_mbyte' : peak_rss_mbyte(),
+                                  'stages' : stages}, indent=2)
+        elif fmt == 'csv':
+            buf = io.StringIO()
+            fields = ['stage', 'calls', 'wall_s', 'cpu_s', 'cpu_fraction',
+                      'rows', 'bytes', 'rows_per_s']
+            w = csv.DictWriter(buf, fieldnames=fields)
+            w.writeheader()
+            w.writerows(stages)
+            content = buf.getvalue()
+        else:
+            raise ValueError(f'Unknown report format {fmt}')
+
+        if path is None:
+            print(content, flush=True)
+        else:
+            with open(path, 'w') as f:
+                f.write(content)
+
+NULL_INSTRUMENT = Instrument(enabled=False)
@@ -1,6 +1,6 @@
 import numpy as np
 import lsst.sphgeom
-import astropy.units as u
+from desc.truth_reorg.coverage import Coverage, INSIDE, BOUNDARY
 
 __all__ = ['Region', 'DC2_RA_MID', 'DC2_RA_NE', 'DC2_DEC_NE', 'DC2_DEC_S']
 
@@ -9,8 +9,23 @@ DC2_RA_NE = 71.46
 DC2_DEC_NE = -27.25
 DC2_DEC_S = -44.33
 class Region:
+    '''
+    Parameters
+    ----------
+    ra_mid         float  RA of the center line, degrees
+    ne_corner      tuple  (ra, dec) of the north-east corner, degrees
+    dec_range      tuple  (south, north) dec, degrees
+    use_coverage   bool   if true (and healpy is available) classify
+                          points with a cached HEALPix coverage map and
+                          do the exact polygon test only for points near
+                          the edges; see coverage
+    max_order      int    deepest order of the coverage map
+    cache_dir      string where coverage maps are cached; default
+                          coverage.coverage_cache_dir()
+    '''
     def __init__(self, ra_mid=DC2_RA_MID, ne_corner=(DC2_RA_NE, DC2_DEC_NE),
-                 dec_range=(DC2_DEC_S, DC2_DEC_NE)):
+                 dec_range=(DC2_DEC_S, DC2_DEC_NE), use_coverage=True,
+                 max_order=12, cache_dir=None):
         self._ra_mid = ra_mid
         ra0 = ne_corner[0]
         cos_dec0 = np.cos(np.radians(ne_corner[1]))
@@ -23,6 +38,26 @@ class Region:
             self.region_corners.extend([(ra_mid - dra, dec),
                                         (ra_mid + dra, dec)])
         self.region_polygon = self.get_convex_polygon(self.region_corners)
+        self._use_coverage = use_coverage
+        self._max_order = max_order
+        self._cache_dir = cache_dir
+        self._coverage = None
+
+    @property
+    def coverage(self):
+        '''
+        Coverage map of the region, loaded or built on first use.  None
+        if not wanted or healpy is not available
+        '''
+        if self._coverage is None and self._use_coverage:
+            try:
+                self._coverage = Coverage.cached(self.region_corners,
+                                                 max_order=self._max_order,
+                                                 cache_dir=self._cache_dir)
+            except ImportError:
+                print('healpy not available; using polygon test for all points')
+                self._use_coverage = False
+        return self._coverage
 
     @staticmethod
     def DDFRegion():
@@ -44,11 +79,23 @@ class Region:
         '''
         Given parallel arrays ra, dec representing points, return a mask
         with an entry set to True if that ra, dec in inside the region.
-        Use sphgeom ConvexPolygon routine
+        Points in coverage pixels wholly inside or outside are decided by
+        pixel lookup, the rest by the sphgeom ConvexPolygon routine
         '''
+        ra = np.asarray(ra, dtype=np.float64)
+        dec = np.asarray(dec, dtype=np.float64)
         if degrees:
-            # convert to radians
-            ra = [(r * u.degree).to_value(u.radian) for r in ra]
-            dec = [(d * u.degree).to_value(u.radian) for d in dec]
+            ra_deg, dec_deg = ra, dec
+            ra, dec = np.radians(ra), np.radians(dec)
+        else:
+            ra_deg, dec_deg = np.degrees(ra), np.degrees(dec)
 
-        return self.region_polygon.contains(ra, dec)
+        coverage = self.coverage
+        if coverage is None:
+            return np.asarray(self.region_polygon.contains(ra, dec), dtype=bool)
+        code = coverage.classify(ra_deg, dec_deg)
+        mask = code == INSIDE
+        edge = np.flatnonzero(code == BOUNDARY)
+        if len(edge) > 0:
+            mask[edge] = self.region_polygon.contains(ra[edge], dec[edge])
+        return mask
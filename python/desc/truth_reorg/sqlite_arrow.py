@@ -0,0 +1,187 @@
+'''
+Read sqlite query results directly into Arrow record batches.
+
+If the ADBC sqlite driver (package adbc_driver_sqlite) is installed, rows
+are stepped through and stored in typed Arrow buffers in C; no Python
+object is created per value.  Otherwise fall back to the sqlite3 module
+(tuples per row) and convert each chunk, so callers need not care which
+is available.
+'''
+import sys
+import tracemalloc
+from time import perf_counter
+
+import pyarrow as pa
+
+from desc.truth_reorg.truth_reorg_utils import connect_read, read_profile_pragmas
+from desc.truth_reorg.parquet_utils import rows_to_batch
+
+try:
+    import adbc_driver_sqlite.dbapi as adbc_sqlite
+    HAVE_ADBC = True
+except ImportError:
+    HAVE_ADBC = False
+
+__all__ = ['SqliteArrowReader', 'HAVE_ADBC', 'measure_extraction']
+
+_BATCH_ROWS_OPTION = 'adbc.sqlite.query.batch_rows'
+
+def _conform(batch, schema):
+    '''
+    Cast batch to schema.  ADBC infers column types from values (INTEGER
+    -> int64, REAL -> double, TEXT -> string); schema may want narrower
+    types or an int id stored as TEXT
+    '''
+    if schema is None or batch.schema == schema:
+        return batch
+    tbl = pa.Table.from_batches([batch]).rename_columns(schema.names)
+    return tbl.cast(schema).combine_chunks().to_batches()[0]
+
+class SqliteArrowReader:
+    '''
+    Read-only connection to an sqlite file returning query results as
+    pyarrow RecordBatches.
+
+    Parameters
+    ----------
+    path        string   sqlite file
+    use_adbc    boolean  use the ADBC driver if available (default True).
+                         If False always use the sqlite3 tuple path
+    profile     read profile for the sqlite3 path; see connect_read
+    '''
+    def __init__(self, path, use_adbc=True, profile='scan'):
+        self._path = path
+        self.native = use_adbc and HAVE_ADBC
+        if self.native:
+            self._conn = adbc_sqlite.connect(f'file:{path}?mode=ro')
+            cur = self._conn.cursor()
+            for stmt in read_profile_pragmas(path, profile):
+                cur.execute(stmt)
+            cur.close()
+        else:
+            self._conn = connect_read(path, profile=profile)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def attach(self, path, alias):
+        '''
+        Attach another database file as alias
+        '''
+        cur = self._conn.cursor()
+        cur.execute(f"ATTACH DATABASE '{path}' AS {alias}")
+        cur.close()
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def batches(self, query, schema=None, batch_rows=65536, parameters=None):
+        '''
+        Generator yielding RecordBatches of at most batch_rows rows from
+        query.  If schema is supplied, batches are cast to it (column
+        names are taken from schema, by position); it is required for
+        the fallback path to give well-defined types.
+        '''
+        cur = self._conn.cursor()
+        if self.native:
+            try:
+                cur.adbc_statement.set_options(
+                    **{_BATCH_ROWS_OPTION : str(batch_rows)})
+            except Exception:
+                pass
+            cur.execute(query, parameters)
+            for batch in cur.fetch_record_batch():
+                if batch.num_rows > 0:
+                    yield _conform(batch, schema)
+            cur.close()
+            return
+
+        cur.arraysize = batch_rows
+        if parameters is None:
+            cur.execute(query)
+        else:
+            cur.execute(query, parameters)
+        while True:
+            rows = cur.fetchmany()
+            if len(rows) == 0:
+                break
+            if schema is None:
+                names = [d[0] for d in cur.description]
+                yield pa.RecordBatch.from_arrays(
+                    [pa.array(c) for c in zip(*rows)], names=names)
+            else:
+                yield rows_to_batch(rows, schema)
+        cur.close()
+
+    def table(self, query, schema=None, batch_rows=65536, parameters=None):
+        '''
+        Whole result of query as a pyarrow Table
+        '''
+        batches = list(self.batches(query, schema=schema,
+                                    batch_rows=batch_rows,
+                                    parameters=parameters))
+        if len(batches) == 0:
+            if schema is None:
+                raise ValueError('Empty result and no schema supplied')
+            return schema.empty_table()
+        return pa.Table.from_batches(batches)
+
+def measure_extraction(path, query, schema=None, batch_rows=65536):
+    '''
+    Run query via the tuple path and, if available, the native path.
+    For each report rows, wall time, rows/s, peak traced Python memory
+    and net Python blocks allocated (sys.getallocatedblocks, a proxy for
+    per-value object churn).
+
+    Returns
+    -------
+    dict keyed by 'tuple' and (if ADBC is installed) 'native'
+    '''
+    report = {}
+    modes = [('tuple', False)]
+    if HAVE_ADBC:
+        modes.append(('native', True))
+    for (label, use_adbc) in modes:
+        # Time without tracing, then repeat to measure allocations
+        with SqliteArrowReader(path, use_adbc=use_adbc) as reader:
+            t0 = perf_counter()
+            n = 0
+            for batch in reader.batches(query, schema=schema,
+                                        batch_rows=batch_rows):
+                n += batch.num_rows
+            wall = perf_counter() - t0
+        with SqliteArrowReader(path, use_adbc=use_adbc) as reader:
+            tracemalloc.start()
+            blocks0 = sys.getallocatedblocks()
+            max_blocks = 0
+            for batch in reader.batches(query, schema=schema,
+                                        batch_rows=batch_rows):
+                max_blocks = max(max_blocks,
+                                 sys.getallocatedblocks() - blocks0)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        report[label] = {'rows' : n, 'wall_s' : round(wall, 4),
+                         'rows_per_s' : round(n / wall, 1) if wall > 0 else None,
+                         'peak_py_mbyte' : round(peak / 2**20, 2),
+                         'max_py_blocks' : max_blocks}
+    return report
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Compare tuple and Arrow-native sqlite extraction')
+    parser.add_argument('dbfile', help='sqlite file')
+    parser.add_argument('--table', default='truth_summary',
+                        help='read all columns of this table')
+    parser.add_argument('--batch-rows', type=int, default=65536)
+
+    args = parser.parse_args()
+    for (k, v) in measure_extraction(args.dbfile, f'select * from {args.table}',
+                                     batch_rows=args.batch_rows).items():
+        print(k, v)
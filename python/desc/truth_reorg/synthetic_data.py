@@ -0,0 +1,320 @@
+'''
+Generate small, DC2-like synthetic inputs for the truth_reorg scripts so
+that they can be exercised and benchmarked without access to the real
+(multi-GB) files.  Table and column names match those the scripts expect.
+Output is fully determined by the sizes and the seed.
+'''
+import os
+import sqlite3
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from desc.truth_reorg.truth_reorg_utils import assemble_create_table
+
+__all__ = ['generate_sn_inputs', 'generate_star_inputs',
+           'generate_galaxy_inputs', 'generate_dust_maps', 'generate_all',
+           'SN_SUMMARY_FILE',
+           'SN_PARAMS_FILE', 'STAR_SUMMARY_FILE', 'STAR_LC_STATS_FILE',
+           'STAR_VAR_FILE']
+
+SN_SUMMARY_FILE = 'sum_variable-31mar.db'
+SN_PARAMS_FILE = 'sne_cosmoDC2_v1.1.4_MS_DDF.db'
+STAR_SUMMARY_FILE = 'star_truth_summary_trimmed.db'
+STAR_LC_STATS_FILE = 'star_lc_stats_trimmed.db'
+STAR_VAR_FILE = 'star_variability_truth_indexed.db'
+
+_BANDS = ('u', 'g', 'r', 'i', 'z', 'y')
+
+# Points are scattered over a box somewhat larger than the DC2 footprint
+# so that trimming has something to do
+_RA_RANGE = (48.0, 76.0)
+_DEC_RANGE = (-46.0, -25.0)
+_MJD_RANGE = (59580.0, 61406.0)
+
+_OLD_SUMMARY_COLUMNS = [('id', 'TEXT'), ('host_galaxy', 'BIGINT'),
+                        ('ra', 'DOUBLE'), ('dec', 'DOUBLE'),
+                        ('redshift', 'FLOAT'), ('is_variable', 'INT'),
+                        ('is_pointsource', 'INT')] + \
+                        [(f'flux_{b}', 'FLOAT') for b in _BANDS] + \
+                        [(f'flux_{b}_noMW', 'FLOAT') for b in _BANDS]
+
+_SNE_PARAMS_COLUMNS = [('snid_in', 'TEXT'), ('snra_in', 'DOUBLE'),
+                       ('sndec_in', 'DOUBLE'), ('z_in', 'DOUBLE'),
+                       ('c_in', 'DOUBLE'), ('mB', 'DOUBLE'),
+                       ('t0_in', 'DOUBLE'), ('x0_in', 'DOUBLE'),
+                       ('x1_in', 'DOUBLE')]
+
+_VARIABILITY_COLUMNS = [('id', 'TEXT'), ('obsHistID', 'INT'),
+                        ('MJD', 'DOUBLE'), ('bandpass', 'TEXT'),
+                        ('delta_flux', 'FLOAT')]
+
+_LC_STATS_COLUMNS = [('id', 'TEXT'), ('model', 'TEXT')] + \
+                    [(f'mean_{b}', 'FLOAT') for b in _BANDS] + \
+                    [(f'stdev_{b}', 'FLOAT') for b in _BANDS]
+
+_STAR_MODELS = ('applyRRly', 'applyParametrizedLightCurve', 'MLT', 'None')
+
+def _write_table(path, table_name, columns, rows, indexes=()):
+    '''
+    Create table_name in sqlite file path and fill it from iterable rows.
+    indexes is a list of (index_name, column_name)
+    '''
+    with sqlite3.connect(path) as conn:
+        conn.execute(assemble_create_table(table_name, columns))
+        ins = f'insert into {table_name} VALUES (' + \
+              ','.join(['?'] * len(columns)) + ')'
+        conn.executemany(ins, rows)
+        for (ix_name, col) in indexes:
+            conn.execute(f'create index {ix_name} on {table_name}({col})')
+        conn.commit()
+
+def _remove_existing(paths):
+    for p in paths:
+        if os.path.exists(p):
+            os.remove(p)
+
+def _positions(rng, n):
+    ra = rng.uniform(*_RA_RANGE, n)
+    dec = rng.uniform(*_DEC_RANGE, n)
+    return ra, dec
+
+def _variability_rows(rng, ids, n_obs, t0=None):
+    '''
+    Generator of variability rows, n_obs per object, ordered by object.
+    If t0 is supplied observations cluster around it as for a transient.
+    '''
+    obs_hist = 0
+    for i, id_str in enumerate(ids):
+        if t0 is None:
+            mjd = np.sort(rng.uniform(*_MJD_RANGE, n_obs))
+        else:
+            mjd = np.sort(t0[i] + rng.uniform(-20.0, 100.0, n_obs))
+        bands = rng.integers(0, len(_BANDS), n_obs)
+        delta = rng.normal(0.0, 50.0, n_obs).astype(np.float32)
+        hist = obs_hist + np.arange(n_obs)
+        obs_hist += n_obs
+        for j in range(n_obs):
+            yield (id_str, int(hist[j]), float(mjd[j]), _BANDS[bands[j]],
+                   float(delta[j]))
+
+def generate_sn_inputs(out_dir, n_sn=10000, n_obs=20, seed=42):
+    '''
+    Create the SN inputs for trim_sn_summary.py, complete_sn_summary.py
+    and make_sn_variability.py:
+        SN_SUMMARY_FILE   tables truth_summary and sn_variability_truth
+        SN_PARAMS_FILE    table sne_params, same row order as truth_summary
+
+    Parameters
+    ----------
+    out_dir   string    directory for output files (must exist)
+    n_sn      int       number of SNe
+    n_obs     int       number of variability rows per SN
+    seed      int       random seed
+
+    Returns
+    -------
+    dict of file paths keyed by role
+    '''
+    rng = np.random.default_rng(seed)
+    summ_path = os.path.join(out_dir, SN_SUMMARY_FILE)
+    params_path = os.path.join(out_dir, SN_PARAMS_FILE)
+    _remove_existing([summ_path, params_path])
+
+    ra, dec = _positions(rng, n_sn)
+    # About 5% of ids belong to Run3.1i and will be excluded by the trim
+    prefix = rng.choice(np.array(['MS', 'mDDF', 'hl_mddf']), n_sn,
+                        p=[0.95, 0.03, 0.02])
+    ids = [f'{prefix[i]}_{9556 + i % 50}_{i}' for i in range(n_sn)]
+    # Mostly real hosts; a few hostless SNe get a small host id
+    host = np.where(rng.random(n_sn) < 0.9,
+                    rng.integers(100000, 10**10, n_sn),
+                    rng.integers(0, 100000, n_sn))
+    z = rng.uniform(0.01, 1.2, n_sn)
+    t0 = rng.uniform(*_MJD_RANGE, n_sn)
+
+    summ_rows = ((ids[i], int(host[i]), float(ra[i]), float(dec[i]),
+                  float(z[i]), 1, 1) + (0.0,) * 12 for i in range(n_sn))
+    _write_table(summ_path, 'truth_summary', _OLD_SUMMARY_COLUMNS, summ_rows)
+    _write_table(summ_path, 'sn_variability_truth', _VARIABILITY_COLUMNS,
+                 _variability_rows(rng, ids, n_obs, t0=t0),
+                 indexes=[('sn_var_id_ix', 'id')])
+
+    c = rng.normal(0.0, 0.1, n_sn)
+    mB = rng.uniform(18.0, 26.0, n_sn)
+    x0 = rng.uniform(1.0e-6, 1.0e-4, n_sn)
+    x1 = rng.normal(0.0, 1.0, n_sn)
+    params_rows = ((ids[i], float(ra[i]), float(dec[i]), float(z[i]),
+                    float(c[i]), float(mB[i]), float(t0[i]), float(x0[i]),
+                    float(x1[i])) for i in range(n_sn))
+    _write_table(params_path, 'sne_params', _SNE_PARAMS_COLUMNS, params_rows)
+
+    return {'sn_summary' : summ_path, 'sn_params' : params_path,
+            'sn_variability' : summ_path}
+
+def generate_star_inputs(out_dir, n_star=10000, n_obs=20, seed=43):
+    '''
+    Create the star inputs for make_star_summary.py,
+    make_star_variability.py and trim_to_region.py:
+        STAR_SUMMARY_FILE    table truth_summary (id is numeric TEXT)
+        STAR_LC_STATS_FILE   table stellar_variability_stats, same order
+        STAR_VAR_FILE        table stellar_variability_truth, indexed on id
+
+    Parameters as for generate_sn_inputs.  Returns dict of file paths.
+    '''
+    rng = np.random.default_rng(seed)
+    summ_path = os.path.join(out_dir, STAR_SUMMARY_FILE)
+    stats_path = os.path.join(out_dir, STAR_LC_STATS_FILE)
+    var_path = os.path.join(out_dir, STAR_VAR_FILE)
+    _remove_existing([summ_path, stats_path, var_path])
+
+    ra, dec = _positions(rng, n_star)
+    ids = [str(i) for i in np.sort(rng.choice(41021613038, n_star,
+                                              replace=False))]
+    flux = rng.lognormal(5.0, 2.0, (len(_BANDS), n_star)).astype(np.float32)
+    summ_rows = ((ids[i], -1, float(ra[i]), float(dec[i]), 0.0, 1, 1) +
+                 tuple(float(f) for f in flux[:, i]) * 2
+                 for i in range(n_star))
+    _write_table(summ_path, 'truth_summary', _OLD_SUMMARY_COLUMNS, summ_rows)
+
+    model = rng.choice(np.array(_STAR_MODELS), n_star)
+    mean = rng.normal(0.0, 0.01, (len(_BANDS), n_star))
+    stdev = rng.exponential(0.002, (len(_BANDS), n_star))
+    stats_rows = ((ids[i], str(model[i])) +
+                  tuple(float(m) for m in mean[:, i]) +
+                  tuple(float(s) for s in stdev[:, i]) for i in range(n_star))
+    _write_table(stats_path, 'stellar_variability_stats', _LC_STATS_COLUMNS,
+                 stats_rows)
+
+    _write_table(var_path, 'stellar_variability_truth', _VARIABILITY_COLUMNS,
+                 _variability_rows(rng, ids, n_obs),
+                 indexes=[('id_idx', 'id')])
+
+    return {'star_summary' : summ_path, 'star_lc_stats' : stats_path,
+            'star_variability' : var_path}
+
+def _galaxy_schema():
+    fields = [('id', pa.int64()), ('host_galaxy', pa.int64()),
+              ('ra', pa.float64()), ('dec', pa.float64()),
+              ('redshift', pa.float32()), ('is_variable', pa.int32()),
+              ('is_pointsource', pa.int32())]
+    fields += [(f'flux_{b}', pa.float32()) for b in _BANDS]
+    fields += [(f'flux_{b}_noMW', pa.float32()) for b in _BANDS]
+    return pa.schema(fields)
+
+def generate_galaxy_inputs(out_dir, pixels=(9556,), n_per_pixel=10000,
+                           row_group_size=None, seed=44):
+    '''
+    Create galaxy truth_summary_hp<pixel>.parquet files of the form
+    read by add_avrv.py.  Positions are not restricted to the pixel.
+
+    Parameters
+    ----------
+    out_dir         string  directory for output files (must exist)
+    pixels          list    healpix pixel numbers; one file per pixel
+    n_per_pixel     int     rows per file
+    row_group_size  int     rows per row group; default n_per_pixel/4
+    seed            int     random seed
+
+    Returns
+    -------
+    list of file paths
+    '''
+    rng = np.random.default_rng(seed)
+    schema = _galaxy_schema()
+    if row_group_size is None:
+        row_group_size = max(1, n_per_pixel // 4)
+    paths = []
+    for hp in pixels:
+        ra, dec = _positions(rng, n_per_pixel)
+        cols = {'id' : np.arange(n_per_pixel, dtype=np.int64) + hp * 10**7,
+                'host_galaxy' : np.full(n_per_pixel, -1, dtype=np.int64),
+                'ra' : ra, 'dec' : dec,
+                'redshift' : rng.uniform(0.0, 3.0, n_per_pixel).astype(np.float32),
+                'is_variable' : np.zeros(n_per_pixel, dtype=np.int32),
+                'is_pointsource' : np.zeros(n_per_pixel, dtype=np.int32)}
+        for b in _BANDS:
+            f = rng.lognormal(3.0, 2.0, n_per_pixel).astype(np.float32)
+            cols[f'flux_{b}'] = f
+            cols[f'flux_{b}_noMW'] = f * np.float32(1.1)
+        tbl = pa.Table.from_arrays([pa.array(cols[f.name], f.type)
+                                    for f in schema], schema=schema)
+        path = os.path.join(out_dir, f'truth_summary_hp{hp}.parquet')
+        pq.write_table(tbl, path, row_group_size=row_group_size)
+        paths.append(path)
+
+    return paths
+
+def generate_all(out_dir, n_objects=10000, n_obs=20, pixels=(9556,),
+                 seed=42):
+    '''
+    Generate SN, star and galaxy inputs of the given size in out_dir,
+    and small dust maps.  Return dict of paths (galaxy files under key
+    'galaxy', map directory under 'dust_map_dir')
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    paths = generate_sn_inputs(out_dir, n_sn=n_objects, n_obs=n_obs,
+                               seed=seed)
+    paths.update(generate_star_inputs(out_dir, n_star=n_objects,
+                                      n_obs=n_obs, seed=seed + 1))
+    paths['galaxy'] = generate_galaxy_inputs(out_dir, pixels=pixels,
+                                             n_per_pixel=n_objects,
+                                             seed=seed + 2)
+    paths['dust_map_dir'] = generate_dust_maps(out_dir, seed=seed + 3)
+    return paths
+
+def _fits_card(key, value):
+    if isinstance(value, bool):
+        value = 'T' if value else 'F'
+    return f'{key:<8}= {value:>20}'.ljust(80)
+
+def generate_dust_maps(out_dir, size=64, seed=44):
+    '''
+    Write small north and south galactic pole E(B-V) maps in the layout
+    of the SFD files (see dust_map), so that dust_engine='sfd' can run
+    without the real maps.  Values are smooth in galactic latitude with
+    some noise.  Return the map directory
+    '''
+    from desc.truth_reorg.dust_map import _NORTH_FILE, _SOUTH_FILE
+
+    map_dir = os.path.join(out_dir, 'DustMaps')
+    os.makedirs(map_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    half = size / 2.0
+    y, x = np.mgrid[0:size, 0:size]
+    # Distance from the pole, 0 at the centre, 1 at the equator
+    r = np.hypot(x - half + 0.5, y - half + 0.5) / half
+    for (name, nsgp) in ((_NORTH_FILE, 1), (_SOUTH_FILE, -1)):
+        ebv = 0.01 + 0.05 * r**4 + rng.uniform(0.0, 0.005, r.shape)
+        cards = [_fits_card('SIMPLE', True), _fits_card('BITPIX', -32),
+                 _fits_card('NAXIS', 2), _fits_card('NAXIS1', size),
+                 _fits_card('NAXIS2', size), _fits_card('CRPIX1', half + 0.5),
+                 _fits_card('CRPIX2', half + 0.5),
+                 _fits_card('LAM_NSGP', nsgp), _fits_card('LAM_SCAL', half),
+                 'END'.ljust(80)]
+        header = ''.join(cards).encode('ascii')
+        header += b' ' * (-len(header) % 2880)
+        data = ebv.astype('>f4').tobytes()
+        data += b'\0' * (-len(data) % 2880)
+        with open(os.path.join(map_dir, name), 'wb') as f:
+            f.write(header + data)
+    return map_dir
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Write synthetic DC2-like inputs for the truth_reorg scripts')
+    parser.add_argument('out_dir', help='directory for generated files')
+    parser.add_argument('--n-objects', type=int, default=10000,
+                        help='number of SNe, stars and galaxies per pixel')
+    parser.add_argument('--n-obs', type=int, default=20,
+                        help='variability rows per SN or star')
+    parser.add_argument('--pixels', type=int, nargs='*', default=[9556],
+                        help='healpix pixels for galaxy files')
+    parser.add_argument('--seed', type=int, default=42)
+
+    args = parser.parse_args()
+    for (k, v) in generate_all(args.out_dir, n_objects=args.n_objects,
+                               n_obs=args.n_obs, pixels=args.pixels,
+                               seed=args.seed).items():
+        print(k, ': ', v)
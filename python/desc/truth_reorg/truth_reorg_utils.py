@@ -1,13 +1,179 @@
+import os
+import queue
 import sqlite3
+import threading
+from contextlib import contextmanager
 import numpy as np
 
-def connect_read(path):
+# Settings for read-only connections.
+#   mmap         if True, set mmap_size to the file size so pages are read
+#                through the OS page cache rather than read() calls.  sqlite
+#                caps this at its compile-time maximum (typically 2 GB)
+#   cache_kbyte  size of sqlite's own page cache
+#   temp_store   where sorts and temporary indexes go (MEMORY or FILE)
+#   immutable    promise the file will not change while open; sqlite then
+#                skips locking and change detection.  Only for frozen inputs
+READ_PROFILES = {'default' : {},
+                 'scan' : {'mmap' : True, 'cache_kbyte' : 1048576,
+                           'temp_store' : 'MEMORY'},
+                 'frozen' : {'mmap' : True, 'cache_kbyte' : 1048576,
+                             'temp_store' : 'MEMORY', 'immutable' : True}}
+
+def read_profile_pragmas(path, profile, schema='main'):
+    '''
+    Return list of PRAGMA statements implementing profile (a name from
+    READ_PROFILES or a dict of the same form) for schema, which is 'main'
+    or the alias of an attached database whose file is path
+    '''
+    settings = READ_PROFILES[profile] if isinstance(profile, str) else profile
+    stmts = []
+    if settings.get('mmap'):
+        stmts.append(f'PRAGMA {schema}.mmap_size={os.path.getsize(path)}')
+    if 'cache_kbyte' in settings:
+        stmts.append(f'PRAGMA {schema}.cache_size=-{int(settings["cache_kbyte"])}')
+    if 'temp_store' in settings:
+        stmts.append(f'PRAGMA temp_store={settings["temp_store"]}')
+    return stmts
+
+def apply_read_profile(conn, path, profile, schema='main'):
+    '''
+    Apply read profile to schema of sqlite3 connection conn; see
+    read_profile_pragmas
+    '''
+    for stmt in read_profile_pragmas(path, profile, schema=schema):
+        conn.execute(stmt)
+
+def read_uri(path, profile='default'):
+    '''
+    URI opening sqlite file path read-only, and immutable if profile says
+    so.  Use with connections made with uri=True, for the main database
+    or in ATTACH
+    '''
+    settings = READ_PROFILES[profile] if isinstance(profile, str) else profile
+    uri = f'file:{path}?mode=ro'
+    if settings.get('immutable'):
+        uri += '&immutable=1'
+    return uri
+
+def connect_read(path, profile='default', check_same_thread=True):
     '''
     Not obvious how to connect read-only to SQLite db. Package it up here
+
+    profile   name of entry in READ_PROFILES, or dict of the same form.
+              Use 'scan' for big sequential reads and 'frozen' for large
+              inputs known not to change while the job runs
     '''
-    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    conn = sqlite3.connect(read_uri(path, profile), uri=True,
+                           check_same_thread=check_same_thread)
+    apply_read_profile(conn, path, profile)
     return conn
 
+class ReadConnectionPool:
+    '''
+    A fixed number of read-only connections to main_path, each with the
+    same databases attached and schemas already parsed, to be checked out
+    by workers processing ranges of ids or rowids instead of each
+    reconnecting and re-attaching.
+
+    Parameters
+    ----------
+    main_path     string  sqlite file for the main schema
+    attachments   dict    alias -> path of databases to attach, e.g.
+                          {'var' : var_file} or {'params' : sn_params}
+    size          int     number of connections
+    profile               read profile; see connect_read
+
+    Connections are created lazily, up to size.  They may be used from any
+    thread but by only one at a time.  sqlite connections cannot be shared
+    across processes; use shared_pool in each worker process.
+    '''
+    def __init__(self, main_path, attachments=None, size=4, profile='scan'):
+        self._main_path = main_path
+        self._attachments = dict(attachments) if attachments else {}
+        self._size = size
+        self._profile = profile
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _new_connection(self):
+        conn = connect_read(self._main_path, profile=self._profile,
+                            check_same_thread=False)
+        # Attached files are opened read-only (and immutable) like main
+        for (alias, path) in self._attachments.items():
+            conn.execute(f'ATTACH DATABASE ? AS {alias}',
+                         (read_uri(path, self._profile),))
+            apply_read_profile(conn, path, self._profile, schema=alias)
+        # Force schema parse now rather than on first real query
+        for alias in ['main'] + list(self._attachments.keys()):
+            conn.execute(f'select count(*) from {alias}.sqlite_master').fetchone()
+        return conn
+
+    def acquire(self, timeout=None):
+        if self._closed:
+            raise RuntimeError('Connection pool is closed')
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self._size:
+                self._created += 1
+                make_new = True
+            else:
+                make_new = False
+        if make_new:
+            try:
+                return self._new_connection()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        return self._idle.get(timeout=timeout)
+
+    def release(self, conn):
+        if self._closed:
+            conn.close()
+        else:
+            self._idle.put(conn)
+
+    @contextmanager
+    def connection(self, timeout=None):
+        '''
+        Context manager checking a connection out of the pool
+        '''
+        conn = self.acquire(timeout=timeout)
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+_SHARED_POOLS = {}
+
+def shared_pool(main_path, attachments=None, size=1, profile='scan'):
+    '''
+    Return a ReadConnectionPool for these arguments, creating it on first
+    use in this process and reusing it afterwards.  Intended for worker
+    processes which handle many ranges: each attaches once, not per range.
+    '''
+    key = (os.getpid(), main_path,
+           tuple(sorted((attachments or {}).items())), repr(profile))
+    pool = _SHARED_POOLS.get(key)
+    if pool is None:
+        pool = ReadConnectionPool(main_path, attachments=attachments,
+                                  size=size, profile=profile)
+        _SHARED_POOLS[key] = pool
+    return pool
+
 def assemble_create_table(table_name, columns):
     '''
     Return string which will create table with supplied names
@@ -42,3 +208,11 @@ def make_sn_int_id(host):
         new_id = host * 1024 + _SN_OBJECT_TYPE
 
     return new_id
+
+def make_sn_int_ids(host):
+    '''
+    Vectorized make_sn_int_id for a numpy array of host ids
+    '''
+    host = np.asarray(host, dtype=np.int64)
+    return np.where(host < 100000, host + (_MAX_STAR_ID + 1),
+                    host * 1024 + _SN_OBJECT_TYPE)
@@ -0,0 +1,473 @@
+'''
+Task queue on a shared filesystem, for running the same work (healpix
+pixels, shards, ...) on several nodes with several processes each,
+without a message broker.
+
+A queue is a directory
+    queue.json                     settings, written when the queue is made
+    pending/<task>.json            tasks not yet claimed
+    claimed/<task>@<worker>.json   tasks being worked on, and by whom
+    done/<task>.json               finished tasks
+    failed/<task>.json             tasks which failed max_attempts times
+    ledger/<worker>.jsonl          one line per attempt made by worker
+
+Every change of state is a rename, which is atomic on POSIX filesystems
+(including NFS and Lustre): a worker claims a task by renaming it from
+pending/ to claimed/, and if several try only one succeeds.  While a task
+runs its worker touches the claim file every heartbeat_s seconds.  A claim
+not touched for timeout_s (worker killed, node lost) is taken over by the
+next idle worker, also by rename.  Claim ages come from file mtimes, set
+by the file server, so timeout_s should be well above heartbeat_s plus
+any clock skew between nodes.  A slow worker may lose its claim and the
+task then runs twice, so tasks must be idempotent (write their output
+under a temporary name and rename it, say).
+
+Each worker appends only to its own ledger file, so no locking is needed.
+
+From the command line, make the queue once, then start the same command
+on every node:
+
+    python -m desc.truth_reorg.work_queue create $Q --tasks 9556 9557 9558
+    python -m desc.truth_reorg.work_queue run $Q --processes 8 -- \\
+        python add_avrv.py --pixels {task}
+    python -m desc.truth_reorg.work_queue status $Q
+'''
+import os
+import json
+import random
+import socket
+import subprocess
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+__all__ = ['WorkQueue', 'worker_id', 'run_command']
+
+_QUEUE_FILE = 'queue.json'
+_STATES = ('pending', 'claimed', 'done', 'failed')
+_SEP = '@'
+_SUFFIX = '.json'
+
+_DEFAULTS = {'timeout_s' : 600.0, 'heartbeat_s' : 30.0, 'max_attempts' : 3,
+             'poll_s' : 5.0}
+
+def worker_id():
+    '''
+    Name of this process, unique across nodes: <host>-<pid>
+    '''
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+def _write_json(path, obj):
+    # Readers see either the old or the new content, never part of it
+    tmp = f'{path}.tmp.{worker_id()}'
+    with open(tmp, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp, path)
+
+def _read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+def _check_task(task):
+    task = str(task)
+    if (task == '' or task.startswith('.') or '/' in task or _SEP in task):
+        raise ValueError(f'Bad task id {task!r}')
+    return task
+
+def _task_of(name):
+    '''
+    Task id from a file name in any of the state directories
+    '''
+    return name[:-len(_SUFFIX)].split(_SEP)[0]
+
+class _Heartbeat:
+    '''
+    Touch path every interval seconds until stopped or path is gone
+    '''
+    def __init__(self, path, interval):
+        self._path = path
+        self._interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            try:
+                os.utime(self._path)
+            except FileNotFoundError:
+                return
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+class WorkQueue:
+    '''
+    Parameters
+    ----------
+    path          string  queue directory, made with WorkQueue.create
+    timeout_s     float   claims not touched for this long are taken over
+    heartbeat_s   float   how often a running task's claim is touched
+    max_attempts  int     a task failing this many times goes to failed/
+    poll_s        float   how long an idle worker waits before looking again
+
+    Settings not given are those stored when the queue was made
+    '''
+    def __init__(self, path, **kwds):
+        self.path = path
+        qfile = os.path.join(path, _QUEUE_FILE)
+        if not os.path.exists(qfile):
+            raise FileNotFoundError(f'{path} is not a work queue')
+        settings = dict(_DEFAULTS)
+        settings.update(_read_json(qfile).get('settings', {}))
+        settings.update({k : v for (k, v) in kwds.items() if v is not None})
+        unknown = set(settings) - set(_DEFAULTS)
+        if unknown:
+            raise ValueError(f'Unknown queue settings {sorted(unknown)}')
+        self.timeout_s = float(settings['timeout_s'])
+        self.heartbeat_s = float(settings['heartbeat_s'])
+        self.max_attempts = int(settings['max_attempts'])
+        self.poll_s = float(settings['poll_s'])
+
+    @staticmethod
+    def create(path, tasks, exist_ok=True, **settings):
+        '''
+        Make a queue at path holding tasks: an iterable of task ids (str
+        or int) or of (task id, dict of keyword arguments for the task).
+        The queue is built in a temporary directory and renamed into
+        place, so any number of processes may call create at once: the
+        first wins and, if exist_ok, the others just open it.
+        settings are stored as defaults for WorkQueue
+
+        Returns the WorkQueue
+        '''
+        unknown = set(settings) - set(_DEFAULTS)
+        if unknown:
+            raise ValueError(f'Unknown queue settings {sorted(unknown)}')
+        if os.path.exists(os.path.join(path, _QUEUE_FILE)):
+            if not exist_ok:
+                raise FileExistsError(f'Work queue {path} exists')
+            return WorkQueue(path)
+
+        parent = os.path.dirname(os.path.abspath(path))
+        os.makedirs(parent, exist_ok=True)
+        tmp = os.path.join(parent,
+                           f'.{os.path.basename(path)}.tmp.{worker_id()}')
+        for d in _STATES + ('ledger',):
+            os.makedirs(os.path.join(tmp, d))
+        n_tasks = 0
+        seen = set()
+        for t in tasks:
+            task, args = t if isinstance(t, (tuple, list)) else (t, {})
+            task = _check_task(task)
+            if task in seen:
+                raise ValueError(f'Duplicate task id {task}')
+            seen.add(task)
+            _write_json(os.path.join(tmp, 'pending', task + _SUFFIX),
+                        {'task' : task, 'args' : dict(args), 'attempts' : 0,
+                         'errors' : []})
+            n_tasks += 1
+        _write_json(os.path.join(tmp, _QUEUE_FILE),
+                    {'created' : time.time(), 'created_by' : worker_id(),
+                     'n_tasks' : n_tasks, 'settings' : settings})
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # Someone else's queue got there first
+            for d in _STATES + ('ledger',):
+                for f in os.listdir(os.path.join(tmp, d)):
+                    os.remove(os.path.join(tmp, d, f))
+                os.rmdir(os.path.join(tmp, d))
+            os.remove(os.path.join(tmp, _QUEUE_FILE))
+            os.rmdir(tmp)
+            if not exist_ok:
+                raise FileExistsError(f'Work queue {path} exists')
+        return WorkQueue(path)
+
+    def _dir(self, state):
+        return os.path.join(self.path, state)
+
+    def _list(self, state):
+        return [f for f in os.listdir(self._dir(state)) if f.endswith(_SUFFIX)]
+
+    def counts(self):
+        '''
+        dict of number of tasks in each state
+        '''
+        return {s : len(self._list(s)) for s in _STATES}
+
+    def tasks(self, state):
+        '''
+        Sorted list of ids of tasks in state (one of pending, claimed,
+        done, failed)
+        '''
+        return sorted(_task_of(f) for f in self._list(state))
+
+    def _claim_pending(self, me):
+        names = self._list('pending')
+        # Workers starting together shouldn't all fight over the same file
+        random.shuffle(names)
+        for name in names:
+            task = _task_of(name)
+            claim = os.path.join(self._dir('claimed'),
+                                 f'{task}{_SEP}{me}{_SUFFIX}')
+            try:
+                os.rename(os.path.join(self._dir('pending'), name), claim)
+            except FileNotFoundError:
+                continue
+            return task, claim, None
+        return None
+
+    def _take_over_expired(self, me):
+        now = time.time()
+        for name in self._list('claimed'):
+            old = os.path.join(self._dir('claimed'), name)
+            try:
+                age = now - os.stat(old).st_mtime
+            except FileNotFoundError:
+                continue
+            if age < self.timeout_s:
+                continue
+            task = _task_of(name)
+            claim = os.path.join(self._dir('claimed'),
+                                 f'{task}{_SEP}{me}{_SUFFIX}')
+            try:
+                os.rename(old, claim)
+            except FileNotFoundError:
+                continue
+            return task, claim, name[:-len(_SUFFIX)].split(_SEP, 1)[1]
+        return None
+
+    def _log(self, me, record):
+        with open(os.path.join(self._dir('ledger'), me + '.jsonl'), 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    def _run_task(self, func, me, task, claim, expired_owner):
+        info = _read_json(claim)
+        done_path = os.path.join(self._dir('done'), task + _SUFFIX)
+        if os.path.exists(done_path):
+            # Finished by a worker which lost its claim but kept going
+            os.remove(claim)
+            return None
+        if expired_owner is not None:
+            info['errors'].append(f'claim by {expired_owner} expired')
+        info['attempts'] += 1
+        _write_json(claim, info)
+
+        heartbeat = _Heartbeat(claim, self.heartbeat_s)
+        start = time.time()
+        error = None
+        result = None
+        try:
+            result = func(task, **info['args'])
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}'
+        finally:
+            heartbeat.stop()
+        end = time.time()
+
+        record = {'task' : task, 'worker' : me, 'attempt' : info['attempts'],
+                  'start' : start, 'end' : end,
+                  'seconds' : round(end - start, 3)}
+        if error is None:
+            status = 'done'
+            try:
+                json.dumps(result)
+            except TypeError:
+                result = repr(result)
+            info.update({'worker' : me, 'finished' : end, 'result' : result})
+            _write_json(done_path, info)
+            try:
+                os.remove(claim)
+            except FileNotFoundError:
+                pass
+            record['result'] = result
+        elif not os.path.exists(claim):
+            # Claim was taken over while we ran; the new owner retries
+            status = 'lost'
+            record['error'] = error
+        else:
+            info['errors'].append(error)
+            _write_json(claim, info)
+            if info['attempts'] >= self.max_attempts:
+                status = 'failed'
+                os.rename(claim, os.path.join(self._dir('failed'),
+                                              task + _SUFFIX))
+            else:
+                status = 'retry'
+                os.rename(claim, os.path.join(self._dir('pending'),
+                                              task + _SUFFIX))
+            record['error'] = error
+        record['status'] = status
+        self._log(me, record)
+        return status
+
+    def work(self, func, max_tasks=None, wait=True, verbose=True):
+        '''
+        Claim and run tasks in this process until none are left.
+        func is called as func(task, **args) with the task id (a string)
+        and the task's keyword arguments; an exception counts as failure.
+        If wait, keep polling while other workers hold claims, since they
+        may fail or expire; otherwise stop once nothing is pending.
+
+        Returns dict of number of tasks ending in each status
+        '''
+        me = worker_id()
+        summary = {'done' : 0, 'retry' : 0, 'failed' : 0, 'lost' : 0}
+        n_run = 0
+        while max_tasks is None or n_run < max_tasks:
+            claimed = self._claim_pending(me) or self._take_over_expired(me)
+            if claimed is None:
+                if not wait or len(self._list('claimed')) == 0:
+                    break
+                time.sleep(self.poll_s)
+                continue
+            task, claim, expired_owner = claimed
+            if verbose and expired_owner is not None:
+                print(f'{me}: taking over task {task} from {expired_owner}',
+                      flush=True)
+            status = self._run_task(func, me, task, claim, expired_owner)
+            if status is None:
+                continue
+            summary[status] += 1
+            n_run += 1
+            if verbose:
+                print(f'{me}: task {task} {status}', flush=True)
+        return summary
+
+    def run(self, func, processes=1, max_tasks=None, wait=True, verbose=True):
+        '''
+        Run work in processes local processes.  func must be picklable
+        (a module-level function or functools.partial of one).  Start
+        the same call on each node to spread the queue over nodes.
+
+        Returns list of per-process summaries (see work)
+        '''
+        if processes <= 1:
+            return [self.work(func, max_tasks=max_tasks, wait=wait,
+                              verbose=verbose)]
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = [executor.submit(_work, self.path, func,
+                                       timeout_s=self.timeout_s,
+                                       heartbeat_s=self.heartbeat_s,
+                                       max_attempts=self.max_attempts,
+                                       poll_s=self.poll_s,
+                                       max_tasks=max_tasks, wait=wait,
+                                       verbose=verbose)
+                       for i in range(processes)]
+            return [f.result() for f in futures]
+
+    def ledger(self):
+        '''
+        All attempts recorded by all workers, ordered by end time
+        '''
+        records = []
+        for name in os.listdir(self._dir('ledger')):
+            if not name.endswith('.jsonl'):
+                continue
+            with open(os.path.join(self._dir('ledger'), name)) as f:
+                records.extend(json.loads(line) for line in f if line.strip())
+        return sorted(records, key=lambda r: r['end'])
+
+    def retry_failed(self):
+        '''
+        Move failed tasks back to pending with attempts reset.  Returns
+        their ids
+        '''
+        moved = []
+        for name in self._list('failed'):
+            path = os.path.join(self._dir('failed'), name)
+            info = _read_json(path)
+            info['attempts'] = 0
+            _write_json(path, info)
+            os.rename(path, os.path.join(self._dir('pending'), name))
+            moved.append(_task_of(name))
+        return sorted(moved)
+
+def _work(path, func, max_tasks=None, wait=True, verbose=True, **settings):
+    '''
+    Process pool worker for WorkQueue.run
+    '''
+    return WorkQueue(path, **settings).work(func, max_tasks=max_tasks,
+                                            wait=wait, verbose=verbose)
+
+def run_command(task, command=(), **args):
+    '''
+    Task function running command, a list of arguments in which {task}
+    and {<name>} for each task keyword argument are replaced.  Raises
+    CalledProcessError if the command fails.  Returns the exit status
+    '''
+    argv = [a.format(task=task, **args) for a in command]
+    return subprocess.run(argv, check=True).returncode
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description='Shared-filesystem work queue')
+    sub = parser.add_subparsers(dest='action', required=True)
+
+    p_create = sub.add_parser('create', help='make a queue')
+    p_create.add_argument('queue')
+    p_create.add_argument('--tasks', nargs='*', default=[],
+                          help='task ids, e.g. healpix pixels')
+    p_create.add_argument('--tasks-file', default=None,
+                          help='file with one task id per line')
+    for (k, v) in _DEFAULTS.items():
+        p_create.add_argument('--' + k.replace('_', '-'), type=type(v),
+                              default=None, help=f'default {v}')
+
+    p_run = sub.add_parser('run', help='work the queue with a command')
+    p_run.add_argument('queue')
+    p_run.add_argument('--processes', type=int, default=1,
+                       help='processes on this node')
+    p_run.add_argument('--max-tasks', type=int, default=None,
+                       help='per process')
+    p_run.add_argument('--no-wait', action='store_true',
+                       help='exit once nothing is pending rather than waiting for claims held by others')
+    p_run.epilog = 'The command follows --; {task} in it is replaced by the task id'
+
+    p_status = sub.add_parser('status', help='print task counts')
+    p_status.add_argument('queue')
+    p_status.add_argument('--ledger', action='store_true',
+                          help='also print the ledger')
+
+    p_retry = sub.add_parser('retry-failed', help='requeue failed tasks')
+    p_retry.add_argument('queue')
+
+    # Everything after -- is the command, options included
+    argv = sys.argv[1:]
+    command = []
+    if '--' in argv:
+        command = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    args = parser.parse_args(argv)
+    if args.action == 'create':
+        tasks = list(args.tasks)
+        if args.tasks_file:
+            with open(args.tasks_file) as f:
+                tasks += [line.strip() for line in f if line.strip()]
+        settings = {k : getattr(args, k) for k in _DEFAULTS
+                    if getattr(args, k) is not None}
+        q = WorkQueue.create(args.queue, tasks, **settings)
+        print(q.counts())
+    elif args.action == 'run':
+        if not command:
+            parser.error('run needs a command after --')
+        q = WorkQueue(args.queue)
+        print(q.run(partial(run_command, command=command),
+                    processes=args.processes, max_tasks=args.max_tasks,
+                    wait=not args.no_wait))
+    elif args.action == 'status':
+        q = WorkQueue(args.queue)
+        print(q.counts())
+        if args.ledger:
+            for r in q.ledger():
+                print(json.dumps(r))
+        for task in q.tasks('failed'):
+            info = _read_json(os.path.join(q.path, 'failed', task + _SUFFIX))
+            print(f'failed {task}: {info["errors"][-1]}')
+    else:
+        print(WorkQueue(args.queue).retry_failed())
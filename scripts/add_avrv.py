@@ -1,12 +1,17 @@
 import os
 import re
 from collections import namedtuple
+from functools import partial
 import pyarrow as pa
 import pyarrow.parquet as pq
 import numpy as np
-from lsst.sims.catUtils.dust import EBVbase
+from desc.truth_reorg.dust_map import make_ebv_model
 from desc.truth_reorg.oldsim_utils import get_MW_AvRv
 from desc.truth_reorg.script_utils import print_callinfo, print_date
+from desc.truth_reorg.script_utils import Instrument, NULL_INSTRUMENT
+from desc.truth_reorg.manifest import BuildManifest, link_or_copy, MANIFEST_NAME
+from desc.truth_reorg.checksums import ColumnChecksums, write_checksums
+from desc.truth_reorg.work_queue import WorkQueue, worker_id
 
 ###Col = namedtuple('column_descriptor', ['name', 'values', 'datatype'])
 Col = namedtuple('column_descriptor', ['name', 'datatype'])
@@ -22,20 +27,32 @@ class AugmentAvRv():
     For an input parquet file with ra,dec columns, generate Av, Rv, columns
     and write output parquet file appending them
     '''
-    def __init__(self, input_dir=_INPUT_DIR, output_dir=_OUTPUT_DIR):
+    def __init__(self, input_dir=_INPUT_DIR, output_dir=_OUTPUT_DIR,
+                 instrument=NULL_INSTRUMENT, dust_engine='ebvbase',
+                 dust_map_dir=None):
         self._input_dir = input_dir
         self._output_dir = output_dir
-        self._ebv_model = EBVbase()
+        self._dust_engine = dust_engine
+        self._dust_map_dir = dust_map_dir
+        self._ebv_model = make_ebv_model(dust_engine, map_dir=dust_map_dir)
+        self._instrument = instrument
 
         self._file_pattern = re.compile('truth_summary_hp\d+.parquet')
 
     def process_file(self, infilename, outfilename=None, ra='ra', dec='dec',
                      dry_run=False):
+        '''
+        Write the augmented file.  It is written under a temporary name
+        unique to this worker and renamed when complete, so a failed or
+        killed run (or a queue worker which lost its claim) never leaves
+        a partial file under the final name
+        '''
         if not outfilename:
             outfilename = infilename
 
         inpath = os.path.join(self._input_dir, infilename)
         outpath = os.path.join(self._output_dir, outfilename)
+        tmppath = f'{outpath}.tmp.{worker_id()}'
 
         # Open output file
         self._pq_in = pq.ParquetFile(inpath)
@@ -48,36 +65,103 @@ class AugmentAvRv():
             out_schema = out_schema.append(rv_field)
         else:
             out_schema = self._pq_in.schema_arrow
-            out_schema = out_schema.append_field(av_field)
-            out_schema = out_schema.append_field(rv_field)
+            out_schema = out_schema.append(av_field)
+            out_schema = out_schema.append(rv_field)
 
+        self._pq_out = None
         if not dry_run:
-            self._pq_out = pq.ParquetWriter(outpath, out_schema)
+            self._pq_out = pq.ParquetWriter(tmppath, out_schema)
+            checks = ColumnChecksums(out_schema)
         num_row_groups = self._pq_in.metadata.num_row_groups
 
-        for i in range(num_row_groups):
-            tbl = self._pq_in.read_row_group(i)
-            av, rv = get_MW_AvRv(self._ebv_model, tbl[ra], tbl[dec])
-            av_l = pa.array(av, pa.float32())
-            rv_l = pa.array(rv, pa.float32())
+        ins = self._instrument
+        try:
+            for i in range(num_row_groups):
+                with ins.stage('fetch') as st:
+                    tbl = self._pq_in.read_row_group(i)
+                    st.add(rows=tbl.num_rows, nbytes=tbl.nbytes)
+                with ins.stage('extinction', rows=tbl.num_rows):
+                    av, rv = get_MW_AvRv(self._ebv_model, tbl[ra], tbl[dec])
+                av_l = pa.array(av, pa.float32())
+                rv_l = pa.array(rv, pa.float32())
+
+                tbl = tbl.append_column(av_field, av_l)
+                tbl = tbl.append_column(rv_field, rv_l)
+                if not dry_run:
+                    with ins.stage('write', rows=tbl.num_rows,
+                                   nbytes=tbl.nbytes):
+                        self._pq_out.write_table(tbl)
+                    with ins.stage('checksum', rows=tbl.num_rows):
+                        checks.update(tbl)
 
-            tbl = tbl.append_column(av_field, av_l)
-            tbl = tbl.append_column(rv_field, rv_l)
             if not dry_run:
-                self._pq_out.write_table(tbl)
+                write_checksums(outpath, checks, writer=self._pq_out)
+                self._pq_out.close()
+                self._pq_out = None
+                os.replace(tmppath, outpath)
+        finally:
+            if self._pq_out is not None:
+                self._pq_out.close()
+                self._pq_out = None
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
 
-    def process_all(self, ra='ra', dec='dec', dry_run=False):
+    def process_incremental(self, files, ra='ra', dec='dec', dry_run=False,
+                            previous_dir=None):
+        '''
+        Process files (basenames in the input directory), skipping any whose
+        input and output are unchanged according to the build manifest in
+        the output directory.  If previous_dir (output directory of an
+        earlier build) is supplied and its manifest shows an output made
+        from identical input, hard-link (or copy) that output instead of
+        recomputing it.
+        '''
+        manifest = BuildManifest(os.path.join(self._output_dir, MANIFEST_NAME))
+        previous = None
+        if previous_dir:
+            previous = BuildManifest(os.path.join(previous_dir, MANIFEST_NAME))
+        # Outputs made with another dust engine or maps are not current
+        params = {'ra' : ra, 'dec' : dec, 'dust_engine' : self._dust_engine,
+                  'dust_map_dir' : self._dust_map_dir}
+
+        for f in files:
+            inpath = os.path.join(self._input_dir, f)
+            outpath = os.path.join(self._output_dir, f)
+            if manifest.is_current(f, [inpath], [outpath], params):
+                print_date(msg=f'{f} is up to date')
+                continue
+            prev_out = os.path.join(previous_dir, f) if previous else None
+            if previous and previous.is_current(f, [inpath], [prev_out],
+                                                params):
+                print_date(msg=f'{f} unchanged; linking from {previous_dir}')
+                if not dry_run:
+                    link_or_copy(prev_out, outpath)
+            else:
+                print_date(msg=f'Processing {f}')
+                self.process_file(f, ra=ra, dec=dec, dry_run=dry_run)
+            if not dry_run:
+                manifest.record(f, [inpath], [outpath], params)
+                manifest.save()
+
+    def process_all(self, ra='ra', dec='dec', dry_run=False,
+                    incremental=False, previous_dir=None):
         '''
         Process all suitable files in the input directory. Each output file
-        will have the same basename as corresponding input file
+        will have the same basename as corresponding input file.
+        If incremental, only process files whose inputs have changed;
+        see process_incremental
         '''
-        files = os.listdir(self._input_dir)
+        files = [f for f in os.listdir(self._input_dir)
+                 if self._file_pattern.match(f)]
+        if incremental:
+            self.process_incremental(files, ra=ra, dec=dec, dry_run=dry_run,
+                                     previous_dir=previous_dir)
+            return
         for f in files:
-            if self._file_pattern.match(f):
-                if dry_run:
-                    print('Found match: ', f)
-                else:
-                    self.process_file(f, ra=ra, dec=dec, dry_run=dry_run)
+            if dry_run:
+                print('Found match: ', f)
+            else:
+                self.process_file(f, ra=ra, dec=dec, dry_run=dry_run)
 
 
 def hp_to_filename(hp):
@@ -86,6 +170,36 @@ def hp_to_filename(hp):
     '''
     return f'truth_summary_hp{hp}.parquet'
 
+# One AugmentAvRv (and dust map) per process, reused for its tasks
+_AUGMENT = {}
+
+def _process_pixel(hp, input_dir=_INPUT_DIR, output_dir=_OUTPUT_DIR,
+                   ra='ra', dec='dec', dust_engine='ebvbase',
+                   dust_map_dir=None):
+    '''
+    Work queue task: augment the file for healpix pixel hp
+    '''
+    key = (input_dir, output_dir, dust_engine, dust_map_dir)
+    if key not in _AUGMENT:
+        _AUGMENT[key] = AugmentAvRv(input_dir=input_dir,
+                                    output_dir=output_dir,
+                                    dust_engine=dust_engine,
+                                    dust_map_dir=dust_map_dir)
+    print_date(msg=f'Starting pixel {hp}')
+    _AUGMENT[key].process_file(hp_to_filename(hp), ra=ra, dec=dec)
+    print_date(msg=f'Finishing pixel {hp}')
+
+def process_queue(queue_dir, pixels, processes=1, **kwds):
+    '''
+    Make (or join) a work queue of pixels in queue_dir and work it with
+    processes processes.  Start the same call on any number of nodes
+    sharing the filesystem; each pixel is processed once.  kwds are
+    passed to _process_pixel.  Returns the queue
+    '''
+    q = WorkQueue.create(queue_dir, pixels)
+    q.run(partial(_process_pixel, **kwds), processes=processes)
+    return q
+
 if __name__ == '__main__':
     import argparse
 
@@ -102,15 +216,61 @@ if __name__ == '__main__':
                         help='healpix pixels for which augmented files will be created. If option is included with no value all suitable files in the directory wil be processed.')
     parser.add_argument('--dry-run', action='store_true',
                         help='If used, go through the motions without creating any files')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only process files whose input changed since the build recorded in the output directory manifest')
+    parser.add_argument('--previous-dir', default=None,
+                        help='With --incremental, output directory of an earlier build from which unchanged outputs are hard-linked')
+    parser.add_argument('--timing-report', default=None,
+                        help='If supplied, write per-stage timing (json) to this path')
+    parser.add_argument('--progress-interval', type=float, default=None,
+                        help='If timing, print progress line at most every this many seconds')
+    parser.add_argument('--dust-engine', choices=['ebvbase', 'sfd'],
+                        default='ebvbase',
+                        help='sfd: read SFD maps directly (no lsst_sims needed)')
+    parser.add_argument('--dust-map-dir', default=None,
+                        help='directory of SFD maps for --dust-engine sfd; default $SIMS_MAPS_DIR/DustMaps')
+    parser.add_argument('--queue', default=None,
+                        help='work queue directory on a shared filesystem; run the same command on several nodes to share out the pixels (all suitable files if --pixels has no value)')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='with --queue, number of processes on this node')
 
 
     args = parser.parse_args()
+    # Queue workers run independently on several nodes; there is no one
+    # process to keep the build manifest or to report a dry run
+    if args.queue and (args.incremental or args.dry_run or args.previous_dir):
+        parser.error('--queue cannot be combined with --incremental, --previous-dir or --dry-run')
     print_callinfo('add_avrv', args)
 
+    instrument = NULL_INSTRUMENT
+    if args.timing_report:
+        instrument = Instrument(progress_interval=args.progress_interval)
     augment = AugmentAvRv(input_dir = args.input_dir,
-                          output_dir=args.output_dir)
+                          output_dir=args.output_dir, instrument=instrument,
+                          dust_engine=args.dust_engine,
+                          dust_map_dir=args.dust_map_dir)
 
-    if (len(args.pixels) > 0):
+    if args.queue:
+        pixels = args.pixels
+        if len(pixels) == 0:
+            pixels = [int(re.search(r'hp(\d+)', f).group(1))
+                      for f in os.listdir(args.input_dir)
+                      if augment._file_pattern.match(f)]
+        # Reuse this one (forked workers inherit it too)
+        _AUGMENT[(args.input_dir, args.output_dir, args.dust_engine,
+                  args.dust_map_dir)] = augment
+        q = process_queue(args.queue, pixels, processes=args.processes,
+                          input_dir=args.input_dir,
+                          output_dir=args.output_dir, ra=args.ra_name,
+                          dec=args.dec_name, dust_engine=args.dust_engine,
+                          dust_map_dir=args.dust_map_dir)
+        print_date(msg=f'Queue status {q.counts()}')
+    elif (len(args.pixels) > 0) and args.incremental:
+        augment.process_incremental([hp_to_filename(hp) for hp in args.pixels],
+                                    ra=args.ra_name, dec=args.dec_name,
+                                    dry_run=args.dry_run,
+                                    previous_dir=args.previous_dir)
+    elif (len(args.pixels) > 0):
         for hp in args.pixels:
             print_date(msg=f'Starting pixel {hp}')
             augment.process_file(hp_to_filename(hp), ra=args.ra_name,
@@ -120,5 +280,9 @@ if __name__ == '__main__':
     else:
         print_date(msg=f'Processing all suitable files in directory {args.input_dir}')
         augment.process_all(ra=args.ra_name, dec=args.dec_name,
-                            dry_run=args.dry_run)
+                            dry_run=args.dry_run,
+                            incremental=args.incremental,
+                            previous_dir=args.previous_dir)
         print_date(msg='Processing complete')
+
+    instrument.report(args.timing_report)
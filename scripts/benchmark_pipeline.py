@@ -0,0 +1,330 @@
+'''
+Run each stage of the SN, star and galaxy pipelines on synthetic inputs
+at several scales and record throughput and peak memory.
+
+Inputs are produced by desc.truth_reorg.synthetic_data, so no network or
+access to the production files is needed.  Each stage runs in its own
+process so that peak RSS is per stage.  Extinction uses the sfd dust
+engine with small synthetic maps, so lsst_sims is not needed.  Stages
+which need software not available in the current environment (e.g.
+lsst.sphgeom for trimming) are recorded as skipped, as are stages
+depending on them.
+
+With --repeat each stage runs several times (each repeat in its own work
+directory) so that run-to-run noise can be estimated.  Results can be
+saved as a new version of a local baseline for this machine, and later
+runs compared with it; with --compare the exit status is 1 if any stage
+regressed in time or peak memory (see desc.truth_reorg.bench_baseline),
+or if a requested stage is not gated: it did not run, or the baseline
+has no entry for it.
+
+Typical use:
+   python benchmark_pipeline.py --scales 1000 10000 --output bench.json
+   python benchmark_pipeline.py --scales 10000 --repeat 5 --save-baseline
+   python benchmark_pipeline.py --scales 10000 --repeat 5 --compare
+'''
+import os
+import sys
+import json
+import shutil
+import sqlite3
+import tempfile
+import statistics
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+
+from desc.truth_reorg.script_utils import print_callinfo, print_date
+from desc.truth_reorg.script_utils import Instrument, peak_rss_mbyte
+from desc.truth_reorg import synthetic_data as sd
+from desc.truth_reorg import bench_baseline
+
+# The pipeline scripts compute default paths from $SCRATCH at import
+os.environ.setdefault('SCRATCH', tempfile.gettempdir())
+
+def _count_rows(path, table):
+    with sqlite3.connect(path) as conn:
+        return conn.execute(f'select count(*) from {table}').fetchone()[0]
+
+def _trim_sn(inputs, work, instrument):
+    from trim_sn_summary import Region, TrimSnSummary
+    out = os.path.join(work, 'initial_table.db')
+    TrimSnSummary(Region(), inputs['sn_summary'], inputs['sn_params'],
+                  instrument=instrument).create(outpath=out, chunksize=30000)
+    return _count_rows(inputs['sn_summary'], 'truth_summary')
+
+def _complete_sn(inputs, work, instrument):
+    from complete_sn_summary import SnSummaryWriter
+    in_file = os.path.join(work, 'initial_table.db')
+    SnSummaryWriter(out_file=os.path.join(work, 'truth_sn_summary.db'),
+                    in_file=in_file, var_file=inputs['sn_variability'],
+                    instrument=instrument, dust_engine='sfd',
+                    dust_map_dir=inputs['dust_map_dir']).complete()
+    return _count_rows(in_file, 'initial_summary')
+
+def _sn_variability(inputs, work, instrument):
+    from make_sn_variability import SnVariabilityWriter
+    out = os.path.join(work, 'truth_sn_variability.db')
+    SnVariabilityWriter(summ_file=os.path.join(work, 'truth_sn_summary.db'),
+                        out_file=out, var_file=inputs['sn_variability'],
+                        instrument=instrument).create()
+    return _count_rows(out, 'truth_sn_variability')
+
+def _star_trim(inputs, work, instrument):
+    from trim_to_region import Trimmer
+    from desc.truth_reorg.sphgeom_utils import DC2_RA_MID, DC2_RA_NE, DC2_DEC_NE, DC2_DEC_S
+    trimmer = Trimmer(ifile=inputs['star_summary'],
+                      ofile=os.path.join(work, 'star_trimmed.db'),
+                      table_name='truth_summary', instrument=instrument)
+    trimmer.set_region(DC2_RA_MID, DC2_RA_NE, DC2_DEC_NE, DC2_DEC_S)
+    trimmer.trim()
+    return _count_rows(inputs['star_summary'], 'truth_summary')
+
+def _star_summary(inputs, work, instrument):
+    from make_star_summary import StarSummaryWriter
+    writer = StarSummaryWriter(old_summary=inputs['star_summary'],
+                               lc_stats=inputs['star_lc_stats'],
+                               instrument=instrument, dust_engine='sfd',
+                               dust_map_dir=inputs['dust_map_dir'])
+    writer.create(out_file=os.path.join(work, 'truth_star_summary.db'),
+                  chunksize=50000)
+    return _count_rows(inputs['star_summary'], 'truth_summary')
+
+def _star_variability(inputs, work, instrument):
+    from make_star_variability import StarVariabilityWriter
+    out = os.path.join(work, 'truth_star_variability.db')
+    StarVariabilityWriter(summ_file=os.path.join(work, 'truth_star_summary.db'),
+                          out_file=out, var_file=inputs['star_variability'],
+                          instrument=instrument).create()
+    return _count_rows(out, 'truth_star_variability')
+
+def _convert_parquet(inputs, work, instrument):
+    from desc.truth_reorg.parquet_utils import convert_sqlite_to_parquet
+    # Convert the pipeline's output, as in production.  The raw input has
+    # TEXT ids, which don't fit the int64 id expected for star files
+    dbfile = os.path.join(work, 'truth_star_variability.db')
+    convert_sqlite_to_parquet(dbfile,
+                              os.path.join(work, 'truth_star_variability.parquet'),
+                              'truth_star_variability', n_group=4,
+                              order_by='rowid', instrument=instrument)
+    return _count_rows(dbfile, 'truth_star_variability')
+
+def _star_positions(inputs):
+    import pandas as pd
+    with sqlite3.connect(inputs['star_summary']) as conn:
+        df = pd.read_sql('select ra, dec from truth_summary', conn)
+    return df['ra'].to_numpy(), df['dec'].to_numpy()
+
+def _region_contains(inputs, work, instrument):
+    from desc.truth_reorg.sphgeom_utils import Region
+    ra, dec = _star_positions(inputs)
+    # A fresh coverage cache, so every repeat includes building the map
+    with instrument.stage('region_contains', rows=len(ra)):
+        Region(cache_dir=os.path.join(work, 'coverage')).contains(ra, dec)
+    return len(ra)
+
+def _mw_avrv(inputs, work, instrument):
+    from desc.truth_reorg.dust_map import make_ebv_model
+    from desc.truth_reorg.oldsim_utils import get_MW_AvRv
+    ra, dec = _star_positions(inputs)
+    model = make_ebv_model(engine='sfd', map_dir=inputs['dust_map_dir'])
+    with instrument.stage('get_MW_AvRv', rows=len(ra)):
+        get_MW_AvRv(model, ra, dec)
+    return len(ra)
+
+def _add_avrv(inputs, work, instrument):
+    import pyarrow.parquet as pq
+    from add_avrv import AugmentAvRv
+    augment = AugmentAvRv(input_dir=os.path.dirname(inputs['galaxy'][0]),
+                          output_dir=work, instrument=instrument,
+                          dust_engine='sfd',
+                          dust_map_dir=inputs['dust_map_dir'])
+    n = 0
+    for p in inputs['galaxy']:
+        augment.process_file(os.path.basename(p))
+        n += pq.ParquetFile(p).metadata.num_rows
+    return n
+
+# (name, function, prerequisite stages) in order of execution
+STAGES = [('trim_sn', _trim_sn, ()),
+          ('complete_sn', _complete_sn, ('trim_sn',)),
+          ('sn_variability', _sn_variability, ('complete_sn',)),
+          ('star_trim', _star_trim, ()),
+          ('star_summary', _star_summary, ()),
+          ('star_variability', _star_variability, ('star_summary',)),
+          ('convert_parquet', _convert_parquet, ('star_variability',)),
+          ('region_contains', _region_contains, ()),
+          ('mw_avrv', _mw_avrv, ()),
+          ('add_avrv', _add_avrv, ())]
+
+def _run_stage(name, inputs, work):
+    '''
+    Run in a child process.  Return a dict describing the outcome
+    '''
+    fn = dict((s[0], s[1]) for s in STAGES)[name]
+    instrument = Instrument()
+    t0 = perf_counter()
+    try:
+        rows = fn(inputs, work, instrument)
+    except ImportError as ex:
+        return {'stage' : name, 'status' : 'skipped', 'reason' : str(ex)}
+    except Exception as ex:
+        return {'stage' : name, 'status' : 'failed', 'reason' : str(ex),
+                'traceback' : traceback.format_exc()}
+    wall = perf_counter() - t0
+    return {'stage' : name, 'status' : 'ok', 'rows' : rows,
+            'wall_s' : round(wall, 4),
+            'rows_per_s' : round(rows / wall, 1) if wall > 0 else None,
+            'peak_rss_mbyte' : peak_rss_mbyte(),
+            'substages' : instrument.summary()}
+
+def _combine_repeats(runs):
+    '''
+    Merge the results of repeated runs of one stage.  wall_s is the
+    median and peak_rss_mbyte the maximum; all samples are kept
+    '''
+    if len(runs) == 1 or any(r['status'] != 'ok' for r in runs):
+        bad = [r for r in runs if r['status'] != 'ok']
+        return bad[0] if bad else runs[0]
+    wall = statistics.median(r['wall_s'] for r in runs)
+    res = dict(runs[-1])
+    rss = [r['peak_rss_mbyte'] for r in runs]
+    res.update({'wall_s' : round(wall, 4),
+                'rows_per_s' : round(res['rows'] / wall, 1) if wall > 0 else None,
+                'peak_rss_mbyte' : max((x for x in rss if x is not None),
+                                       default=None),
+                'wall_s_samples' : [r['wall_s'] for r in runs],
+                'peak_rss_samples' : rss, 'repeats' : len(runs)})
+    return res
+
+def run_benchmarks(scales, work_dir, n_obs=20, seed=42, stages=None,
+                   keep=False, repeat=1):
+    '''
+    For each scale generate inputs with that many objects, then run
+    each requested stage, and the stages it depends on, repeat times.
+    Return list of result dicts.
+    '''
+    results = []
+    wanted = set(stages if stages else [s[0] for s in STAGES])
+    # Requested stages bring their prerequisites (STAGES is in order)
+    for (name, _, prereqs) in reversed(STAGES):
+        if name in wanted:
+            wanted.update(prereqs)
+    for scale in scales:
+        scale_dir = os.path.join(work_dir, f'scale_{scale}')
+        print_date(msg=f'Generating inputs for scale {scale}')
+        inputs = sd.generate_all(scale_dir, n_objects=scale, n_obs=n_obs,
+                                 seed=seed)
+        runs = {}
+        for r in range(repeat):
+            # Outputs of one repeat must not be inputs of the next
+            run_dir = os.path.join(scale_dir, f'run_{r}') if repeat > 1 \
+                else scale_dir
+            os.makedirs(run_dir, exist_ok=True)
+            status = {}
+            for (name, _, prereqs) in STAGES:
+                if name not in wanted:
+                    continue
+                missing = [p for p in prereqs if status.get(p) != 'ok']
+                if missing:
+                    res = {'stage' : name, 'status' : 'skipped',
+                           'reason' : f'prerequisite(s) {missing} not run'}
+                else:
+                    print_date(msg=f'Scale {scale}: running {name}')
+                    with ProcessPoolExecutor(max_workers=1) as pool:
+                        res = pool.submit(_run_stage, name, inputs,
+                                          run_dir).result()
+                res['scale'] = scale
+                status[name] = res['status']
+                runs.setdefault(name, []).append(res)
+                print_date(msg=f'Scale {scale}: {name} {res["status"]}')
+            if repeat > 1 and not keep:
+                shutil.rmtree(run_dir)
+        results.extend(_combine_repeats(v) for v in runs.values())
+        if not keep:
+            shutil.rmtree(scale_dir)
+    return results
+
+def _default_baseline():
+    return os.path.join(os.environ['SCRATCH'], 'desc/truth/bench/baselines.json')
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark pipeline stages on synthetic inputs')
+    parser.add_argument('--scales', type=int, nargs='+',
+                        default=[1000, 10000, 100000],
+                        help='number of objects of each type per run')
+    parser.add_argument('--n-obs', type=int, default=20,
+                        help='variability rows per object')
+    parser.add_argument('--stages', nargs='*', default=None,
+                        help='run only these stages and their prerequisites (default all)')
+    parser.add_argument('--work-dir', default=None,
+                        help='where to put generated files. Default is a temporary directory')
+    parser.add_argument('--keep', action='store_true',
+                        help='Do not delete generated inputs and outputs')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='run each stage this many times')
+    parser.add_argument('--output', default=None,
+                        help='write results as json to this path; else print')
+    parser.add_argument('--baseline', default=None,
+                        help='baseline file. Default is $SCRATCH/desc/truth/bench/baselines.json')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='record results as a new baseline version for this machine')
+    parser.add_argument('--label', default=None,
+                        help='description stored with a saved baseline')
+    parser.add_argument('--compare', action='store_true',
+                        help='compare with the baseline; exit status 1 on regression or if a requested stage is not gated')
+    parser.add_argument('--baseline-version', type=int, default=None,
+                        help='compare with this version rather than the latest')
+    parser.add_argument('--rel-tol', type=float, default=0.10,
+                        help='fractional increase in wall time tolerated')
+    parser.add_argument('--mem-tol', type=float, default=0.15,
+                        help='fractional increase in peak memory tolerated')
+    parser.add_argument('--n-sigma', type=float, default=3.0,
+                        help='increase must also exceed this many times the run-to-run noise')
+
+    args = parser.parse_args()
+    print_callinfo(sys.argv[0], args)
+
+    work_dir = args.work_dir
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix='truth_reorg_bench_')
+    results = run_benchmarks(args.scales, work_dir, n_obs=args.n_obs,
+                             seed=args.seed, stages=args.stages,
+                             keep=args.keep, repeat=args.repeat)
+    content = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(content)
+    elif not (args.compare or args.save_baseline):
+        print(content)
+
+    regressed = False
+    if args.compare or args.save_baseline:
+        store = bench_baseline.BaselineStore(args.baseline or _default_baseline())
+        key, machine = bench_baseline.machine_fingerprint()
+        print(f'Machine {key}: {machine}')
+    if args.compare:
+        baseline = store.baseline(version=args.baseline_version)
+        if baseline is None:
+            print(f'No baseline for this machine in {store.path}')
+            regressed = True
+        else:
+            outcome = bench_baseline.compare_results(
+                results, baseline, rel_tol=args.rel_tol,
+                mem_tol=args.mem_tol, n_sigma=args.n_sigma)
+            bench_baseline.format_report(outcome, baseline)
+            regressed = any(o['status'] == 'regression'
+                            for o in outcome.values())
+            ungated = sorted(k for (k, o) in outcome.items()
+                             if o['status'] in bench_baseline.UNGATED)
+            if ungated:
+                print(f'Warning: not gated against the baseline: {", ".join(ungated)}')
+                regressed = True
+    if args.save_baseline:
+        version = store.add(results, label=args.label)
+        store.save()
+        print(f'Saved baseline version {version} to {store.path}')
+    sys.exit(1 if regressed else 0)
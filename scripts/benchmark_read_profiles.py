@@ -0,0 +1,96 @@
+'''
+Time the kinds of scans done by the truth_reorg scripts under each
+read profile of connect_read (see truth_reorg_utils.READ_PROFILES).
+
+Scans:
+  full     select * from table              (convert_sqlite_to_parquet)
+  radec    select ra, dec from table        (Trimmer mask pass)
+  window   rowid-window selects             (convert_sqlite_to_parquet)
+  join     summary INNER JOIN attached var  (variability writers), only
+           if --var-file is supplied
+
+Each scan is run --repeat times per profile; the first run is more
+sensitive to the state of the OS page cache, so both first and best
+times are reported.  Inputs may be synthetic (see synthetic_data.py).
+'''
+import sys
+import json
+from time import perf_counter
+
+from desc.truth_reorg.script_utils import print_callinfo
+from desc.truth_reorg.truth_reorg_utils import connect_read, apply_read_profile
+from desc.truth_reorg.truth_reorg_utils import READ_PROFILES
+
+def _scan(conn, query, chunksize=50000):
+    cur = conn.cursor()
+    cur.arraysize = chunksize
+    cur.execute(query)
+    n = 0
+    while True:
+        rows = cur.fetchmany()
+        if len(rows) == 0:
+            break
+        n += len(rows)
+    return n
+
+def _windows(conn, table, n_window=10):
+    total = conn.execute(f'select max(rowid) from {table}').fetchone()[0] or 0
+    step = max(1, total // n_window)
+    n = 0
+    for lo in range(0, total, step):
+        n += _scan(conn, f'select * from {table} where rowid > {lo} and rowid <= {lo + step}')
+    return n
+
+def run(dbfile, table, var_file=None, join_on=None, repeat=3,
+        profiles=None):
+    '''
+    Return dict profile -> scan -> {'rows', 'first_s', 'best_s'}
+    '''
+    if profiles is None:
+        profiles = list(READ_PROFILES.keys())
+    results = {}
+    for profile in profiles:
+        res = {}
+        scans = {'full' : lambda c: _scan(c, f'select * from {table}'),
+                 'radec' : lambda c: _scan(c, f'select ra, dec from {table}'),
+                 'window' : lambda c: _windows(c, table)}
+        if var_file:
+            scans['join'] = lambda c: _scan(c, f'select * from {table} INNER JOIN var.{join_on[0]} ON {table}.{join_on[1]} = var.{join_on[0]}.{join_on[2]}')
+        for (name, fn) in scans.items():
+            times = []
+            for i in range(repeat):
+                conn = connect_read(dbfile, profile=profile)
+                if var_file:
+                    conn.execute(f"attach '{var_file}' as var")
+                    apply_read_profile(conn, var_file, profile, schema='var')
+                t0 = perf_counter()
+                n = fn(conn)
+                times.append(perf_counter() - t0)
+                conn.close()
+            res[name] = {'rows' : n, 'first_s' : round(times[0], 4),
+                         'best_s' : round(min(times), 4)}
+        results[profile] = res
+    return results
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Compare connect_read profiles on typical scans')
+    parser.add_argument('dbfile', help='sqlite file to scan')
+    parser.add_argument('--table', default='truth_summary')
+    parser.add_argument('--var-file', default=None,
+                        help='variability file to attach for the join scan')
+    parser.add_argument('--join-on', nargs=3, default=None,
+                        metavar=('VAR_TABLE', 'SUMM_COL', 'VAR_COL'),
+                        help='e.g. sn_variability_truth id_string id')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--profiles', nargs='*', default=None)
+
+    args = parser.parse_args()
+    print_callinfo(sys.argv[0], args)
+    if args.var_file and not args.join_on:
+        parser.error('--join-on is required with --var-file')
+
+    print(json.dumps(run(args.dbfile, args.table, var_file=args.var_file,
+                         join_on=args.join_on, repeat=args.repeat,
+                         profiles=args.profiles), indent=2))
@@ -1,18 +1,35 @@
 import os
+import json
 import numpy as np
 import sqlite3
-
-from lsst.sims.catUtils.dust import EBVbase
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from desc.truth_reorg.dust_map import make_ebv_model
+from desc.truth_reorg.oldsim_utils import get_MW_AvRv
+from desc.truth_reorg.script_utils import NULL_INSTRUMENT
+from desc.truth_reorg.parquet_utils import open_parquet_writer, read_batches, rebatch
+from desc.truth_reorg.id_dictionary import SnIdDictionary
+from desc.truth_reorg.lc_aggregates import LcAggregates
+from desc.truth_reorg.batch_sizer import as_sizer
+from desc.truth_reorg.checksums import ColumnChecksums, write_checksums
 '''
 This is a companion script to trim_sn_summary.py.  The output of
 trim_sn_summary.py is this input to complete_sn_summary.
 
 
-complete_sn_summary must run in a DC2-era lsst_sims environment. It will
+complete_sn_summary must run in a DC2-era lsst_sims environment unless
+dust_engine='sfd' is used. It will
      - Add new integer id column (keep original id)
      - Add Rv, Av columns
      - Add columns for max observed delta flux
 
+The trimmed input may be an sqlite file or an Arrow IPC file written by
+TrimSnSummary.create(outpath='....arrow'), or, if both environments are
+available in one process, the batches from TrimSnSummary.iter_batches().
+If the output file name ends in .parquet, output is written as parquet one
+record batch at a time (see complete_parquet); the trimmed input may then
+also be parquet, and the variability input sqlite or parquet.
 '''
 
 _INIT_COLUMNS = [('id_string', 'TEXT'), ('host_galaxy', 'BIGINT'),
@@ -34,6 +51,46 @@ _VAR_FILE = os.path.join(_SN_DIR, 'sum_variable-31mar.db')
 _VAR_TABLE = 'sn_variability_truth'
 _MAX_STAR_ID = 41021613038
 _SN_OBJ_TYPE = 22
+_ARROW_SUFFIXES = ('.arrow', '.feather')
+
+class _ArrowCursor:
+    '''
+    Stand-in for an sqlite cursor, supporting only fetchmany, which returns
+    rows from a sequence of pyarrow RecordBatches.  Batches are cut to at
+    most arraysize rows (which may be changed between calls); empty
+    batches are skipped.
+    '''
+    def __init__(self, batches, names, arraysize):
+        self._names = names
+        self.arraysize = arraysize
+        self._pieces = self._iter_pieces(batches)
+
+    def _iter_pieces(self, batches):
+        for batch in batches:
+            start = 0
+            while start < batch.num_rows:
+                piece = batch.slice(start, self.arraysize)
+                start += piece.num_rows
+                yield piece
+
+    def fetchmany(self):
+        piece = next(self._pieces, None)
+        if piece is None:
+            return []
+        cols = [piece.column(piece.schema.get_field_index(n)).to_pylist()
+                for n in self._names]
+        return list(zip(*cols))
+
+def _read_arrow_batches(path):
+    '''
+    Memory-map an Arrow IPC file and yield its record batches
+    '''
+    import pyarrow as pa
+
+    source = pa.memory_map(path, 'r')
+    reader = pa.ipc.open_file(source)
+    for i in range(reader.num_record_batches):
+        yield reader.get_batch(i)
 
 class SnSummaryWriter:
     '''
@@ -44,15 +101,17 @@ class SnSummaryWriter:
         * Add new integer id
 
     '''
-    ebv_model = EBVbase()
-
     def __init__(self, out_file=_OUT_FILE, in_file=_IN_FILE,
-                 in_table=_IN_TABLE, var_file=_VAR_FILE):
+                 in_table=_IN_TABLE, var_file=_VAR_FILE,
+                 instrument=NULL_INSTRUMENT, dust_engine='ebvbase',
+                 dust_map_dir=None):
+        self._ebv_model = make_ebv_model(dust_engine, map_dir=dust_map_dir)
         self._out_file = out_file
         self._out_table = _OUT_TABLE
         self._in_file = in_file
         self._in_table = in_table
         self._var_file = var_file
+        self._instrument = instrument
 
     @staticmethod
     def _connect_read(path):
@@ -62,19 +121,6 @@ class SnSummaryWriter:
         conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
         return conn
 
-    @staticmethod
-    def get_MW_AvRv(ra, dec, Rv=3.1):
-        '''
-        Copied from
-        https://github.com/LSSTDESC/sims_TruthCatalog/blob/master/python/desc/sims_truthcatalog/synthetic_photometry.py#L133
-        '''
-        #eq_coord = np.array([[np.radians(ra)], [np.radians(dec)]])
-        eq_coord = np.array([np.radians(ra), np.radians(dec)])
-        ebv = SnSummaryWriter.ebv_model.calculateEbv(equatorialCoordinates=eq_coord,
-                                                     interp=True)
-        Av = Rv*ebv
-        return Av, Rv
-
     @staticmethod
     def make_int_id(host):
         '''
@@ -137,32 +183,217 @@ class SnSummaryWriter:
         and write to output.
         Returns
         -------
-        False if there might be more data; otherwise (all done) True
+        Number of rows written; 0 if all done
         '''
-        rows = in_cur.fetchmany()
+        ins = self._instrument
+        with ins.stage('fetch') as st:
+            rows = in_cur.fetchmany()
+            st.add(rows=len(rows))
         if len(rows) == 0:
-            return True
+            return 0
 
         id_list, host, ra, dec, c5, c6, c7, c8, c9, c10 = zip(*rows)
 
-        Av, rv = self.get_MW_AvRv(ra, dec)
-        Rv = np.full((len(Av),), rv)
-        id_int = [self.make_int_id(h) for h in host]
-
-        max_deltas = [self.get_max_fluxes(self._conn_var, id_str) for id_str in id_list]
+        with ins.stage('extinction', rows=len(rows)):
+            Av, rv = get_MW_AvRv(self._ebv_model, ra, dec)
+        with ins.stage('transform', rows=len(rows)):
+            Rv = np.full((len(Av),), rv)
+            id_int = [self.make_int_id(h) for h in host]
+
+        with ins.stage('max_flux', rows=len(rows)):
+            if self._aggregates is not None:
+                max_deltas = zip(*[self._aggregates.column(pa.array(id_list), band,
+                                                           'max_delta_flux').to_pylist()
+                                   for band in self._BANDS])
+            else:
+                max_deltas = [self.get_max_fluxes(self._conn_var, id_str) for id_str in id_list]
         u, g, r, i, z, y = zip(*max_deltas)
         to_write = list(zip(id_list, host, ra, dec, c5, c6, c7, c8, c9, c10,
                             id_int, Av, Rv, u, g, r, i, z, y))
 
-        self._conn_out.cursor().executemany(self._INSERT, to_write)
+        with ins.stage('write', rows=len(to_write)):
+            self._conn_out.cursor().executemany(self._INSERT, to_write)
 
-        self._conn_out.commit()
+        with ins.stage('commit'):
+            self._conn_out.commit()
+        with ins.stage('checksum', rows=len(to_write)):
+            self._checks.update_rows(to_write)
 
-        return False
+        return len(to_write)
 
-    def complete(self, chunksize=20000, max_chunk=None):
-        self._conn_in = self._connect_read(self._in_file)
-        self._conn_var = self._connect_read(self._var_file)
+    _MAX_FLUX_SCHEMA = pa.schema([('id', pa.string()), ('bandpass', pa.string()),
+                                  ('max_flux', pa.float64())])
+    _BANDS = ('u', 'g', 'r', 'i', 'z', 'y')
+
+    @staticmethod
+    def make_int_id_array(host):
+        '''
+        Vectorized make_int_id for a pyarrow array of host ids
+        '''
+        host = pc.cast(host, pa.int64())
+        return pc.if_else(pc.less(host, 100000),
+                          pc.add(host, _MAX_STAR_ID + 1),
+                          pc.add(pc.multiply(host, 1024), _SN_OBJ_TYPE))
+
+    def _all_max_fluxes(self):
+        '''
+        For parquet variability input: max delta_flux per (id, bandpass)
+        over the whole file, aggregated a batch at a time.  With an id
+        dictionary, ids are mapped to int64 codes first and rows for SNe
+        not in it are dropped
+        '''
+        partial = []
+        for batch in read_batches(self._var_file, ['id', 'bandpass', 'delta_flux']):
+            t = pa.Table.from_batches([batch])
+            if self._id_dict is not None:
+                codes = self._id_dict.codes(batch.column(0))
+                t = t.set_column(0, 'id', pa.array(codes))
+                t = t.filter(pa.array(codes >= 0))
+            partial.append(t.group_by(['id', 'bandpass']).aggregate([('delta_flux', 'max')]))
+        tbl = pa.concat_tables(partial)
+        tbl = tbl.group_by(['id', 'bandpass']).aggregate([('delta_flux_max', 'max')])
+        return tbl.rename_columns(['id', 'bandpass', 'max_flux'])
+
+    def _max_flux_table(self, ids):
+        '''
+        Table of (id, bandpass, max_flux) for the SNe in ids
+        '''
+        if self._max_flux_all is not None:
+            return self._max_flux_all
+        q = f'''select id, bandpass, max(delta_flux) from sn_variability_truth
+        where id in (select value from json_each(?)) group by id, bandpass'''
+        return self._var_reader.table(q, schema=self._MAX_FLUX_SCHEMA,
+                                      parameters=(json.dumps(ids.to_pylist()),))
+
+    def _do_batch(self, batch, writer):
+        '''
+        Arrow counterpart of _do_chunk: calculate additional columns for
+        a RecordBatch of the trimmed table and write it
+        '''
+        ins = self._instrument
+        n = batch.num_rows
+        ids = batch.column('id_string')
+        with ins.stage('extinction', rows=n):
+            Av, rv = get_MW_AvRv(self._ebv_model,
+                                 batch.column('ra').to_numpy(zero_copy_only=False),
+                                 batch.column('dec').to_numpy(zero_copy_only=False))
+        with ins.stage('transform', rows=n):
+            id_int = self.make_int_id_array(batch.column('host_galaxy'))
+            Rv = pa.array(np.full((n,), rv))
+
+        with ins.stage('max_flux', rows=n):
+            if self._aggregates is not None:
+                max_fluxes = [self._aggregates.column(ids, band, 'max_delta_flux')
+                              for band in self._BANDS]
+            else:
+                max_fluxes = self._max_flux_columns(ids)
+
+        arrays = ([batch.column(c) for c in self._in_names]
+                  + [id_int, pa.array(Av), Rv] + max_fluxes)
+        schema = writer.schema
+        out = pa.RecordBatch.from_arrays([pc.cast(a, f.type)
+                                          for (a, f) in zip(arrays, schema)],
+                                         schema=schema)
+        with ins.stage('write', rows=n):
+            writer.write_batch(out)
+        with ins.stage('checksum', rows=n):
+            self._checks.update(out)
+
+    def _max_flux_columns(self, ids):
+        '''
+        Max delta_flux per band for ids, from the variability file
+        '''
+        mf = self._max_flux_table(ids)
+        # Match on integer codes if the table was built with the dictionary
+        if self._id_dict is not None and self._max_flux_all is not None:
+            keys = pa.array(self._id_dict.codes(ids))
+        else:
+            keys = ids
+        max_fluxes = []
+        for band in self._BANDS:
+            sub = mf.filter(pc.equal(mf['bandpass'], band))
+            idx = pc.index_in(keys, value_set=sub['id'].combine_chunks())
+            max_fluxes.append(pc.take(sub['max_flux'].combine_chunks(), idx))
+        return max_fluxes
+
+    def complete_parquet(self, chunksize=20000, max_chunk=None, batches=None,
+                         tune=True, id_dict=None, aggregates=None):
+        '''
+        As complete, but write out_file as parquet, one record batch at a
+        time.  Input as for complete, or a parquet file.  Max fluxes come
+        from one grouped query per batch if var_file is sqlite, or a single
+        streaming aggregation if it is parquet.  In the latter case, if
+        id_dict (SnIdDictionary or its directory, built with
+        host='host_galaxy' from the trimmed table) is given, aggregation
+        and matching are done on int64 codes.  If aggregates (file
+        written by lc_aggregates.aggregate_light_curves) is given, max
+        fluxes are taken from it and var_file is not read
+        '''
+        from desc.truth_reorg.sqlite_arrow import SqliteArrowReader
+
+        self._in_names = [e[0] for e in _INIT_COLUMNS]
+        sizer = as_sizer(chunksize)
+        if batches is None:
+            batches = read_batches(self._in_file, self._in_names,
+                                   table=self._in_table, batch_rows=sizer.size)
+        batches = sizer.timed(rebatch(batches, sizer))
+
+        self._var_reader = None
+        self._max_flux_all = None
+        if id_dict is not None and not isinstance(id_dict, SnIdDictionary):
+            id_dict = SnIdDictionary(id_dict)
+        self._id_dict = id_dict
+        self._aggregates = LcAggregates(aggregates) if aggregates else None
+        if self._aggregates is None:
+            if self._var_file.endswith('.parquet'):
+                self._max_flux_all = self._all_max_fluxes()
+            else:
+                self._var_reader = SqliteArrowReader(self._var_file)
+
+        writer = open_parquet_writer(self._out_file,
+                                     _INIT_COLUMNS + _ADD_COLUMNS, tune=tune)
+        self._checks = ColumnChecksums(writer.schema)
+        ins = self._instrument
+        i_chunk = 0
+        while True:
+            if max_chunk and i_chunk >= max_chunk:
+                break
+            with ins.stage('fetch') as st:
+                batch = next(batches, None)
+                st.add(rows=batch.num_rows if batch is not None else 0)
+            if batch is None:
+                print("all done")
+                break
+            self._do_batch(batch, writer)
+            print('completed chunk ', i_chunk)
+            i_chunk += 1
+
+        write_checksums(self._out_file, self._checks, writer=writer)
+        writer.close()
+        if self._var_reader is not None:
+            self._var_reader.close()
+
+    def complete(self, chunksize=20000, max_chunk=None, batches=None,
+                 id_dict=None, aggregates=None):
+        '''
+        Read the trimmed table, add columns and write truth_sn_summary.
+        Input comes from batches if supplied (an iterable of pyarrow
+        RecordBatches, e.g. TrimSnSummary.iter_batches()), else from
+        in_file, which may be sqlite or an Arrow IPC file (.arrow, .feather)
+        If out_file ends in .parquet, use complete_parquet (id_dict is
+        only used there).  If aggregates is given, max fluxes come from it
+        rather than per-id queries of var_file.  chunksize is an int,
+        'auto' or a BatchSizer (see batch_sizer)
+        '''
+        if self._out_file.endswith('.parquet'):
+            return self.complete_parquet(chunksize=chunksize,
+                                         max_chunk=max_chunk, batches=batches,
+                                         id_dict=id_dict, aggregates=aggregates)
+        self._conn_in = None
+        self._aggregates = LcAggregates(aggregates) if aggregates else None
+        self._conn_var = None
+        if self._aggregates is None:
+            self._conn_var = self._connect_read(self._var_file)
         self._conn_out = sqlite3.connect(self._out_file)
 
         out_columns = _INIT_COLUMNS + _ADD_COLUMNS
@@ -170,18 +401,28 @@ class SnSummaryWriter:
         create_query = self.assemble_create_table(_OUT_TABLE, out_columns)
 
         self._conn_out.cursor().execute(create_query)
+        self._checks = ColumnChecksums.for_columns(out_columns)
 
         self._in_names = [e[0] for e in _INIT_COLUMNS]
-        rd_query = 'select ' + ','.join(self._in_names) + ' from ' + self._in_table
-        in_cur = self._conn_in.cursor()
-        in_cur.arraysize = chunksize
-        in_cur.execute(rd_query)
+        sizer = as_sizer(chunksize)
+        if batches is None and self._in_file.endswith(_ARROW_SUFFIXES):
+            batches = _read_arrow_batches(self._in_file)
+        if batches is not None:
+            in_cur = _ArrowCursor(batches, self._in_names, sizer.size)
+        else:
+            self._conn_in = self._connect_read(self._in_file)
+            rd_query = 'select ' + ','.join(self._in_names) + ' from ' + self._in_table
+            in_cur = self._conn_in.cursor()
+            in_cur.execute(rd_query)
 
         done = False
         i_chunk = 0
 
         while not done:
-            done = self._do_chunk(in_cur)
+            in_cur.arraysize = sizer.size
+            with sizer.batch() as b:
+                b.rows = self._do_chunk(in_cur)
+            done = (b.rows == 0)
             if done:
                 print("all done")
             else:
@@ -191,9 +432,13 @@ class SnSummaryWriter:
                 if i_chunk >= max_chunk:
                     break
 
-        self._conn_in.close()
+        if self._conn_in:
+            self._conn_in.close()
+        write_checksums(self._out_file, self._checks, table=_OUT_TABLE,
+                        conn=self._conn_out)
         self._conn_out.close()
-        self._conn_var.close()
+        if self._conn_var:
+            self._conn_var.close()
 
 if __name__ == '__main__':
 
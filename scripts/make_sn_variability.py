@@ -1,7 +1,24 @@
 import os
+import sys
 import sqlite3
+from functools import partial
 
-from desc.truth_reorg.truth_reorg_utils import assemble_create_table, connect_read
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from desc.truth_reorg.truth_reorg_utils import assemble_create_table, shared_pool
+from desc.truth_reorg.truth_reorg_utils import connect_read
+from desc.truth_reorg.script_utils import NULL_INSTRUMENT, print_callinfo, print_date
+from desc.truth_reorg.parquet_utils import arrow_schema, rows_to_batch
+from desc.truth_reorg.parquet_utils import read_batches, batch_to_rows, rebatch
+from desc.truth_reorg.id_dictionary import SnIdDictionary
+from desc.truth_reorg.range_join import outer_table, rowid_ranges, run_ranges
+from desc.truth_reorg.range_join import merge_sqlite_shards, merge_parquet_shards
+from desc.truth_reorg.range_join import verify_against_serial
+from desc.truth_reorg.planner import plan_writer, format_plan
+from desc.truth_reorg.batch_sizer import as_sizer, chunksize_arg
+from desc.truth_reorg.checksums import ColumnChecksums, write_checksums
 
 '''
 Inputs
@@ -29,10 +46,11 @@ _OUT_COLUMNS = [('id_string', 'TEXT'), ('obsHistID', 'BIGINT'),
 
 class SnVariabilityWriter:
     def __init__(self, summ_file=_SUMM_FILE, out_file=_OUT_FILE,
-                 var_file=_VAR_FILE):
+                 var_file=_VAR_FILE, instrument=NULL_INSTRUMENT):
         self._summ_file = summ_file
         self._var_file = var_file
         self._out_file = out_file
+        self._instrument = instrument
 
         ins = f'insert into {_OUT_TABLE} VALUES ('
         for i in range(len(_OUT_COLUMNS) - 1):
@@ -40,70 +58,324 @@ class SnVariabilityWriter:
         ins += '?)'
         self._insert = ins
 
-    def create(self, chunksize=50000, max_chunk=None):
-        read_conn = connect_read(self._summ_file)
-
-        attach_q = "attach '" + self._var_file + "' as var"
-        read_conn.execute(attach_q)
-
+    def _join_query(self, rowid_range=None, range_table=None):
         select_columns = (f'{_VAR_TABLE}.id', 'obsHistID', 'MJD',
                           'bandpass', 'delta_flux', f'{_SUMM_TABLE}.id')
         table_spec = f'{_SUMM_TABLE} INNER JOIN var.{_VAR_TABLE} ON '
         table_spec += f'{_SUMM_TABLE}.id_string = var.{_VAR_TABLE}.id'
         select_q = 'SELECT ' + ','.join(select_columns) + ' from '
         select_q += table_spec
+        if rowid_range:
+            select_q += f' WHERE {range_table}.rowid > {rowid_range[0]}'
+            select_q += f' AND {range_table}.rowid <= {rowid_range[1]}'
+        return select_q
+
+    def _range_table(self, conn):
+        '''
+        Schema-qualified name of the table the serial join scans in its
+        outer loop.  With snid_ix on var.id sqlite normally scans
+        summary and searches var, but may choose the other order
+        '''
+        outer = outer_table(conn, self._join_query())
+        if outer and outer.split('.')[-1] == _VAR_TABLE:
+            return f'var.{_VAR_TABLE}'
+        return _SUMM_TABLE
+
+    def create(self, chunksize=50000, max_chunk=None, read_profile='scan',
+               rowid_range=None, range_table=None, out_file=None):
+        '''
+        Write the joined rows to out_file (default: the writer's out_file);
+        a name ending in .parquet is written as parquet.  If rowid_range
+        (lo, hi] is given, only rows from that range of range_table.
+        chunksize is an int, 'auto' or a BatchSizer (see batch_sizer).
+        Returns number of rows written
+        '''
+        out_file = out_file or self._out_file
+        pool = shared_pool(self._summ_file, {'var' : self._var_file},
+                           profile=read_profile)
+        sizer = as_sizer(chunksize)
+        # The per-process pool has a single connection; it must go back
+        # whatever happens, or the next create in this process waits forever
+        with pool.connection() as read_conn:
+            read_cur = read_conn.cursor()
+            pq_writer = None
+            try:
+                read_cur.arraysize = sizer.size
+                read_cur.execute(self._join_query(rowid_range, range_table))
 
-        read_cur = read_conn.cursor()
-        read_cur.arraysize = chunksize
-        read_cur.execute(select_q)
+                # If we got this far, create new table
+                if out_file.endswith('.parquet'):
+                    pq_writer = pq.ParquetWriter(out_file,
+                                                 arrow_schema(_OUT_COLUMNS))
+                else:
+                    create_query = assemble_create_table(_OUT_TABLE, _OUT_COLUMNS)
+                    with sqlite3.connect(out_file) as conn:
+                        conn.execute(create_query)
 
-        # If we got this far, create new table
-        create_query = assemble_create_table(_OUT_TABLE, _OUT_COLUMNS)
-        with sqlite3.connect(self._out_file) as conn:
-            conn.execute(create_query)
+                checks = ColumnChecksums.for_columns(_OUT_COLUMNS)
+                i_chunk = 0
+                n_rows = 0
 
-        done = False
-        i_chunk = 0
+                while True:
+                    if max_chunk:
+                        if i_chunk >= max_chunk:
+                            break
+                    read_cur.arraysize = sizer.size
+                    with sizer.batch() as b:
+                        n = self._do_chunk(read_cur, out_file, pq_writer, checks)
+                        b.rows = n
+                    if n == 0:
+                        break
+                    n_rows += n
+                    i_chunk += 1
+                    if i_chunk % 10 == 0:
+                        print('Next chunk is ', i_chunk)
+
+                write_checksums(out_file, checks, table=_OUT_TABLE,
+                                writer=pq_writer)
+            finally:
+                if pq_writer is not None:
+                    pq_writer.close()
+                read_cur.close()
+        return n_rows
+
+    def plan(self, memory_gbyte=4.0, sample_rows=5000, out_format=None,
+             read_profile='scan', max_workers=None, n_ranges=None):
+        '''
+        Sample the join and estimate output size, memory and wall time of
+        create / create_parallel; recommend chunksize and workers for a
+        memory budget.  out_format defaults to that of out_file.  See
+        planner.plan_writer
+        '''
+        if out_format is None:
+            out_format = 'parquet' if self._out_file.endswith('.parquet') else 'db'
+        with connect_read(self._summ_file, profile=read_profile) as conn:
+            conn.execute(f"ATTACH DATABASE '{self._var_file}' AS var")
+            range_table = self._range_table(conn)
+            return plan_writer(conn,
+                               partial(self._join_query, range_table=range_table),
+                               range_table, _OUT_COLUMNS,
+                               [self._summ_file, self._var_file],
+                               memory_gbyte=memory_gbyte,
+                               sample_rows=sample_rows, out_format=out_format,
+                               read_profile=read_profile,
+                               max_workers=max_workers, n_ranges=n_ranges)
 
-        while not done:
-            if max_chunk:
-                if i_chunk >= max_chunk:
-                    break
-            done = self._do_chunk(read_cur)
-            if done:
+    def create_parallel(self, n_ranges=8, max_workers=None, chunksize=50000,
+                        read_profile='scan', shard_dir=None,
+                        shard_format='db', merge=True):
+        '''
+        Split the outer table of the join into n_ranges rowid ranges and
+        write each in its own process to a shard in shard_dir (default:
+        next to out_file).  If merge, combine shards in range order into
+        out_file and delete them; otherwise leave them, e.g. as a
+        multi-file parquet dataset (shard_format='parquet').
+
+        Returns list of shard files (empty if merged)
+        '''
+        if merge and shard_format == 'parquet' and not self._out_file.endswith('.parquet'):
+            raise ValueError('Merged parquet output requires out_file ending in .parquet')
+        with connect_read(self._summ_file) as conn:
+            conn.execute(f"ATTACH DATABASE '{self._var_file}' AS var")
+            range_table = self._range_table(conn)
+            ranges = rowid_ranges(conn, range_table, n_ranges)
+        if shard_dir is None:
+            shard_dir = os.path.dirname(os.path.abspath(self._out_file))
+        os.makedirs(shard_dir, exist_ok=True)
+        stem = os.path.splitext(os.path.basename(self._out_file))[0]
+        shards = [os.path.join(shard_dir, f'{stem}_part{i:04d}.{shard_format}')
+                  for i in range(len(ranges))]
+        # Shards left by an earlier failed run would make create fail
+        for shard in shards:
+            if os.path.exists(shard):
+                os.remove(shard)
+        print_date(msg=f'{len(ranges)} ranges over {range_table}')
+
+        worker = partial(_write_range, self._summ_file, self._var_file,
+                         chunksize=chunksize, read_profile=read_profile,
+                         range_table=range_table)
+        counts = run_ranges(worker, ranges, shards, max_workers=max_workers)
+        print_date(msg=f'Wrote {sum(counts)} rows to {len(shards)} shards')
+        if not merge:
+            return shards
+
+        if shard_format == 'parquet':
+            merge_parquet_shards(shards, self._out_file)
+        else:
+            merge_sqlite_shards(shards, self._out_file, _OUT_TABLE,
+                                assemble_create_table(_OUT_TABLE, _OUT_COLUMNS))
+        for shard in shards:
+            os.remove(shard)
+        return []
+
+    def create_with_dictionary(self, id_dict, chunksize=50000, max_chunk=None,
+                               out_file=None):
+        '''
+        Write the same rows as create without the text join: read the
+        variability table (sqlite or parquet) in its stored order, map
+        id strings to int ids with id_dict (an SnIdDictionary or its
+        directory) and drop rows whose id is not in the dictionary.
+        Build the dictionary from the new summary, e.g.
+        SnIdDictionary.build(summ_file, dict_dir).
+
+        Row order follows the variability table rather than the summary.
+        Returns number of rows written
+        '''
+        if not isinstance(id_dict, SnIdDictionary):
+            id_dict = SnIdDictionary(id_dict)
+        out_file = out_file or self._out_file
+        schema = arrow_schema(_OUT_COLUMNS)
+        if out_file.endswith('.parquet'):
+            pq_writer = pq.ParquetWriter(out_file, schema)
+        else:
+            pq_writer = None
+            with sqlite3.connect(out_file) as conn:
+                conn.execute(assemble_create_table(_OUT_TABLE, _OUT_COLUMNS))
+
+        checks = ColumnChecksums(schema)
+        ins = self._instrument
+        var_columns = ['id', 'obsHistID', 'MJD', 'bandpass', 'delta_flux']
+        sizer = as_sizer(chunksize)
+        batches = sizer.timed(rebatch(read_batches(self._var_file, var_columns,
+                                                   table=_VAR_TABLE,
+                                                   batch_rows=sizer.size),
+                                      sizer))
+        n_rows = 0
+        i_chunk = 0
+        while True:
+            if max_chunk and i_chunk >= max_chunk:
+                break
+            with ins.stage('fetch') as st:
+                batch = next(batches, None)
+                st.add(rows=batch.num_rows if batch is not None else 0)
+            if batch is None:
                 break
+            with ins.stage('transform', rows=batch.num_rows):
+                ids = id_dict.lookup(batch.column(0))
+                keep = ids >= 0
+                out = pa.RecordBatch.from_arrays(
+                    [pc.cast(a, f.type) for (a, f) in
+                     zip(list(batch.columns) + [pa.array(ids)], schema)],
+                    schema=schema).filter(pa.array(keep))
+            if out.num_rows > 0:
+                with ins.stage('write', rows=out.num_rows):
+                    if pq_writer is not None:
+                        pq_writer.write_batch(out)
+                    else:
+                        with sqlite3.connect(out_file) as conn:
+                            conn.executemany(self._insert, batch_to_rows(out))
+                            conn.commit()
+                with ins.stage('checksum', rows=out.num_rows):
+                    checks.update(out)
+            n_rows += out.num_rows
             i_chunk += 1
             if i_chunk % 10 == 0:
                 print('Next chunk is ', i_chunk)
 
-        read_conn.close()
+        write_checksums(out_file, checks, table=_OUT_TABLE, writer=pq_writer)
+        if pq_writer is not None:
+            pq_writer.close()
+        return n_rows
 
-    def _do_chunk(self, read_cur):
+    def _do_chunk(self, read_cur, out_file, pq_writer=None, checks=None):
         '''
-        Get a chunk of rows and write them to the new db.
-        Return True if there is nothing more to do
+        Get a chunk of rows and write them to the new db (or parquet
+        writer, if supplied), adding them to checks if supplied.
+        Return number of rows written; 0 if there is nothing more to do
         '''
-        rows = read_cur.fetchmany()
+        ins = self._instrument
+        with ins.stage('fetch') as st:
+            rows = read_cur.fetchmany()
+            st.add(rows=len(rows))
         if len(rows) == 0:
-            return True
+            return 0
 
+        if pq_writer is not None:
+            batch = rows_to_batch(rows, pq_writer.schema)
+            with ins.stage('write', rows=len(rows)):
+                pq_writer.write_batch(batch)
+            if checks is not None:
+                with ins.stage('checksum', rows=len(rows)):
+                    checks.update(batch)
+            return len(rows)
 
-        with sqlite3.connect(self._out_file) as conn:
+        with sqlite3.connect(out_file) as conn:
             cur = conn.cursor()
-            cur.executemany(self._insert, rows)
-            conn.commit()
+            with ins.stage('write', rows=len(rows)):
+                cur.executemany(self._insert, rows)
+            with ins.stage('commit'):
+                conn.commit()
+        if checks is not None:
+            with ins.stage('checksum', rows=len(rows)):
+                checks.update_rows(rows)
+
+        return len(rows)
 
-        return False
+def _write_range(summ_file, var_file, shard, lo, hi, chunksize=50000,
+                 read_profile='scan', range_table=None):
+    '''
+    Process pool worker for SnVariabilityWriter.create_parallel
+    '''
+    writer = SnVariabilityWriter(summ_file=summ_file, var_file=var_file,
+                                 out_file=shard)
+    return writer.create(chunksize=chunksize, read_profile=read_profile,
+                         rowid_range=(lo, hi), range_table=range_table)
 
 if __name__ == '__main__':
-    # for testing
-    #writer = SnVariabilityWriter(out_file=os.path.join(_SN_DIR, 'truth_sn_var_test.db'))
+    import argparse
 
-    # real
-    writer = SnVariabilityWriter()
+    parser = argparse.ArgumentParser(description='Write truth SN variability table')
+    parser.add_argument('--summ-file', default=_SUMM_FILE)
+    parser.add_argument('--var-file', default=_VAR_FILE)
+    parser.add_argument('--out-file', default=_OUT_FILE)
+    parser.add_argument('--chunksize', type=chunksize_arg, default=50000,
+                        help="rows per chunk, or 'auto' to adapt at run time")
+    parser.add_argument('--max-chunk', type=int, default=None,
+                        help='for testing; serial mode only')
+    parser.add_argument('--parallel', type=int, default=0, metavar='N_RANGES',
+                        help='if > 0, split the join into this many rowid ranges run in separate processes')
+    parser.add_argument('--max-workers', type=int, default=None)
+    parser.add_argument('--shard-format', choices=['db', 'parquet'],
+                        default='db')
+    parser.add_argument('--shard-dir', default=None)
+    parser.add_argument('--no-merge', action='store_true',
+                        help='leave shards rather than merging into out-file')
+    parser.add_argument('--id-dict', default=None,
+                        help='SnIdDictionary directory; if set, map ids with it instead of joining on id strings')
+    parser.add_argument('--plan', action='store_true',
+                        help='sample inputs, print size, memory and time estimates and recommended settings; write nothing')
+    parser.add_argument('--memory-gbyte', type=float, default=4.0,
+                        help='memory budget used with --plan')
+    parser.add_argument('--verify', default=None, metavar='SERIAL_FILE',
+                        help='compare merged output with output of the serial path')
 
-    # for testing
-    # writer.create(chunksize=1000, max_chunk=3)
+    args = parser.parse_args()
+    print_callinfo(sys.argv[0], args)
 
-    # for real
-    writer.create()
+    writer = SnVariabilityWriter(summ_file=args.summ_file,
+                                 var_file=args.var_file,
+                                 out_file=args.out_file)
+    if args.plan:
+        print(format_plan(writer.plan(memory_gbyte=args.memory_gbyte,
+                                      max_workers=args.max_workers,
+                                      n_ranges=args.parallel or None)))
+        sys.exit(0)
+    if args.id_dict:
+        shards = []
+        writer.create_with_dictionary(args.id_dict, chunksize=args.chunksize,
+                                      max_chunk=args.max_chunk)
+    elif args.parallel > 0:
+        shards = writer.create_parallel(n_ranges=args.parallel,
+                                        max_workers=args.max_workers,
+                                        chunksize=args.chunksize,
+                                        shard_dir=args.shard_dir,
+                                        shard_format=args.shard_format,
+                                        merge=not args.no_merge)
+    else:
+        shards = []
+        writer.create(chunksize=args.chunksize, max_chunk=args.max_chunk)
+    if args.verify:
+        tol = 1.0e-7 if args.shard_format == 'parquet' else 0.0
+        print(verify_against_serial(args.verify, shards or args.out_file,
+                                    _OUT_TABLE, tolerance=tol))
+    print_date(msg='Done')
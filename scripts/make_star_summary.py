@@ -1,14 +1,20 @@
 import os
 import numpy as np
 import sqlite3
+import pyarrow as pa
+import pyarrow.compute as pc
 
-# Note: because of the following import, this code must be run in
+# Note: with the default dust engine (EBVbase) this code must be run in
 # an environment where old lsst-sims is available
-from lsst.sims.catUtils.dust import EBVbase
+from desc.truth_reorg.dust_map import make_ebv_model
 
 from desc.truth_reorg.truth_reorg_utils import assemble_create_table,connect_read
 
 from desc.truth_reorg.oldsim_utils import  get_MW_AvRv
+from desc.truth_reorg.script_utils import NULL_INSTRUMENT
+from desc.truth_reorg.parquet_utils import open_parquet_writer, read_batches, rebatch
+from desc.truth_reorg.batch_sizer import as_sizer
+from desc.truth_reorg.checksums import ColumnChecksums, write_checksums
 
 '''
 Inputs:
@@ -16,7 +22,8 @@ Old (trimmed) star truth summary
 LC stats
 
 Outputs:
-truth_star_summary table in SQLite file
+truth_star_summary table in SQLite file, or a parquet file if the output
+name ends in .parquet.  Inputs may be sqlite or parquet files.
 
 The following need to happen:
 * read in columns of interest from the inputs.
@@ -25,6 +32,9 @@ The following need to happen:
     because we're going to include the more useful above_threshold instead
   - From LC stats need model and stdev_<band>
 * use them all in the new table except from set stdev_<band> store only max
+  stdev_<band> always come from LC stats.  lc_aggregates keeps only the
+  stdev of delta_flux; a first-order conversion to delta mag moves
+  objects across the threshold for above_threshold
 * convert id field to int
 * add Av, Rv as was done for SNe
 '''
@@ -62,10 +72,13 @@ class StarSummaryWriter:
 
     _DMAG_THRESHOLD = 0.001
 
-    def __init__(self, old_summary=_OLD_SUMMARY, lc_stats=_LC_STATS):
+    def __init__(self, old_summary=_OLD_SUMMARY, lc_stats=_LC_STATS,
+                 instrument=NULL_INSTRUMENT, dust_engine='ebvbase',
+                 dust_map_dir=None):
         self._old_summary = old_summary
         self._lc_stats = lc_stats
-        self._ebv_model = EBVbase()
+        self._ebv_model = make_ebv_model(dust_engine, map_dir=dust_map_dir)
+        self._instrument = instrument
 
     @staticmethod
     def to_int(s):
@@ -75,25 +88,30 @@ class StarSummaryWriter:
         '''
         Read in a chunk from each of two tables, compute Av, Rv and
         max_stdev, glue it all back together and write to output.
-        Return True if input is exhausted, else False
+        Return number of rows written; 0 if input is exhausted
         '''
-        summ_rows = summ_cur.fetchmany()
-        if len(summ_rows) == 0:
-            return True
-        lc_rows = lc_cur.fetchmany()
-
-        id_text, ra, dec, flux_u, flux_g, flux_r, flux_i, flux_z, flux_y = zip(*summ_rows)
-        model, stdev_u, stdev_g, stdev_r, stdev_i, stdev_z, stdev_y = zip(*lc_rows)
-        max_mag = np.amax(np.array([stdev_u, stdev_g, stdev_r, stdev_i,
-                                    stdev_z, stdev_y]), axis=0)
-        # convert boolean to int (actually first np.int64)
-        # Following does not play nicely with sqlite.  It doesn't seem to
-        # know what to do with np.int64
-        above_np = np.multiply(max_mag > self._DMAG_THRESHOLD, 1)
-
-        # so try this
-        above_threshold = [int(m) for m in above_np]
-        av, rv = get_MW_AvRv(self._ebv_model, ra, dec)
+        ins = self._instrument
+        with ins.stage('fetch') as st:
+            summ_rows = summ_cur.fetchmany()
+            if len(summ_rows) == 0:
+                return 0
+            lc_rows = lc_cur.fetchmany()
+            st.add(rows=len(summ_rows))
+
+        with ins.stage('transform', rows=len(summ_rows)):
+            id_text, ra, dec, flux_u, flux_g, flux_r, flux_i, flux_z, flux_y = zip(*summ_rows)
+            model, stdev_u, stdev_g, stdev_r, stdev_i, stdev_z, stdev_y = zip(*lc_rows)
+            max_mag = np.amax(np.array([stdev_u, stdev_g, stdev_r, stdev_i,
+                                        stdev_z, stdev_y]), axis=0)
+            # convert boolean to int (actually first np.int64)
+            # Following does not play nicely with sqlite.  It doesn't seem to
+            # know what to do with np.int64
+            above_np = np.multiply(max_mag > self._DMAG_THRESHOLD, 1)
+
+            # so try this
+            above_threshold = [int(m) for m in above_np]
+        with ins.stage('extinction', rows=len(summ_rows)):
+            av, rv = get_MW_AvRv(self._ebv_model, ra, dec)
 
         id_int = [int(i_t) for i_t in id_text]
 
@@ -101,13 +119,98 @@ class StarSummaryWriter:
                             flux_u, flux_g, flux_r, flux_i, flux_z, flux_y,
                             model, max_mag, above_threshold, av, rv))
 
-        self._out_conn.cursor().executemany(self._INSERT, to_write)
-        self._out_conn.commit()
+        with ins.stage('write', rows=len(to_write)):
+            self._out_conn.cursor().executemany(self._INSERT, to_write)
+        with ins.stage('commit'):
+            self._out_conn.commit()
+        with ins.stage('checksum', rows=len(to_write)):
+            self._checks.update_rows(to_write)
 
-        return False
+        return len(to_write)
+
+    def _do_batch(self, summ, lc, writer):
+        '''
+        Arrow counterpart of _do_chunk: summ and lc are row-aligned
+        RecordBatches.  Compute new columns with Arrow kernels and write
+        one batch to writer
+        '''
+        ins = self._instrument
+        n = summ.num_rows
+        with ins.stage('transform', rows=n):
+            id_int = pc.cast(summ.column('id'), pa.int64())
+            stdevs = [lc.column(c) for c in self._LC_STATS_COLUMNS[1:]]
+            max_mag = pc.max_element_wise(*stdevs)
+            above_threshold = pc.greater(max_mag, self._DMAG_THRESHOLD)
+        with ins.stage('extinction', rows=n):
+            av, rv = get_MW_AvRv(self._ebv_model,
+                                 summ.column('ra').to_numpy(zero_copy_only=False),
+                                 summ.column('dec').to_numpy(zero_copy_only=False))
+
+        arrays = ([id_int] + [summ.column(c) for c in self._SUMM_COLUMNS[1:]]
+                  + [lc.column('model'), max_mag, above_threshold, av, rv])
+        schema = writer.schema
+        out = pa.RecordBatch.from_arrays([pc.cast(a, f.type)
+                                          for (a, f) in zip(arrays, schema)],
+                                         schema=schema)
+        with ins.stage('write', rows=n):
+            writer.write_batch(out)
+        with ins.stage('checksum', rows=n):
+            self._checks.update(out)
+
+    def create_parquet(self, out_file, chunksize=50000, max_chunk=None,
+                       tune=True):
+        '''
+        As create, but write parquet, one record batch at a time.  Inputs
+        may be the usual sqlite files or parquet files with the same columns
+        '''
+        # Both streams are cut to the sizer's current size, which changes
+        # only between batches, so they stay row-aligned
+        sizer = as_sizer(chunksize)
+        summ_batches = rebatch(read_batches(self._old_summary,
+                                            self._SUMM_COLUMNS,
+                                            table=_OLD_SUMMARY_TABLE,
+                                            batch_rows=sizer.size), sizer)
+        lc_batches = rebatch(read_batches(self._lc_stats,
+                                          self._LC_STATS_COLUMNS,
+                                          table=_LC_STATS_TABLE,
+                                          batch_rows=sizer.size), sizer)
+        writer = open_parquet_writer(out_file, self._OUT_COLUMNS, tune=tune,
+                                     low_cardinality=['model'])
+        self._checks = ColumnChecksums(writer.schema)
+        ins = self._instrument
+        i_chunk = 0
+        while True:
+            if max_chunk and i_chunk >= max_chunk:
+                break
+            with sizer.batch() as b:
+                with ins.stage('fetch') as st:
+                    summ = next(summ_batches, None)
+                    lc = next(lc_batches, None)
+                    st.add(rows=summ.num_rows if summ is not None else 0)
+                if summ is None:
+                    print("all done")
+                    break
+                if lc is None or lc.num_rows != summ.num_rows:
+                    raise ValueError('Summary and LC stats inputs differ in length')
+                self._do_batch(summ, lc, writer)
+                b.rows = summ.num_rows
+            if i_chunk % 10 == 0:
+                print('completed chunk ', i_chunk)
+            i_chunk += 1
+        write_checksums(out_file, self._checks, writer=writer)
+        writer.close()
 
     def create(self, out_file=_OUT, chunksize=20000, max_chunk=None):
+        '''
+        Write the new summary.  model and stdev of delta mag per band come
+        from LC stats.
+        chunksize is an int, 'auto' or a BatchSizer (see batch_sizer)
+        '''
+        if out_file.endswith('.parquet'):
+            return self.create_parquet(out_file, chunksize=chunksize,
+                                       max_chunk=max_chunk)
         self._outfile = out_file
+        sizer = as_sizer(chunksize)
         self._chunksize = chunksize
 
         old_summary_conn = connect_read(self._old_summary)
@@ -117,12 +220,10 @@ class StarSummaryWriter:
         # create new table
         create_stmt = assemble_create_table(_OUT_TABLE, self._OUT_COLUMNS)
         out_conn.execute(create_stmt)
+        self._checks = ColumnChecksums.for_columns(self._OUT_COLUMNS)
 
         old_summary_cur = old_summary_conn.cursor()
-        old_summary_cur.arraysize = chunksize
-
         lc_cur = lc_conn.cursor()
-        lc_cur.arraysize = chunksize
 
         select_old = 'SELECT ' + ','.join(self._SUMM_COLUMNS) + ' from ' + _OLD_SUMMARY_TABLE
         select_lc = 'SELECT ' + ','.join(self._LC_STATS_COLUMNS) + ' from ' + _LC_STATS_TABLE
@@ -133,7 +234,12 @@ class StarSummaryWriter:
         i_chunk = 0
 
         while not done:
-            done = self._do_chunk(old_summary_cur, lc_cur)
+            # Same size for both cursors keeps them row-aligned
+            old_summary_cur.arraysize = sizer.size
+            lc_cur.arraysize = sizer.size
+            with sizer.batch() as b:
+                b.rows = self._do_chunk(old_summary_cur, lc_cur)
+            done = (b.rows == 0)
             if done:
                 print("all done")
             else:
@@ -146,6 +252,8 @@ class StarSummaryWriter:
 
         old_summary_conn.close()
         lc_conn.close()
+        write_checksums(out_file, self._checks, table=_OUT_TABLE,
+                        conn=self._out_conn)
         self._out_conn.close()
 
 if __name__ == '__main__':
@@ -0,0 +1,277 @@
+'''
+Run the SN and/or star build chains as described by a YAML or TOML
+configuration file, e.g.
+
+stages:
+  trim_sn:
+    type: trim_sn_summary
+    inputs: [$SCRATCH/desc/truth/sn/sum_variable-31mar.db,
+             $SCRATCH/desc/truth/sn/sne_cosmoDC2_v1.1.4_MS_DDF.db]
+    outputs: [$SCRATCH/desc/truth/sn/initial_table.db]
+    params: {chunksize: 30000, pad: [0.2, 0.6, 0.2]}
+  complete_sn:
+    type: complete_sn_summary
+    inputs: [$SCRATCH/desc/truth/sn/initial_table.db,
+             $SCRATCH/desc/truth/sn/sum_variable-31mar.db]
+    outputs: [$SCRATCH/desc/truth/sn/truth_sn_summary.db]
+
+Stages are connected by matching outputs to inputs.  The order of
+inputs and outputs for each stage type is given in the docstring of the
+corresponding function below.  Environment variables in paths are expanded.
+See doc/pipeline_example.yaml for a complete configuration.
+'''
+import os
+import re
+import sys
+import shutil
+import sqlite3
+from functools import wraps
+
+from desc.truth_reorg.script_utils import print_callinfo, print_date
+from desc.truth_reorg.pipeline import Stage, Pipeline, load_config
+
+def _remove_outputs(outputs):
+    # Writers create their tables and fail if they already exist
+    for p in outputs:
+        if os.path.isdir(p):
+            shutil.rmtree(p)
+        elif os.path.exists(p):
+            os.remove(p)
+
+def _tmp_name(path):
+    # Same directory and extension, since writers choose the format from it
+    return os.path.join(os.path.dirname(path),
+                        f'.tmp.{os.getpid()}.{os.path.basename(path)}')
+
+def _companions(tmp):
+    '''
+    Files written alongside tmp, e.g. checksum sidecars: tmp + suffix
+    '''
+    d = os.path.dirname(tmp) or '.'
+    base = os.path.basename(tmp)
+    return [os.path.join(d, f) for f in os.listdir(d)
+            if f.startswith(base) and f != base]
+
+def _staged_outputs(func):
+    '''
+    Decorator for stage functions: func writes its outputs under
+    temporary names, which replace the real outputs only when it
+    succeeds.  A failed or killed stage never leaves a partial output
+    which looks newer than its inputs
+    '''
+    @wraps(func)
+    def wrapper(inputs, outputs, **params):
+        tmp = [_tmp_name(p) for p in outputs]
+        _remove_outputs(tmp + [c for t in tmp for c in _companions(t)])
+        try:
+            func(inputs, tmp, **params)
+        except BaseException:
+            _remove_outputs(tmp + [c for t in tmp for c in _companions(t)])
+            raise
+        for (t, p) in zip(tmp, outputs):
+            for c in _companions(t):
+                os.replace(c, p + c[len(t):])
+            _remove_outputs([p])
+            os.replace(t, p)
+    return wrapper
+
+_CREATE_INDEX_RE = re.compile(r'^\s*create\s+(unique\s+)?index\s+(?!if\s+not\s+exists)',
+                              re.IGNORECASE)
+
+def _create_indexes(path, statements):
+    '''
+    Run create index statements on sqlite file path.  Each is made
+    "if not exists", so running them again is harmless
+    '''
+    with sqlite3.connect(path) as conn:
+        for stmt in statements:
+            conn.execute(_CREATE_INDEX_RE.sub(
+                lambda m: f'create {m.group(1) or ""}index if not exists ', stmt))
+        conn.commit()
+
+@_staged_outputs
+def trim_sn_summary(inputs, outputs, chunksize=30000, pad=(0.2, 0.6, 0.2)):
+    '''
+    inputs: old SN truth summary, sn params.  outputs: initial table.
+    pad is (ra, north dec, south dec) padding in degrees.
+    Requires lsst_distrib
+    '''
+    from trim_sn_summary import TrimSnSummary
+    from desc.truth_reorg.sphgeom_utils import Region, DC2_RA_MID, DC2_RA_NE, DC2_DEC_NE, DC2_DEC_S
+    ra_pad, n_pad, s_pad = pad
+    region = Region(ra_mid=DC2_RA_MID,
+                    ne_corner=(DC2_RA_NE + ra_pad, DC2_DEC_NE + n_pad),
+                    dec_range=(DC2_DEC_S - s_pad, DC2_DEC_NE + n_pad))
+    TrimSnSummary(region, inputs[0], inputs[1]).create(outpath=outputs[0],
+                                                       chunksize=chunksize)
+
+@_staged_outputs
+def complete_sn_summary(inputs, outputs, chunksize=20000):
+    '''
+    inputs: initial table, SN variability.  outputs: truth_sn_summary.
+    Requires lsst_sims
+    '''
+    from complete_sn_summary import SnSummaryWriter
+    SnSummaryWriter(out_file=outputs[0], in_file=inputs[0],
+                    var_file=inputs[1]).complete(chunksize=chunksize)
+
+@_staged_outputs
+def sn_variability(inputs, outputs, chunksize=50000, n_ranges=0,
+                   max_workers=None, indexes=()):
+    '''
+    inputs: truth_sn_summary, old SN variability.  outputs: new variability
+    If n_ranges > 0 the join is split into that many parallel rowid ranges.
+    indexes are create index statements run on the output once written,
+    so that stages reading it see it only in its final state
+    '''
+    from make_sn_variability import SnVariabilityWriter
+    writer = SnVariabilityWriter(summ_file=inputs[0], var_file=inputs[1],
+                                 out_file=outputs[0])
+    if n_ranges > 0:
+        writer.create_parallel(n_ranges=n_ranges, max_workers=max_workers,
+                               chunksize=chunksize)
+    else:
+        writer.create(chunksize=chunksize)
+    _create_indexes(outputs[0], indexes)
+
+@_staged_outputs
+def trim_region(inputs, outputs, table_name='truth_star_summary',
+                chunksize=50000, pad=(0.2, 0.6, 0.2)):
+    '''
+    inputs: file to be trimmed.  outputs: trimmed file.
+    Requires lsst_distrib
+    '''
+    from trim_to_region import Trimmer
+    from desc.truth_reorg.sphgeom_utils import DC2_RA_MID, DC2_RA_NE, DC2_DEC_NE, DC2_DEC_S
+    ra_pad, n_pad, s_pad = pad
+    trimmer = Trimmer(ifile=inputs[0], ofile=outputs[0], table_name=table_name)
+    trimmer.set_region(DC2_RA_MID, DC2_RA_NE + ra_pad, DC2_DEC_NE + n_pad,
+                       DC2_DEC_S - s_pad)
+    trimmer.trim(chunksize=chunksize)
+
+@_staged_outputs
+def star_summary(inputs, outputs, chunksize=50000):
+    '''
+    inputs: old (trimmed) star summary, LC stats.  outputs: truth_star_summary.
+    Requires lsst_sims
+    '''
+    from make_star_summary import StarSummaryWriter
+    StarSummaryWriter(old_summary=inputs[0],
+                      lc_stats=inputs[1]).create(out_file=outputs[0],
+                                                 chunksize=chunksize)
+
+@_staged_outputs
+def star_variability(inputs, outputs, chunksize=50000, n_ranges=0,
+                     max_workers=None, indexes=()):
+    '''
+    inputs: truth_star_summary, old star variability.
+    outputs: new variability
+    If n_ranges > 0 the join is split into that many parallel rowid ranges.
+    indexes as for sn_variability
+    '''
+    from make_star_variability import StarVariabilityWriter
+    writer = StarVariabilityWriter(summ_file=inputs[0], var_file=inputs[1],
+                                   out_file=outputs[0])
+    if n_ranges > 0:
+        writer.create_parallel(n_ranges=n_ranges, max_workers=max_workers,
+                               chunksize=chunksize)
+    else:
+        writer.create(chunksize=chunksize)
+    _create_indexes(outputs[0], indexes)
+
+@_staged_outputs
+def convert_parquet(inputs, outputs, table, n_group=1, max_group_gbyte=5.0):
+    '''
+    inputs: sqlite file.  outputs: parquet file
+    '''
+    from desc.truth_reorg.parquet_utils import convert_sqlite_to_parquet
+    convert_sqlite_to_parquet(inputs[0], outputs[0], table, n_group=n_group,
+                              max_group_gbyte=max_group_gbyte,
+                              order_by='rowid')
+
+@_staged_outputs
+def compact_light_curves(inputs, outputs, table=None, batch_rows=500000):
+    '''
+    inputs: variability file (sqlite or parquet).  outputs: directory for
+    the compact layout; see desc.truth_reorg.lc_compact
+    '''
+    from desc.truth_reorg.lc_compact import encode_light_curves
+    encode_light_curves(inputs[0], outputs[0], table=table,
+                        batch_rows=batch_rows)
+
+@_staged_outputs
+def create_indexes(inputs, outputs, statements=()):
+    '''
+    inputs: sqlite file.  outputs: stamp file written on success.
+    statements are create index statements, as in doc/indexes.txt.
+    The input is modified in place, which makes any stage reading it
+    look out of date afterwards; for files produced in the pipeline use
+    the indexes parameter of the producing stage instead
+    '''
+    _create_indexes(inputs[0], statements)
+    with open(outputs[0], 'w') as f:
+        f.write('\n'.join(statements) + '\n')
+
+STAGE_TYPES = {'trim_sn_summary' : trim_sn_summary,
+               'complete_sn_summary' : complete_sn_summary,
+               'sn_variability' : sn_variability,
+               'trim_region' : trim_region,
+               'star_summary' : star_summary,
+               'star_variability' : star_variability,
+               'convert_parquet' : convert_parquet,
+               'compact_light_curves' : compact_light_curves,
+               'create_indexes' : create_indexes}
+
+def build_pipeline(config, manifest_path=None):
+    '''
+    Make a Pipeline from a config dict as returned by load_config.
+    manifest_path may also be given in the config as key "manifest"
+    '''
+    stages = []
+    for (name, spec) in config['stages'].items():
+        if spec['type'] not in STAGE_TYPES:
+            raise ValueError(f'Stage {name} has unknown type {spec["type"]}')
+        stages.append(Stage(name, STAGE_TYPES[spec['type']],
+                            inputs=spec.get('inputs', []),
+                            outputs=spec.get('outputs', []),
+                            after=spec.get('after', []),
+                            params=spec.get('params', {})))
+    return Pipeline(stages,
+                    manifest_path=manifest_path or config.get('manifest'))
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run truth_reorg stages described in a config file')
+    parser.add_argument('config', help='YAML or TOML pipeline description')
+    parser.add_argument('--max-workers', type=int, default=2,
+                        help='maximum number of stages to run at once')
+    parser.add_argument('--force', action='store_true',
+                        help='run stages even if outputs are up to date')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='report what would run without running it')
+    parser.add_argument('--manifest', default=None,
+                        help='build manifest path; if set, decide what to rerun from content fingerprints rather than mtimes')
+    parser.add_argument('--stages', nargs='*', default=None,
+                        help='restrict to these stages (dependencies must already be built)')
+
+    args = parser.parse_args()
+    print_callinfo(sys.argv[0], args)
+
+    config = load_config(args.config)
+    if args.stages:
+        config['stages'] = {k : v for (k, v) in config['stages'].items()
+                            if k in args.stages}
+        for v in config['stages'].values():
+            v['after'] = [a for a in v.get('after', []) if a in args.stages]
+    pipeline = build_pipeline(config, manifest_path=args.manifest)
+    results = pipeline.run(max_workers=args.max_workers, force=args.force,
+                           dry_run=args.dry_run)
+
+    for (name, res) in results.items():
+        print(f'{name:24s} {res["status"]:8s} {res["elapsed"]:10.1f} s')
+    path, total = pipeline.critical_path(results)
+    print(f'Critical path ({total:.1f} s): ' + ' -> '.join(path))
+    print_date(msg='Pipeline complete')
+    if any(r['status'] == 'failed' for r in results.values()):
+        sys.exit(1)
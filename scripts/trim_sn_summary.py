@@ -9,64 +9,22 @@ Add some columns from sne params
 A separate script, which must run in a DC2-era lsst_sims environment, will
 complete calculation of additional columns.
 See   complete_sn_summary.py
+Output may be written as sqlite or, if the output path ends in .arrow
+or .feather, as an Arrow IPC file which the companion script memory-maps.
 """
 
 import os
 import numpy as np
 import sqlite3
-import astropy.units as u
-import lsst.sphgeom
+from desc.truth_reorg.script_utils import NULL_INSTRUMENT
+# Region needs lsst.sphgeom
+from desc.truth_reorg.sphgeom_utils import Region
 
 __all__ = ['Region', 'TrimSnSummary']
 _RA_MID = 61.855
 _RA_NE = 71.46
 _DEC_NE = -27.25
 _DEC_S = -44.33
-class Region:
-    def __init__(self, ra_mid=_RA_MID, ne_corner=(_RA_NE, _DEC_NE),
-                 dec_range=(-44.33, -27.25)):
-        self._ra_mid = ra_mid
-        ra0 = ne_corner[0]
-        cos_dec0 = np.cos(np.radians(ne_corner[1]))
-        self._dra_scale = np.abs(ra0 - self._ra_mid)*cos_dec0
-        self._dec_range = dec_range
-
-        self.region_corners = []
-        for dec in dec_range:
-            dra = self._dra(dec)
-            self.region_corners.extend([(ra_mid - dra, dec),
-                                        (ra_mid + dra, dec)])
-        self.region_polygon = self.get_convex_polygon(self.region_corners)
-
-    @staticmethod
-    def DDFRegion():
-        return Region(ra_mid=53.125, ne_corner=(53.764, -27.533),
-                      dec_range=(-28.667, -27.533))
-
-    @staticmethod
-    def get_convex_polygon(corners):
-        vertices = []
-        for corner in corners:
-            lonlat = lsst.sphgeom.LonLat.fromDegrees(*corner)
-            vertices.append(lsst.sphgeom.UnitVector3d(lonlat))
-        return lsst.sphgeom.ConvexPolygon(vertices)
-
-    def _dra(self, dec):
-        return np.abs(self._dra_scale/np.cos(np.radians(dec)))
-
-    def contains(self, ra, dec, degrees=True):
-        '''
-        Given parallel arrays ra, dec representing points, return a mask
-        with an entry set to True if that ra, dec in inside the region.
-        Use sphgeom ConvexPolygon routine
-        '''
-        if degrees:
-            # convert to radians
-            ra = [(r * u.degree).to_value(u.radian) for r in ra]
-            dec = [(d * u.degree).to_value(u.radian) for d in dec]
-
-        return self.region_polygon.contains(ra, dec)
-
 class TrimSnSummary:
     '''
     This class creates a new SQLite file containing the table
@@ -75,10 +33,12 @@ class TrimSnSummary:
         * Eliminates is_pointsource, is_variable, and flux columns
         * Adds some columns from sn params: mB, c, t0, x0, x1
 '''
-    def __init__(self, region, old_sn_summary, sn_params):
+    def __init__(self, region, old_sn_summary, sn_params,
+                 instrument=NULL_INSTRUMENT):
         self._region = region
         self._old_summary = old_sn_summary
         self._sn_params = sn_params
+        self._instrument = instrument
 
     _INIT_COLUMNS = [('id_string', 'TEXT'), ('host_galaxy', 'BIGINT'),
                      ('ra', 'DOUBLE'), ('dec', 'DOUBLE'), ('redshift', 'DOUBLE'),
@@ -99,69 +59,144 @@ class TrimSnSummary:
         stmt += ','.join(col_specs) + ')'
         return stmt
 
-    def _do_trim_merge(self, outpath, chunksize):
+    _ARROW_SUFFIXES = ('.arrow', '.feather')
+
+    # ids of Run3.1i objects, to be excluded, start with one of these
+    _EXCLUDE_PREFIXES = ('mDDF', 'hl_mddf')
+
+    def _trimmed_batches(self, chunksize):
+        '''
+        Generator.  For each chunk of chunksize input rows yield a pyarrow
+        RecordBatch (columns as in _INIT_COLUMNS) of rows which survive
+        the trim.  Footprint mask and id prefix exclusion are evaluated
+        on whole columns; nothing is held in memory beyond one chunk.
+        chunksize is an int, 'auto' or a BatchSizer (see batch_sizer)
+        '''
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        from desc.truth_reorg.parquet_utils import arrow_schema, rebatch
+        from desc.truth_reorg.sqlite_arrow import SqliteArrowReader
+        from desc.truth_reorg.batch_sizer import as_sizer
+
         # Note: have confirmed that the usual two input files are
         # ordered the same way: truth_summary.id = sne_params.snid_in
         # for each row
 
+        schema = arrow_schema(self._INIT_COLUMNS)
+
+        # open connection on 1 input file, attach the other.  Not taken
+        # from a ReadConnectionPool: the trim is a single sequential pass,
+        # so there is nothing to reuse, and pooled connections are sqlite3
+        # ones, which would lose the native (ADBC) read path
+        reader = SqliteArrowReader(self._old_summary)
+        reader.attach(self._sn_params, 'params')
+
+        big_select = '''
+        select id as id_string, host_galaxy, ra, dec, redshift,
+        c_in as c, mB, t0_in as t0, x0_in as x0, x1_in as x1
+        from truth_summary join params.sne_params
+        on truth_summary.rowid = params.sne_params.rowid
+        order by truth_summary.rowid'''
+        sizer = as_sizer(chunksize)
+        batches = sizer.timed(rebatch(reader.batches(big_select, schema=schema,
+                                                     batch_rows=sizer.size),
+                                      sizer))
+
+        chunk_done = 0
+        while True:
+            with self._instrument.stage('fetch') as st:
+                batch = next(batches, None)
+                st.add(rows=batch.num_rows if batch is not None else 0)
+            if batch is None:
+                break
+            with self._instrument.stage('mask', rows=batch.num_rows):
+                in_region = self._region.contains(
+                    batch.column(schema.get_field_index('ra')).to_numpy(),
+                    batch.column(schema.get_field_index('dec')).to_numpy())
+                keep = pa.array(np.asarray(in_region, dtype=bool))
+
+                # exclude objects from Run3.1i
+                ids = batch.column(schema.get_field_index('id_string'))
+                for prefix in self._EXCLUDE_PREFIXES:
+                    keep = pc.and_(keep,
+                                   pc.invert(pc.starts_with(ids, prefix)))
+                batch = batch.filter(keep)
+            yield batch
+            chunk_done += 1
+
+        reader.close()
+        print(f'Completed {chunk_done} chunks; batch sizes {sizer.summary()}')
+
+    def _do_trim_merge(self, outpath, chunksize):
+        from desc.truth_reorg.parquet_utils import batch_to_rows
+        from desc.truth_reorg.checksums import ColumnChecksums, write_checksums
+
         self._initial_out = outpath
 
-        # open connection on 1 input file, attach the other
-        conn = sqlite3.connect(self._old_summary)
-        cur = conn.cursor()
-
-        # select just ra and dec to form inclusion/exclusion mask
-        m = None
-        cur.arraysize = 600000 # arger than #rows in the tables
-        cur.execute("SELECT ra, dec from truth_summary order by rowid")
-        chunk = cur.fetchall()
-        ra, dec = zip(*chunk)
-        msk = self._region.contains(ra, dec)
-        del chunk
-
-        # For many-column select use chunk size specified
-        cur.arraysize = chunksize
-        attach = 'ATTACH DATABASE ? AS params'
-        cur.execute(attach, (self._sn_params,))
         # open output file
         conn_write  = sqlite3.connect(self._initial_out)
         cur_write = conn_write.cursor()
         create_table_sql = self.assemble_create_table(self._INITIAL_TABLE,
                                                       self._INIT_COLUMNS)
         cur_write.execute(create_table_sql)
+        checks = ColumnChecksums.for_columns(self._INIT_COLUMNS)
 
-        big_select = '''
-        select id as id_string, host_galaxy, ra, dec, redshift,
-        c_in as c, mB, t0_in as t0, x0_in as x0, x1_in as x1
-        from truth_summary join params.sne_params
-        on truth_summary.rowid = params.sne_params.rowid
-        order by truth_summary.rowid'''
         ins = '''
         insert into initial_summary VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         '''
-        cur.execute(big_select)
+        for batch in self._trimmed_batches(chunksize):
+            with self._instrument.stage('write', rows=batch.num_rows):
+                cur_write.executemany(ins, batch_to_rows(batch))
+            with self._instrument.stage('checksum', rows=batch.num_rows):
+                checks.update(batch)
+
+        with self._instrument.stage('commit'):
+            conn_write.commit()
+        write_checksums(outpath, checks, table=self._INITIAL_TABLE,
+                        conn=conn_write)
+        conn_write.close()
 
-        lower = 0
-        msk_chunk = msk[lower : lower + chunksize]
-        rows = cur.fetchmany()
-        chunk_done = 0
-        while len(rows) > 0:
-            for e in zip(msk_chunk, rows):
-                # exclude objects outside footprint or from Run3.1i
-                if e[0] and not e[1][0].startswith("mDDF") and not e[1][0].startswith("hl_mddf"):
-                    cur_write.execute(ins, e[1])
-            chunk_done += 1
-            lower += chunksize
-            msk_chunk = msk[lower : lower + chunksize]
-            rows = cur.fetchmany()
+    def iter_batches(self, chunksize=100000):
+        '''
+        Generator yielding the trimmed table as pyarrow RecordBatches,
+        one per input chunk.  Can be handed directly to
+        SnSummaryWriter.complete when both run in the same process.
+        '''
+        return self._trimmed_batches(chunksize)
 
-        conn_write.commit()
-        conn_write.close()
-        conn.close()
-        print(f'Completed {chunk_done} chunks with chunk size {chunksize}')
+    def _do_trim_arrow(self, outpath, chunksize):
+        '''
+        Write trimmed table as an Arrow IPC (Feather v2) file.  It can be
+        memory-mapped by the reader rather than read back from sqlite
+        '''
+        import pyarrow as pa
+        from desc.truth_reorg.parquet_utils import arrow_schema
+        from desc.truth_reorg.checksums import ColumnChecksums, write_checksums
+
+        self._initial_out = outpath
+        schema = arrow_schema(self._INIT_COLUMNS)
+        checks = ColumnChecksums(schema)
+        with pa.OSFile(outpath, 'wb') as sink:
+            with pa.ipc.new_file(sink, schema) as writer:
+                for batch in self.iter_batches(chunksize):
+                    with self._instrument.stage('write', rows=batch.num_rows,
+                                                nbytes=batch.nbytes):
+                        writer.write_batch(batch)
+                    with self._instrument.stage('checksum', rows=batch.num_rows):
+                        checks.update(batch)
+        # IPC files have no key-value footer to add to; use a sidecar
+        write_checksums(outpath, checks)
 
     def create(self, outpath=None, chunksize=100000):
-        self._do_trim_merge(outpath, chunksize)
+        '''
+        Write trimmed table to outpath.  If outpath ends in .arrow or
+        .feather write an Arrow IPC file; otherwise an sqlite file with
+        table initial_summary
+        '''
+        if outpath.endswith(self._ARROW_SUFFIXES):
+            self._do_trim_arrow(outpath, chunksize)
+        else:
+            self._do_trim_merge(outpath, chunksize)
 
 if __name__ == '__main__':
     '''
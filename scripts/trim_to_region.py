@@ -3,6 +3,11 @@ import sqlite3
 import os
 from desc.truth_reorg.sphgeom_utils import Region, DC2_RA_MID, DC2_RA_NE, DC2_DEC_NE, DC2_DEC_S
 from desc.truth_reorg.truth_reorg_utils import connect_read
+from desc.truth_reorg.script_utils import NULL_INSTRUMENT
+from desc.truth_reorg.sqlite_arrow import SqliteArrowReader
+from desc.truth_reorg.parquet_utils import rebatch
+from desc.truth_reorg.batch_sizer import as_sizer
+from desc.truth_reorg.checksums import ColumnChecksums, write_checksums
 
 # Note: this code must be run in lsst_distrib environment for lsst.sphgeom
 
@@ -25,13 +30,15 @@ class Trimmer:
     _IFILE = os.path.join(_IO_DIR, 'truth_star_summary_big.db')
     _OFILE = os.path.join(_IO_DIR, 'truth_star_summary_trimmed.db')
     def __init__(self, ifile=_IFILE, ofile=_OFILE,
-                 table_name='truth_star_summary', ra_name='ra', dec_name='dec'):
+                 table_name='truth_star_summary', ra_name='ra', dec_name='dec',
+                 instrument=NULL_INSTRUMENT):
         self._ifile = ifile
         self._ofile = ofile
         self._ra_name = ra_name
         self._dec_name = dec_name
         self._region = None
         self._table_name = table_name
+        self._instrument = instrument
 
         read_schema_query = "select sql from sqlite_schema where name=?"
         read_columns_query = "select * from pragma_table_info(?)"
@@ -44,6 +51,7 @@ class Trimmer:
             column_info = cursor.fetchall()
             # Format of column_info is rowid, column_name, column_type,..
             self._columns = [c[1] for c in column_info]
+            self._column_types = [(c[1], c[2].upper()) for c in column_info]
 
         # Form insert query
         ins = f'insert into {table_name} VALUES ('
@@ -56,34 +64,46 @@ class Trimmer:
         self._region = Region(ra_mid, (ne_ra, ne_dec), (s_dec, ne_dec))
 
     def trim(self, chunksize=50000, max_chunk=None):
+        '''
+        chunksize is an int, 'auto' or a BatchSizer (see batch_sizer).
+        The mask and write passes size their batches independently
+        '''
+        sizer = as_sizer(chunksize)
+        mask_sizer = sizer.clone()
         # Make mask of rows to be kept
         radec_q = f'select {self._ra_name},{self._dec_name} from ' + self._table_name
         column_string = ','.join(self._columns)
         bigread_q = ' '.join(['select', column_string, 'from', self._table_name])
-        with connect_read(self._ifile) as conn:
-            cur = conn.cursor()
-            cur.arraysize = chunksize
+        # ra, dec are read straight into arrays, not row tuples.  Batch
+        # sizes need not match chunksize, so keep one mask for all rows
+        max_rows = max_chunk * sizer.size if max_chunk else None
+        with SqliteArrowReader(self._ifile) as reader:
+            batches = mask_sizer.timed(rebatch(reader.batches(radec_q,
+                                                              batch_rows=mask_sizer.size),
+                                               mask_sizer))
             mask_chunks = []
-            cur.execute(radec_q)
+            n_rows = 0
 
             done = False
-            i_chunk = 0
             while not done:
-                if max_chunk:
-                    if i_chunk >= max_chunk:
-                        done = True
-                        break
-                rows = cur.fetchmany()
-                if len(rows) == 0:
+                if max_rows and n_rows >= max_rows:
+                    break
+                with self._instrument.stage('fetch') as st:
+                    batch = next(batches, None)
+                    st.add(rows=batch.num_rows if batch is not None else 0)
+                if batch is None:
                     done = True
                     break
-                ra, dec = zip(*rows)
-                mask_chunks.append(self._region.contains(ra, dec))
-                i_chunk += 1
-
-        read_conn = connect_read(self._ifile)
+                ra = batch.column(0).to_numpy()
+                dec = batch.column(1).to_numpy()
+                with self._instrument.stage('mask', rows=batch.num_rows):
+                    mask_chunks.append(np.asarray(self._region.contains(ra, dec),
+                                                  dtype=bool))
+                n_rows += batch.num_rows
+        mask = np.concatenate(mask_chunks) if mask_chunks else np.zeros(0, dtype=bool)
+
+        read_conn = connect_read(self._ifile, profile='scan')
         read_cur = read_conn.cursor()
-        read_cur.arraysize=chunksize
 
         read_cur.execute(bigread_q)
         done = False
@@ -95,40 +115,61 @@ class Trimmer:
             cursor = conn.cursor()
             cursor.execute(self._create_string)
 
+        # Rows are copied as stored, so checksum with the declared types
+        try:
+            self._checks = ColumnChecksums.for_columns(self._column_types)
+        except KeyError:
+            print('Column type without arrow equivalent; no checksums written')
+            self._checks = None
+
         i_chunk = 0
         while not done:
             if max_chunk:
                 if i_chunk >= max_chunk:
                     break
-            if i_chunk >= len(mask_chunks):
+            if lower >= len(mask):
                 break
-            mask_chunk = mask_chunks[i_chunk]
-            done = self._do_chunk(read_cur, mask_chunk)
-            lower += chunksize
+            read_cur.arraysize = sizer.size
+            mask_chunk = mask[lower : lower + sizer.size]
+            with sizer.batch() as b:
+                b.rows = self._do_chunk(read_cur, mask_chunk)
+            done = (b.rows == 0)
+            lower += b.rows
             i_chunk += 1
             if i_chunk % 10 == 0:
                 print('Next chunk is ', i_chunk)
 
         read_conn.close()
+        if self._checks is not None:
+            write_checksums(self._ofile, self._checks, table=self._table_name)
 
     def _do_chunk(self, read_cur, mask_chunk):
         '''
         Get some rows, decide which to exclude, write the rest
-        Return True if there is nothing more to do
+        Return number of rows read; 0 if there is nothing more to do
         '''
-        rows = read_cur.fetchmany()
+        ins = self._instrument
+        with ins.stage('fetch') as st:
+            rows = read_cur.fetchmany()
+            st.add(rows=len(rows))
         if len(rows) == 0:
-            return True
-        to_write = []
-        for e in zip(mask_chunk, rows):
-            if e[0]:
-                to_write.append(e[1])
+            return 0
+        with ins.stage('transform', rows=len(rows)):
+            to_write = []
+            for e in zip(mask_chunk, rows):
+                if e[0]:
+                    to_write.append(e[1])
         if len(to_write) == 0:
-            return False
+            return len(rows)
         with sqlite3.connect(self._ofile) as out_conn:
-            out_conn.executemany(self._insert, to_write)
-            out_conn.commit()
-        return False
+            with ins.stage('write', rows=len(to_write)):
+                out_conn.executemany(self._insert, to_write)
+            with ins.stage('commit'):
+                out_conn.commit()
+        if self._checks is not None:
+            with ins.stage('checksum', rows=len(to_write)):
+                self._checks.update_rows(to_write)
+        return len(rows)
 
 if __name__ == '__main__':
 